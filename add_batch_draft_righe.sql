@@ -0,0 +1,42 @@
+-- ========================================
+-- MIGRAZIONE: Bozze del movimento multiplo con righe e colonne di riepilogo
+-- ========================================
+-- Le righe di una bozza vengono salvate una per riga in
+-- movimenti_batch_draft_righe invece che nel blob json_items: il salvataggio
+-- automatico invia solo le righe aggiunte / modificate / rimosse
+-- (PATCH /api/movimento-multiplo/bozza/<id>).
+--
+-- num_righe, quantita_totale e num_prodotti vengono aggiornati a ogni
+-- salvataggio, così la lista delle bozze non legge più le righe.
+--
+-- Le bozze esistenti restano in json_items e vengono convertite in righe
+-- alla prima apertura.
+-- ========================================
+
+ALTER TABLE movimenti_batch_draft
+    MODIFY COLUMN json_items JSON NULL,
+    ADD COLUMN num_righe INT NOT NULL DEFAULT 0 AFTER stato_destinazione,
+    ADD COLUMN quantita_totale INT NOT NULL DEFAULT 0 AFTER num_righe,
+    ADD COLUMN num_prodotti INT NOT NULL DEFAULT 0 AFTER quantita_totale;
+
+CREATE TABLE IF NOT EXISTS movimenti_batch_draft_righe (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    draft_id INT NOT NULL,
+    riga_key VARCHAR(64) NOT NULL,          -- identificativo della riga generato dal client
+    prodotto_id INT NOT NULL,
+    quantita INT NOT NULL DEFAULT 0,
+    dati TEXT NOT NULL,                     -- riga completa come inviata dal client (JSON)
+    UNIQUE KEY uq_draft_riga (draft_id, riga_key),
+    FOREIGN KEY (draft_id) REFERENCES movimenti_batch_draft(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Riepilogo delle bozze esistenti (quantità e prodotti vengono ricalcolati alla conversione)
+UPDATE movimenti_batch_draft
+SET num_righe = COALESCE(JSON_LENGTH(json_items), 0)
+WHERE json_items IS NOT NULL;
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- SHOW COLUMNS FROM movimenti_batch_draft LIKE 'num_%';
+-- SHOW CREATE TABLE movimenti_batch_draft_righe;
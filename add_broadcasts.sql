@@ -0,0 +1,96 @@
+-- ========================================
+-- MIGRAZIONE: Broadcast separati dalle notifiche soglia
+-- ========================================
+-- Un broadcast è una sola riga in broadcasts; la lettura da parte di un
+-- utente è una riga in broadcast_reads. Il feed delle notifiche unisce i
+-- broadcast non letti al momento della lettura, quindi inviare un
+-- broadcast costa una scrittura invece di una riga per utente.
+--
+-- Un utente vede i broadcast inviati dopo la creazione del suo account.
+-- I broadcast già presenti in notifications (codice_prodotto '[TIPO] titolo')
+-- vengono spostati nelle nuove tabelle mantenendo lo stato di lettura.
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name notifications > backup_notifications.sql
+-- ========================================
+
+-- STEP 1: Tabelle
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    titolo VARCHAR(255) NOT NULL,
+    messaggio TEXT NOT NULL,
+    tipo VARCHAR(20) NOT NULL DEFAULT 'info',
+    created_by INT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (created_by) REFERENCES utenti(id) ON DELETE SET NULL,
+    INDEX idx_broadcasts_data (created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS broadcast_reads (
+    user_id INT NOT NULL,
+    broadcast_id INT NOT NULL,
+    letto_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, broadcast_id),
+    FOREIGN KEY (user_id) REFERENCES utenti(id) ON DELETE CASCADE,
+    FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id) ON DELETE CASCADE,
+    INDEX idx_broadcast_reads_data (letto_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- STEP 2: Un broadcast per ogni invio (le righe dello stesso invio hanno
+-- stesso titolo, messaggio e tipo e sono state scritte nello stesso minuto)
+DROP TEMPORARY TABLE IF EXISTS broadcast_migrati;
+CREATE TEMPORARY TABLE broadcast_migrati AS
+SELECT codice_prodotto, nome_prodotto, magazzino,
+       DATE_FORMAT(data_notifica, '%Y-%m-%d %H:%i') AS minuto,
+       MIN(data_notifica) AS created_at,
+       CAST(NULL AS SIGNED) AS broadcast_id
+FROM notifications
+WHERE codice_prodotto LIKE '[%'
+GROUP BY codice_prodotto, nome_prodotto, magazzino, DATE_FORMAT(data_notifica, '%Y-%m-%d %H:%i');
+
+INSERT INTO broadcasts (titolo, messaggio, tipo, created_at)
+SELECT TRIM(SUBSTRING(codice_prodotto, LOCATE(']', codice_prodotto) + 1)),
+       nome_prodotto,
+       CASE WHEN magazzino IN ('info', 'success', 'warning', 'error') THEN magazzino ELSE 'info' END,
+       created_at
+FROM broadcast_migrati
+ORDER BY created_at;
+
+UPDATE broadcast_migrati bm
+JOIN broadcasts b
+  ON b.created_at = bm.created_at
+ AND b.messaggio = bm.nome_prodotto
+ AND b.titolo = TRIM(SUBSTRING(bm.codice_prodotto, LOCATE(']', bm.codice_prodotto) + 1))
+SET bm.broadcast_id = b.id;
+
+-- STEP 3: Ricevute di lettura per tutti gli utenti che non hanno la copia
+-- del broadcast ancora da leggere
+INSERT IGNORE INTO broadcast_reads (user_id, broadcast_id, letto_at)
+SELECT u.id, bm.broadcast_id, bm.created_at
+FROM broadcast_migrati bm
+CROSS JOIN utenti u
+WHERE bm.broadcast_id IS NOT NULL
+  AND NOT EXISTS (
+      SELECT 1 FROM notifications n
+      WHERE n.user_id = u.id
+        AND n.visualizzata = FALSE
+        AND n.codice_prodotto = bm.codice_prodotto
+        AND n.nome_prodotto = bm.nome_prodotto
+        AND DATE_FORMAT(n.data_notifica, '%Y-%m-%d %H:%i') = bm.minuto
+  );
+
+-- STEP 4: Rimuovi le copie per utente
+DELETE FROM notifications WHERE codice_prodotto LIKE '[%';
+
+DROP TEMPORARY TABLE broadcast_migrati;
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- Deve restituire 0:
+-- SELECT COUNT(*) FROM notifications WHERE codice_prodotto LIKE '[%';
+-- Broadcast non letti per utente:
+-- SELECT u.username, COUNT(b.id) FROM utenti u
+-- JOIN broadcasts b ON b.created_at >= u.created_at
+-- LEFT JOIN broadcast_reads r ON r.broadcast_id = b.id AND r.user_id = u.id
+-- WHERE r.broadcast_id IS NULL GROUP BY u.username;
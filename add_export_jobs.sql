@@ -0,0 +1,45 @@
+-- ========================================
+-- MIGRAZIONE: Coda dei job di esportazione
+-- ========================================
+-- Le esportazioni pesanti (XLSX del magazzino, CSV e PDF delle statistiche)
+-- vengono generate da un pool di thread fuori dalla richiesta
+-- (utils/jobs.py). Ogni job ha una riga in export_jobs, così stato e
+-- download funzionano da qualunque processo dell'applicazione:
+--   - id: token casuale usato negli URL di stato e download
+--   - chiave: hash di tipo + parametri + versione dei dati. È UNIQUE, quindi
+--     due richieste uguali condividono lo stesso job. Viene azzerata quando
+--     il job fallisce o scade, così la richiesta successiva crea un nuovo job
+--   - expires_at: dopo la scadenza (TTL) il file viene eliminato
+--   - processo, heartbeat_at: il processo che esegue il job aggiorna
+--     l'heartbeat; se si ferma (riavvio) il job viene segnato in errore
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name > backup_completo.sql
+-- ========================================
+
+CREATE TABLE IF NOT EXISTS export_jobs (
+    id CHAR(32) PRIMARY KEY,
+    chiave CHAR(64) NULL,
+    tipo VARCHAR(30) NOT NULL,
+    parametri TEXT NOT NULL,
+    user_id INT NOT NULL,
+    stato VARCHAR(20) NOT NULL DEFAULT 'IN_CODA',  -- IN_CODA, IN_CORSO, COMPLETATO, ERRORE
+    progresso TINYINT UNSIGNED NOT NULL DEFAULT 0,
+    file VARCHAR(255) NULL,
+    errore TEXT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    started_at DATETIME NULL,
+    finished_at DATETIME NULL,
+    expires_at DATETIME NULL,
+    processo CHAR(32) NULL,           -- processo dell'applicazione che esegue il job
+    heartbeat_at DATETIME NULL,       -- aggiornato dal processo finché il job è attivo
+    FOREIGN KEY (user_id) REFERENCES utenti(id) ON DELETE CASCADE,
+    UNIQUE KEY uq_export_job_chiave (chiave),
+    INDEX idx_export_jobs_scadenza (expires_at),
+    INDEX idx_export_jobs_stato (stato, heartbeat_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- SELECT stato, COUNT(*) FROM export_jobs GROUP BY stato;
@@ -0,0 +1,36 @@
+-- ========================================
+-- MIGRAZIONE: Feed delle modifiche alle giacenze (delta sync)
+-- ========================================
+-- Ogni INSERT/UPDATE/DELETE su giacenze scrive una riga in giacenze_changes
+-- tramite trigger, nella stessa transazione della modifica. `seq` è il
+-- cursore monotono usato da GET /api/giacenze/changes?since=<seq>: i client
+-- scaricano solo le giacenze cambiate invece dell'intera lista.
+--
+-- Lo stato corrente viene letto da giacenze al momento della richiesta:
+-- una giacenza presente nel feed ma non più in tabella è stata eliminata.
+-- ========================================
+
+CREATE TABLE IF NOT EXISTS giacenze_changes (
+    seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+    giacenza_id INT NOT NULL,
+    operazione CHAR(1) NOT NULL,  -- I = insert, U = update, D = delete
+    changed_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    INDEX idx_changed_at (changed_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+DROP TRIGGER IF EXISTS trg_giacenze_changes_insert;
+DROP TRIGGER IF EXISTS trg_giacenze_changes_update;
+DROP TRIGGER IF EXISTS trg_giacenze_changes_delete;
+
+CREATE TRIGGER trg_giacenze_changes_insert AFTER INSERT ON giacenze
+FOR EACH ROW INSERT INTO giacenze_changes (giacenza_id, operazione) VALUES (NEW.id, 'I');
+
+CREATE TRIGGER trg_giacenze_changes_update AFTER UPDATE ON giacenze
+FOR EACH ROW INSERT INTO giacenze_changes (giacenza_id, operazione) VALUES (NEW.id, 'U');
+
+CREATE TRIGGER trg_giacenze_changes_delete AFTER DELETE ON giacenze
+FOR EACH ROW INSERT INTO giacenze_changes (giacenza_id, operazione) VALUES (OLD.id, 'D');
+
+-- Pulizia periodica: i client con un cursore più vecchio del primo seq
+-- disponibile ricevono reset=true e ricaricano la lista completa.
+-- DELETE FROM giacenze_changes WHERE changed_at < NOW() - INTERVAL 7 DAY;
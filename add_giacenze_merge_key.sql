@@ -0,0 +1,64 @@
+-- ========================================
+-- MIGRAZIONE: Chiave naturale univoca su giacenze
+-- ========================================
+-- Una giacenza è identificata da:
+--   (prodotto_id, magazzino_id, ubicazione_norm, stato, note_hash)
+-- dove ubicazione_norm e note_hash sono colonne generate
+-- (NULL e stringa vuota sono equivalenti).
+--
+-- Lo script unisce le giacenze duplicate già presenti (sommando le
+-- quantità nella riga con id minore), poi aggiunge le colonne generate
+-- e l'indice UNIQUE usato da INSERT ... ON DUPLICATE KEY UPDATE.
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name giacenze > backup_giacenze.sql
+-- ========================================
+
+-- STEP 1: Normalizza gli stati in maiuscolo (es. 'in_magazzino' -> 'IN_MAGAZZINO')
+UPDATE giacenze SET stato = UPPER(stato) WHERE stato <> BINARY UPPER(stato);
+
+-- STEP 2: Individua i gruppi di giacenze duplicate
+DROP TEMPORARY TABLE IF EXISTS giacenze_merge;
+CREATE TEMPORARY TABLE giacenze_merge AS
+SELECT
+    MIN(id) AS keep_id,
+    prodotto_id,
+    magazzino_id,
+    COALESCE(ubicazione, '') AS ubicazione_norm,
+    stato,
+    MD5(COALESCE(note, '')) AS note_hash,
+    SUM(quantita) AS quantita_totale
+FROM giacenze
+GROUP BY prodotto_id, magazzino_id, COALESCE(ubicazione, ''), stato, MD5(COALESCE(note, ''))
+HAVING COUNT(*) > 1;
+
+-- STEP 3: Somma le quantità nella giacenza da mantenere
+UPDATE giacenze g
+JOIN giacenze_merge d ON g.id = d.keep_id
+SET g.quantita = d.quantita_totale;
+
+-- STEP 4: Elimina le giacenze duplicate
+DELETE g FROM giacenze g
+JOIN giacenze_merge d
+  ON g.prodotto_id = d.prodotto_id
+ AND g.magazzino_id <=> d.magazzino_id
+ AND COALESCE(g.ubicazione, '') = d.ubicazione_norm
+ AND g.stato <=> d.stato
+ AND MD5(COALESCE(g.note, '')) = d.note_hash
+ AND g.id <> d.keep_id;
+
+DROP TEMPORARY TABLE giacenze_merge;
+
+-- STEP 5: Colonne generate e indice UNIQUE sulla chiave naturale
+-- Nota: le righe con magazzino_id NULL non sono coperte dal vincolo
+-- (in MySQL i NULL sono sempre distinti in un indice UNIQUE).
+ALTER TABLE giacenze
+    ADD COLUMN ubicazione_norm VARCHAR(100) GENERATED ALWAYS AS (COALESCE(ubicazione, '')) STORED,
+    ADD COLUMN note_hash CHAR(32) GENERATED ALWAYS AS (MD5(COALESCE(note, ''))) STORED,
+    ADD UNIQUE KEY uq_giacenza_merge (prodotto_id, magazzino_id, ubicazione_norm, stato, note_hash);
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- SHOW CREATE TABLE giacenze;
+-- Dovresti vedere le colonne ubicazione_norm, note_hash e l'indice uq_giacenza_merge
@@ -0,0 +1,17 @@
+-- ========================================
+-- MIGRAZIONE: Versione per il controllo di concorrenza ottimistico
+-- ========================================
+-- Ogni scrittura su giacenze incrementa `version`. Le modifiche fatte
+-- dall'utente (modifica giacenza, modifica rapida mobile) vengono applicate
+-- solo se la versione letta dal client è ancora quella corrente:
+--   UPDATE giacenze SET ..., version = version + 1 WHERE id = %s AND version = %s
+-- In caso di conflitto l'app risponde 409 con la giacenza aggiornata.
+-- ========================================
+
+ALTER TABLE giacenze
+    ADD COLUMN version INT UNSIGNED NOT NULL DEFAULT 0 AFTER note;
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- SHOW COLUMNS FROM giacenze LIKE 'version';
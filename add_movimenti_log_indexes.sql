@@ -0,0 +1,34 @@
+-- ========================================
+-- MIGRAZIONE: Indici per il log movimenti paginato
+-- ========================================
+-- /api/logmovimenti legge movimenti e log_scarichi in ordine
+-- (data_ora, id) decrescente dal cursore dell'ultima riga vista, con i
+-- filtri applicati nel database. Ogni filtro ha un indice composto che
+-- termina con data_ora, così il database legge solo la pagina richiesta.
+-- L'indice su (data_ora) di entrambe le tabelle (idx_data) esiste già.
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name movimenti log_scarichi > backup_movimenti.sql
+-- ========================================
+
+-- STEP 1: movimenti
+ALTER TABLE movimenti
+    ADD INDEX idx_mov_utente_data (user_id, data_ora),
+    ADD INDEX idx_mov_prodotto_data (prodotto_id, data_ora),
+    ADD INDEX idx_mov_da_magazzino_data (da_magazzino_id, data_ora),
+    ADD INDEX idx_mov_a_magazzino_data (a_magazzino_id, data_ora),
+    ADD INDEX idx_mov_tipo_data (tipo_movimento, data_ora),
+    ADD FULLTEXT INDEX ft_mov_note (note);
+
+-- STEP 2: log_scarichi
+ALTER TABLE log_scarichi
+    ADD INDEX idx_ls_utente_data (user_id, data_ora),
+    ADD INDEX idx_ls_prodotto_data (prodotto_id, data_ora),
+    ADD FULLTEXT INDEX ft_ls_note (note);
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- Deve usare idx_mov_prodotto_data, senza "Using filesort" sulla tabella movimenti:
+-- EXPLAIN SELECT id FROM movimenti WHERE prodotto_id = 1
+-- ORDER BY data_ora DESC, id DESC LIMIT 101;
@@ -0,0 +1,42 @@
+-- ========================================
+-- MIGRAZIONE: Archivio notifiche e indice per il feed
+-- ========================================
+-- Il feed legge WHERE visualizzata = FALSE AND user_id = ? ORDER BY
+-- data_notifica DESC: l'indice (user_id, visualizzata, data_notifica) lo
+-- serve senza filesort. idx_visualizzata (solo TRUE/FALSE) non serve più.
+--
+-- Le notifiche lette vengono spostate in notifications_archive da
+-- `python -m utils.notification_archive` (a blocchi, vedi il modulo).
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name notifications > backup_notifications.sql
+-- ========================================
+
+-- STEP 1: Indice composto del feed
+ALTER TABLE notifications
+    ADD INDEX idx_notifiche_utente (user_id, visualizzata, data_notifica),
+    DROP INDEX idx_visualizzata;
+
+-- STEP 2: Tabella di archivio
+CREATE TABLE IF NOT EXISTS notifications_archive (
+    id INT PRIMARY KEY,
+    user_id INT NOT NULL,
+    codice_prodotto VARCHAR(50) NOT NULL,
+    nome_prodotto VARCHAR(255) NOT NULL,
+    quantita_attuale INT NOT NULL,
+    soglia_minima INT NOT NULL,
+    magazzino VARCHAR(100),
+    data_notifica DATETIME,
+    visualizzata BOOLEAN DEFAULT TRUE,
+    data_visualizzazione DATETIME NULL,
+    archiviata_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_archivio_utente (user_id, data_notifica),
+    INDEX idx_archivio_data (archiviata_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- Deve usare idx_notifiche_utente, senza "Using filesort":
+-- EXPLAIN SELECT id FROM notifications
+-- WHERE visualizzata = FALSE AND user_id = 1 ORDER BY data_notifica DESC;
@@ -0,0 +1,20 @@
+-- ========================================
+-- MIGRAZIONE: Indice sulla data di lettura delle notifiche
+-- ========================================
+-- /notifications risponde 304 Not Modified usando una versione per utente
+-- tenuta in memoria (utils/notification_bus.py). Per accorgersi delle
+-- notifiche segnate come lette da un altro processo il controllo periodico
+-- cerca le righe con data_visualizzazione recente: l'indice evita una
+-- scansione completa della tabella.
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name notifications > backup_notifications.sql
+-- ========================================
+
+ALTER TABLE notifications
+    ADD INDEX idx_data_visualizzazione (data_visualizzazione);
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- SHOW INDEX FROM notifications WHERE Key_name = 'idx_data_visualizzazione';
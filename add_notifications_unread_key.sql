@@ -0,0 +1,49 @@
+-- ========================================
+-- MIGRAZIONE: Una sola notifica non letta per utente e prodotto
+-- ========================================
+-- Il controllo soglie crea le notifiche con un unico INSERT ... SELECT
+-- (anti-join sulle notifiche non lette). L'indice UNIQUE sulla colonna
+-- generata codice_non_letto garantisce che anche due controlli concorrenti
+-- non creino la stessa notifica due volte.
+--
+-- codice_non_letto vale codice_prodotto solo per le notifiche soglia non
+-- ancora visualizzate; per quelle lette e per i broadcast ('[TIPO] titolo')
+-- è NULL, quindi non sono coperte dal vincolo.
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name notifications > backup_notifications.sql
+-- ========================================
+
+-- STEP 1: Individua le notifiche soglia non lette duplicate (si tiene la più recente)
+DROP TEMPORARY TABLE IF EXISTS notifiche_duplicate;
+CREATE TEMPORARY TABLE notifiche_duplicate AS
+SELECT user_id, codice_prodotto, MAX(id) AS keep_id
+FROM notifications
+WHERE visualizzata = FALSE AND codice_prodotto NOT LIKE '[%'
+GROUP BY user_id, codice_prodotto
+HAVING COUNT(*) > 1;
+
+-- STEP 2: Elimina i duplicati
+DELETE n FROM notifications n
+JOIN notifiche_duplicate d
+  ON n.user_id = d.user_id
+ AND n.codice_prodotto = d.codice_prodotto
+ AND n.id <> d.keep_id
+WHERE n.visualizzata = FALSE;
+
+DROP TEMPORARY TABLE notifiche_duplicate;
+
+-- STEP 3: Colonna generata e indice UNIQUE
+ALTER TABLE notifications
+    ADD COLUMN codice_non_letto VARCHAR(50) GENERATED ALWAYS AS (
+        CASE WHEN visualizzata = FALSE AND codice_prodotto NOT LIKE '[%' THEN codice_prodotto END
+    ) STORED,
+    ADD UNIQUE KEY uq_notifica_non_letta (user_id, codice_non_letto);
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- Deve restituire 0 righe:
+-- SELECT user_id, codice_prodotto, COUNT(*) FROM notifications
+-- WHERE visualizzata = FALSE AND codice_prodotto NOT LIKE '[%'
+-- GROUP BY user_id, codice_prodotto HAVING COUNT(*) > 1;
@@ -0,0 +1,36 @@
+-- ========================================
+-- MIGRAZIONE: Outbox transazionale per gli effetti collaterali delle scritture
+-- ========================================
+-- Ogni operazione che cambia le giacenze (carico, scarico, movimento,
+-- modifica, rientro, sincronizzazione offline, ...) scrive un evento in
+-- outbox_events NELLA STESSA TRANSAZIONE della modifica: se la transazione
+-- va in commit l'evento esiste, se va in rollback sparisce con lei.
+--
+-- Gli effetti collaterali (controllo soglie e notifiche) non vengono più
+-- eseguiti durante la richiesta: i consumer leggono gli eventi in ordine di
+-- id e salvano in outbox_consumers l'ultimo id elaborato (checkpoint).
+-- Un consumer interrotto riparte dal checkpoint: nessun evento viene perso.
+-- ========================================
+
+CREATE TABLE IF NOT EXISTS outbox_events (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    tipo_evento VARCHAR(30) NOT NULL,       -- CARICO, SCARICO, TRASFERIMENTO, MODIFICA, ELIMINAZIONE, SOGLIA
+    prodotto_id INT NULL,
+    quantita INT NULL,
+    user_id INT NULL,
+    payload TEXT NULL,                      -- JSON con i dettagli (ubicazioni, stati, quantità prima/dopo)
+    created_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    INDEX idx_created_at (created_at),
+    INDEX idx_prodotto (prodotto_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS outbox_consumers (
+    consumer VARCHAR(50) PRIMARY KEY,
+    ultimo_id BIGINT NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Pulizia periodica consigliata (eventi già confermati da tutti i consumer):
+-- DELETE FROM outbox_events
+-- WHERE id <= (SELECT MIN(ultimo_id) FROM outbox_consumers)
+--   AND created_at < NOW() - INTERVAL 7 DAY;
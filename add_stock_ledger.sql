@@ -0,0 +1,116 @@
+-- ========================================
+-- MIGRAZIONE: Registro unico dei movimenti di magazzino (stock_ledger)
+-- ========================================
+-- Gli scarichi di scaricomerce e scarico_merce_non_in_magazzino finivano in
+-- log_scarichi, tutto il resto in movimenti: il log movimenti doveva unire
+-- le due tabelle (UNION con COLLATE) e le statistiche, che leggono solo
+-- movimenti, non vedevano questi scarichi.
+--
+-- Dopo questa migrazione ogni movimento è una riga di stock_ledger:
+--   - append-only: UPDATE e DELETE sono rifiutati dai trigger
+--   - quantita resta positiva come prima, quantita_netta è la variazione
+--     con segno (+ CARICO, - SCARICO, 0 per trasferimenti e modifiche,
+--     di cui non è registrato il verso)
+--   - tipo_scarico valorizzato per gli scarichi che prima andavano in log_scarichi
+--
+-- Le vecchie tabelle vengono rinominate in *_legacy e sostituite da viste
+-- con lo stesso nome e le stesse colonne:
+--   - movimenti: tutte le righe del registro. È una vista aggiornabile, le
+--     INSERT INTO movimenti esistenti continuano a funzionare
+--   - log_scarichi: solo gli scarichi con tipo_scarico (sola lettura; gli
+--     scarichi si scrivono in stock_ledger con tipo_movimento = 'SCARICO')
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name movimenti log_scarichi > backup_movimenti.sql
+-- Eseguire con l'applicazione ferma: le righe scritte tra lo STEP 1 e lo
+-- STEP 5 andrebbero perse.
+-- ========================================
+
+-- STEP 1: Metti da parte le tabelle attuali
+RENAME TABLE movimenti TO movimenti_legacy, log_scarichi TO log_scarichi_legacy;
+
+-- STEP 2: Registro unico
+CREATE TABLE stock_ledger (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    data_ora DATETIME DEFAULT CURRENT_TIMESTAMP,
+    tipo_movimento VARCHAR(50) DEFAULT 'TRASFERIMENTO',
+    prodotto_id INT NOT NULL,
+    quantita INT NOT NULL,
+    quantita_netta INT GENERATED ALWAYS AS (
+        CASE tipo_movimento WHEN 'CARICO' THEN quantita WHEN 'SCARICO' THEN -quantita ELSE 0 END
+    ) STORED,
+    da_magazzino_id INT,
+    a_magazzino_id INT,
+    da_ubicazione VARCHAR(100),
+    a_ubicazione VARCHAR(100),
+    stato VARCHAR(50),
+    note TEXT,
+    tipo_scarico VARCHAR(50),
+    user_id INT,
+    FOREIGN KEY (prodotto_id) REFERENCES prodotti(id) ON DELETE CASCADE,
+    FOREIGN KEY (da_magazzino_id) REFERENCES magazzini(id) ON DELETE SET NULL,
+    FOREIGN KEY (a_magazzino_id) REFERENCES magazzini(id) ON DELETE SET NULL,
+    FOREIGN KEY (user_id) REFERENCES utenti(id) ON DELETE SET NULL,
+    -- Log movimenti: (data_ora, id) decrescente, anche per utente / prodotto
+    INDEX idx_ledger_data (data_ora),
+    INDEX idx_ledger_prodotto_data (prodotto_id, data_ora),
+    INDEX idx_ledger_utente_data (user_id, data_ora),
+    INDEX idx_ledger_da_magazzino_data (da_magazzino_id, data_ora),
+    INDEX idx_ledger_a_magazzino_data (a_magazzino_id, data_ora),
+    INDEX idx_ledger_tipo_data (tipo_movimento, data_ora),
+    -- Statistiche per periodo: tutte le colonne lette sono nell'indice
+    INDEX idx_ledger_statistiche (data_ora, tipo_movimento, quantita, prodotto_id, user_id),
+    FULLTEXT INDEX ft_ledger_note (note)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- STEP 3: Backfill. I movimenti mantengono il loro id, gli scarichi
+-- ricevono id successivi in ordine di data
+INSERT INTO stock_ledger (id, data_ora, tipo_movimento, prodotto_id, quantita, da_magazzino_id, a_magazzino_id,
+                          da_ubicazione, a_ubicazione, stato, note, user_id)
+SELECT id, data_ora, tipo_movimento, prodotto_id, quantita, da_magazzino_id, a_magazzino_id,
+       da_ubicazione, a_ubicazione, stato, note, user_id
+FROM movimenti_legacy
+ORDER BY id;
+
+INSERT INTO stock_ledger (data_ora, tipo_movimento, prodotto_id, quantita, note, tipo_scarico, user_id)
+SELECT data_ora, 'SCARICO', prodotto_id, quantita, note, tipo_scarico, user_id
+FROM log_scarichi_legacy
+ORDER BY data_ora, id;
+
+-- STEP 4: Append-only
+DROP TRIGGER IF EXISTS trg_stock_ledger_no_update;
+DROP TRIGGER IF EXISTS trg_stock_ledger_no_delete;
+
+CREATE TRIGGER trg_stock_ledger_no_update BEFORE UPDATE ON stock_ledger
+FOR EACH ROW SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'stock_ledger è append-only';
+
+CREATE TRIGGER trg_stock_ledger_no_delete BEFORE DELETE ON stock_ledger
+FOR EACH ROW SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'stock_ledger è append-only';
+
+-- STEP 5: Viste di compatibilità (MERGE: le query usano gli indici del registro)
+CREATE OR REPLACE ALGORITHM = MERGE VIEW movimenti AS
+SELECT id, prodotto_id, da_magazzino_id, a_magazzino_id, da_ubicazione, a_ubicazione,
+       quantita, note, data_ora, user_id, stato, tipo_movimento
+FROM stock_ledger;
+
+CREATE OR REPLACE ALGORITHM = MERGE VIEW log_scarichi AS
+SELECT id, data_ora, user_id, prodotto_id, quantita, note, tipo_scarico
+FROM stock_ledger
+WHERE tipo_scarico IS NOT NULL;
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- I conteggi devono coincidere:
+-- SELECT (SELECT COUNT(*) FROM movimenti_legacy) + (SELECT COUNT(*) FROM log_scarichi_legacy) AS prima,
+--        (SELECT COUNT(*) FROM stock_ledger) AS dopo;
+--
+-- Deve usare idx_ledger_statistiche ("Using index", nessuna lettura delle righe):
+-- EXPLAIN SELECT COUNT(*), SUM(CASE WHEN tipo_movimento = 'SCARICO' THEN quantita ELSE 0 END)
+-- FROM stock_ledger WHERE data_ora BETWEEN NOW() - INTERVAL 30 DAY AND NOW();
+--
+-- Deve fallire con 'stock_ledger è append-only':
+-- UPDATE stock_ledger SET quantita = quantita WHERE id = 1;
+--
+-- Dopo qualche giorno di verifica le tabelle legacy possono essere eliminate:
+-- DROP TABLE movimenti_legacy, log_scarichi_legacy;
@@ -0,0 +1,67 @@
+-- ========================================
+-- MIGRAZIONE: Partizioni mensili del registro movimenti
+-- ========================================
+-- Le statistiche filtrano stock_ledger per data_ora BETWEEN: con una
+-- partizione per mese (RANGE COLUMNS su data_ora) il database legge solo
+-- le partizioni del periodo, qualunque sia la quantità di storico.
+--
+-- Vincoli MySQL/MariaDB sulle tabelle partizionate:
+--   - la chiave primaria deve contenere data_ora: diventa (id, data_ora)
+--   - niente foreign key: prodotto, magazzini e utente restano come id
+--     (il registro è append-only, lo storico resta anche se il prodotto
+--     viene eliminato; le query usano già LEFT JOIN o JOIN sui nomi)
+--   - niente indice FULLTEXT: la ricerca nelle note del log usa LIKE
+--
+-- Richiede add_stock_ledger.sql. Dopo la migrazione eseguire subito
+--     python -m utils.ledger_archive crea
+-- che divide la partizione unica in mesi (dalla riga più vecchia fino a
+-- tre mesi avanti) e va poi pianificato ogni mese insieme a
+--     python -m utils.ledger_archive archivia
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name stock_ledger > backup_stock_ledger.sql
+-- La ricostruzione della tabella blocca le scritture: eseguire con
+-- l'applicazione ferma.
+-- ========================================
+
+-- STEP 1: Foreign key e FULLTEXT (nomi generati da add_stock_ledger.sql)
+ALTER TABLE stock_ledger
+    DROP FOREIGN KEY stock_ledger_ibfk_1,
+    DROP FOREIGN KEY stock_ledger_ibfk_2,
+    DROP FOREIGN KEY stock_ledger_ibfk_3,
+    DROP FOREIGN KEY stock_ledger_ibfk_4,
+    DROP INDEX ft_ledger_note;
+
+-- STEP 2: data_ora obbligatoria (entra nella chiave primaria).
+-- Il trigger append-only viene sospeso solo per questa correzione
+DROP TRIGGER IF EXISTS trg_stock_ledger_no_update;
+
+UPDATE stock_ledger SET data_ora = '1970-01-01 00:00:00' WHERE data_ora IS NULL;
+
+CREATE TRIGGER trg_stock_ledger_no_update BEFORE UPDATE ON stock_ledger
+FOR EACH ROW SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'stock_ledger è append-only';
+
+ALTER TABLE stock_ledger
+    MODIFY data_ora DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (id, data_ora);
+
+-- STEP 3: Partizionamento (una sola partizione, divisa in mesi da utils.ledger_archive).
+-- `python -m utils.ledger_archive crea` crea p_storico per le righe più vecchie
+-- dell'orizzonte e per quelle con la data segnaposto 1970-01-01, poi una
+-- partizione per mese
+ALTER TABLE stock_ledger
+PARTITION BY RANGE COLUMNS (data_ora) (
+    PARTITION pmax VALUES LESS THAN (MAXVALUE)
+);
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- Dopo `python -m utils.ledger_archive crea`, la colonna partitions deve
+-- elencare solo le partizioni degli ultimi 30 giorni:
+-- EXPLAIN SELECT COUNT(*) FROM stock_ledger
+-- WHERE data_ora BETWEEN NOW() - INTERVAL 30 DAY AND NOW();
+--
+-- SELECT PARTITION_NAME, TABLE_ROWS FROM information_schema.PARTITIONS
+-- WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'stock_ledger';
@@ -0,0 +1,25 @@
+-- ========================================
+-- MIGRAZIONE: Idempotenza della sincronizzazione offline
+-- ========================================
+-- Ogni operazione inviata dai palmari a POST /api/sync ha una chiave di
+-- idempotenza generata sul dispositivo. L'esito viene salvato qui nella
+-- stessa transazione dell'operazione: un reinvio della stessa chiave
+-- restituisce l'esito registrato senza ripetere l'operazione.
+-- ========================================
+
+CREATE TABLE IF NOT EXISTS sync_operations (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    idempotency_key VARCHAR(64) NOT NULL,
+    tipo VARCHAR(30),
+    stato VARCHAR(20) NOT NULL,
+    risultato TEXT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_sync_operation (user_id, idempotency_key),
+    INDEX idx_created_at (created_at),
+    FOREIGN KEY (user_id) REFERENCES utenti(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Pulizia periodica consigliata (le chiavi servono solo finché il
+-- dispositivo può reinviare l'operazione):
+-- DELETE FROM sync_operations WHERE created_at < NOW() - INTERVAL 30 DAY;
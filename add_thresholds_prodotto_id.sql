@@ -0,0 +1,59 @@
+-- ========================================
+-- MIGRAZIONE: Soglie collegate ai prodotti per id
+-- ========================================
+-- Le soglie erano collegate ai prodotti per codice, con join del tipo
+--   pt.codice_prodotto COLLATE utf8mb4_unicode_ci = p.codice_prodotto COLLATE utf8mb4_unicode_ci
+-- che impediscono l'uso degli indici su entrambi i lati. Ora product_thresholds
+-- ha prodotto_id con chiave esterna verso prodotti e tutte le join sono per id.
+-- codice_prodotto e nome_prodotto restano come copia informativa.
+--
+-- Le soglie il cui codice non corrisponde a nessun prodotto non hanno mai
+-- funzionato correttamente (prodotto eliminato o rinominato): lo STEP 3 le
+-- copia in product_thresholds_orfane e solo dopo le elimina, così restano
+-- consultabili (e ripristinabili) anche dopo la migrazione.
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name product_thresholds > backup_thresholds.sql
+-- ========================================
+
+-- STEP 1: Nuova colonna
+ALTER TABLE product_thresholds
+    ADD COLUMN prodotto_id INT NULL AFTER id;
+
+-- STEP 2: Risolvi i codici esistenti (conversione di collation solo lato soglie,
+-- così la ricerca usa l'indice UNIQUE di prodotti.codice_prodotto)
+UPDATE product_thresholds pt
+JOIN prodotti p ON p.codice_prodotto = pt.codice_prodotto COLLATE utf8mb4_unicode_ci
+SET pt.prodotto_id = p.id;
+
+-- STEP 3: Soglie senza prodotto corrispondente, copiate prima dell'eliminazione
+CREATE TABLE IF NOT EXISTS product_thresholds_orfane LIKE product_thresholds;
+
+INSERT IGNORE INTO product_thresholds_orfane
+SELECT * FROM product_thresholds
+WHERE prodotto_id IS NULL;
+
+DELETE FROM product_thresholds
+WHERE prodotto_id IS NULL
+  AND id IN (SELECT id FROM product_thresholds_orfane);
+
+-- STEP 4: Vincoli e indici
+ALTER TABLE product_thresholds
+    MODIFY COLUMN prodotto_id INT NOT NULL,
+    ADD CONSTRAINT fk_threshold_prodotto FOREIGN KEY (prodotto_id) REFERENCES prodotti(id) ON DELETE CASCADE,
+    ADD UNIQUE KEY unique_user_prodotto (user_id, prodotto_id),
+    ADD INDEX idx_threshold_prodotto (prodotto_id, notifica_attiva),
+    DROP INDEX unique_user_product;
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- L'accesso a product_thresholds deve usare idx_threshold_prodotto (type ref):
+-- EXPLAIN SELECT pt.user_id FROM product_thresholds pt
+-- JOIN prodotti p ON p.id = pt.prodotto_id WHERE pt.prodotto_id IN (1, 2);
+-- Controllo automatico: python test_indici_soglie.py
+--
+-- Soglie non migrate (da ricollegare a mano al prodotto corretto e reinserire):
+-- SELECT id, user_id, codice_prodotto, nome_prodotto FROM product_thresholds_orfane;
+-- Quando non servono più:
+-- DROP TABLE product_thresholds_orfane;
@@ -0,0 +1,65 @@
+-- ========================================
+-- MIGRAZIONE: Versione dei dati per la cache delle esportazioni
+-- ========================================
+-- Le esportazioni del magazzino (XLSX, TXT) e il CSV delle statistiche
+-- vengono salvati su disco e riusati finché i dati non cambiano
+-- (utils/export_cache.py). La versione dei dati è composta da:
+--   - l'ultimo seq di giacenze_changes (trigger su giacenze, richiede
+--     add_giacenze_changes.sql): cambia a ogni scrittura delle giacenze
+--   - il contatore 'anagrafica' di versioni_dati: cambia quando vengono
+--     modificati o eliminati prodotti e magazzini, o rinominati utenti
+--     (nomi e codici compaiono nelle esportazioni)
+-- prodotti, magazzini e utenti cambiano di rado: il contatore su una sola
+-- riga non rallenta le scritture delle giacenze.
+--
+-- IMPORTANTE: Fai backup prima di eseguire!
+-- mysqldump -u username -p database_name > backup_completo.sql
+-- ========================================
+
+-- STEP 1: Contatori
+CREATE TABLE IF NOT EXISTS versioni_dati (
+    nome VARCHAR(50) PRIMARY KEY,
+    versione BIGINT NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+INSERT IGNORE INTO versioni_dati (nome, versione) VALUES ('anagrafica', 0);
+
+-- STEP 2: Trigger su prodotti, magazzini e utenti
+DROP TRIGGER IF EXISTS trg_versione_prodotti_update;
+DROP TRIGGER IF EXISTS trg_versione_prodotti_delete;
+DROP TRIGGER IF EXISTS trg_versione_magazzini_update;
+DROP TRIGGER IF EXISTS trg_versione_magazzini_delete;
+DROP TRIGGER IF EXISTS trg_versione_utenti_update;
+DROP TRIGGER IF EXISTS trg_versione_utenti_delete;
+
+CREATE TRIGGER trg_versione_prodotti_update AFTER UPDATE ON prodotti
+FOR EACH ROW UPDATE versioni_dati SET versione = versione + 1 WHERE nome = 'anagrafica';
+
+-- L'eliminazione di un prodotto elimina le sue giacenze in cascata senza
+-- attivare i trigger di giacenze_changes
+CREATE TRIGGER trg_versione_prodotti_delete AFTER DELETE ON prodotti
+FOR EACH ROW UPDATE versioni_dati SET versione = versione + 1 WHERE nome = 'anagrafica';
+
+CREATE TRIGGER trg_versione_magazzini_update AFTER UPDATE ON magazzini
+FOR EACH ROW UPDATE versioni_dati SET versione = versione + 1 WHERE nome = 'anagrafica';
+
+CREATE TRIGGER trg_versione_magazzini_delete AFTER DELETE ON magazzini
+FOR EACH ROW UPDATE versioni_dati SET versione = versione + 1 WHERE nome = 'anagrafica';
+
+-- Solo il cambio di username (gli altri aggiornamenti degli utenti non
+-- toccano le esportazioni)
+CREATE TRIGGER trg_versione_utenti_update AFTER UPDATE ON utenti
+FOR EACH ROW UPDATE versioni_dati SET versione = versione + 1
+WHERE nome = 'anagrafica' AND NOT (NEW.username <=> OLD.username);
+
+CREATE TRIGGER trg_versione_utenti_delete AFTER DELETE ON utenti
+FOR EACH ROW UPDATE versioni_dati SET versione = versione + 1 WHERE nome = 'anagrafica';
+
+-- ========================================
+-- VERIFICA FINALE
+-- ========================================
+-- Il contatore deve aumentare dopo la modifica di un prodotto:
+-- SELECT versione FROM versioni_dati WHERE nome = 'anagrafica';
+-- UPDATE prodotti SET nome_prodotto = nome_prodotto WHERE id = 1;
+-- SELECT versione FROM versioni_dati WHERE nome = 'anagrafica';
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response
 from flask_compress import Compress
 import mysql.connector
 from mysql.connector import Error
@@ -7,11 +7,33 @@ import json
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import send_file, make_response
 from datetime import datetime
-import io
-import tempfile
 import os
-import xlsxwriter
 from magazzino_reconciliation import process_uploaded_files, get_webapp_api_response
+from utils.delta_sync import cursore_corrente, leggi_modifiche, LIMITE_DEFAULT as LIMITE_DELTA_DEFAULT
+from utils.giacenze import (
+    upsert_giacenza, aggiorna_o_unisci_giacenza, aggiorna_quantita_giacenza, carica_giacenza
+)
+from utils.movimento_multiplo import normalizza_movimenti, carica_giacenze_coinvolte, pianifica_movimenti, applica_piano
+from utils.carico_bulk import leggi_bolla, prepara_carico, applica_carico, BollaNonValida
+from utils.sync import applica_operazioni, MAX_OPERAZIONI as MAX_OPERAZIONI_SYNC
+from utils.outbox import registra_evento, registra_eventi
+from utils.export_magazzino import genera_txt as genera_txt_magazzino, scrivi_xlsx as scrivi_xlsx_magazzino
+from utils.export_arrow import (
+    FORMATI as FORMATI_COLONNARI, disponibile as export_colonnare_disponibile, genera_giacenze as genera_giacenze_colonnare,
+)
+from utils import export_cache
+from utils.bozze import crea_bozza, applica_patch, carica_righe, BozzaNonValida
+from utils.log_movimenti import (
+    normalizza_filtri as normalizza_filtri_log, leggi_pagina as leggi_pagina_log,
+    FiltroNonValido as FiltroLogNonValido, LIMITE_DEFAULT as LIMITE_LOG_DEFAULT
+)
+from utils.notification_worker import avvia_worker as avvia_worker_notifiche, sveglia as sveglia_worker_notifiche
+from utils.notifications import (
+    notifiche_non_lette, crea_broadcast, segna_broadcast_letto, segna_broadcast_letti,
+    broadcast_recenti, conta_broadcast_oggi
+)
+from utils import notification_bus
+from utils.transactions import esegui_transazione, blocca_giacenze, AnnullaTransazione, TransazioneContesa
 import logging
 
 # ========================================
@@ -21,6 +43,7 @@ import logging
 from routes.auth import auth_bp
 from routes.admin import admin_bp
 from routes.statistics import stats_bp
+from routes.jobs import jobs_bp
 
 # Filtro per escludere le richieste di polling dalle log
 class NotificationLogFilter(logging.Filter):
@@ -36,6 +59,8 @@ class NotificationLogFilter(logging.Filter):
 werkzeug_logger = logging.getLogger('werkzeug')
 werkzeug_logger.addFilter(NotificationLogFilter())
 
+logger = logging.getLogger(__name__)
+
 
 app = Flask(__name__)
 
@@ -66,6 +91,16 @@ except ImportError:
 app.register_blueprint(auth_bp)                    # /login, /logout, /register
 app.register_blueprint(admin_bp, url_prefix='/admin')  # /admin/*
 app.register_blueprint(stats_bp)                   # /statistiche, /api/statistiche/*
+app.register_blueprint(jobs_bp)                    # /api/jobs/*
+
+# Worker in background per soglie e notifiche (NOTIFICHE_WORKER=off se gira
+# come processo separato: python -m utils.notification_worker).
+# Avviato alla prima richiesta servita, non all'import: script e CLI che
+# importano app (anche indirettamente da database_connection) e il processo
+# padre del reloader non devono avviare un secondo consumer dell'outbox.
+@app.before_request
+def avvia_worker_alla_prima_richiesta():
+    avvia_worker_notifiche()
 
 # ========================================
 # APP VERSION
@@ -299,9 +334,13 @@ def index():
         conn = connect_to_database()
         cursor = conn.cursor(dictionary=True)
 
+        # Cursore del feed modifiche letto prima della lista: il client
+        # applicherà i delta successivi (vedi /api/giacenze/changes)
+        giacenze_cursor = cursore_corrente(cursor)
+
         # Query per giacenze con filtri, including latest movement note
         query = """
-            SELECT g.id, p.codice_prodotto, p.nome_prodotto, m.nome AS magazzino, g.ubicazione, g.stato, g.quantita, g.note,
+            SELECT g.id, p.codice_prodotto, p.nome_prodotto, m.nome AS magazzino, g.ubicazione, g.stato, g.quantita, g.note, g.version,
                    (SELECT note FROM movimenti mv WHERE mv.prodotto_id = g.prodotto_id ORDER BY mv.data_ora DESC LIMIT 1) AS latest_movement_note
             FROM giacenze g
             JOIN prodotti p ON g.prodotto_id = p.id
@@ -362,7 +401,7 @@ def index():
         cursor.execute("SELECT COUNT(*) AS warehouses_count FROM magazzini")
         warehouses_count = cursor.fetchone()['warehouses_count']
 
-        cursor.execute("SELECT COUNT(*) AS movements_today FROM movimenti WHERE DATE(data_ora) = CURDATE()")
+        cursor.execute("SELECT COUNT(*) AS movements_today FROM movimenti WHERE data_ora >= CURDATE() AND data_ora < CURDATE() + INTERVAL 1 DAY")
         movements_today = cursor.fetchone()['movements_today']
 
         # Query per lista prodotti (per modal prodotti)
@@ -377,6 +416,7 @@ def index():
         prodotti = cursor.fetchall()
     except Error as e:
         giacenze = []
+        giacenze_cursor = 0
         magazzini_opzioni = []
         stati_opzioni = []
         ubicazioni_opzioni = []
@@ -393,6 +433,7 @@ def index():
             conn.close()
 
     return render_template("index.html", giacenze=giacenze,
+                           giacenze_cursor=giacenze_cursor,
                            filtro_codice=filtro_codice,
                            filtro_nome=filtro_nome,
                            filtro_magazzino=filtro_magazzino,
@@ -466,7 +507,6 @@ def movimento():
                     prodotto_id, da_magazzino_id, a_magazzino_id, da_ubicazione, a_ubicazione, quantita, note, user_id, stato, tipo_movimento
                 ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             """, (prodotto_id, da_magazzino_id, a_magazzino_id, da_ubicazione, a_ubicazione, quantita, note, user_id, a_stato, tipo_mov))
-            conn.commit()
 
             # Aggiorna giacenza di partenza
             if da_stato:
@@ -492,45 +532,25 @@ def movimento():
                     if nuova_quantita <= 0:
                         cursor.execute("DELETE FROM giacenze WHERE id = %s", (da_giacenza["id"],))
                     else:
-                        cursor.execute("UPDATE giacenze SET quantita = %s WHERE id = %s",
+                        cursor.execute("UPDATE giacenze SET quantita = %s, version = version + 1 WHERE id = %s",
                                        (nuova_quantita, da_giacenza["id"]))
-                    conn.commit()
                     giacenza_updated = True
 
-            # Aggiorna giacenza di destinazione
+            # Aggiorna giacenza di destinazione (upsert sulla chiave naturale:
+            # stesso magazzino, ubicazione, stato e nota => quantità sommata)
             if a_stato:
-                query = """
-                    SELECT * FROM giacenze WHERE prodotto_id = %s AND stato = %s
-                """
-                params = [prodotto_id, a_stato]
-                if a_magazzino_id:
-                    query += " AND magazzino_id = %s"
-                    params.append(a_magazzino_id)
-                else:
-                    query += " AND magazzino_id IS NULL"
-                if a_ubicazione:
-                    query += " AND ubicazione = %s"
-                    params.append(a_ubicazione)
-                else:
-                    query += " AND (ubicazione IS NULL OR ubicazione = '')"
-                # Cerca anche per nota identica
-                query_note = query + " AND (note = %s OR (note IS NULL AND %s IS NULL))"
-                params_note = params + [note, note]
-                cursor.execute(query_note, params_note)
-                a_giacenza = cursor.fetchone()
-
-                if a_giacenza:
-                    nuova_quantita = a_giacenza["quantita"] + quantita
-                    cursor.execute("UPDATE giacenze SET quantita = %s WHERE id = %s",
-                                   (nuova_quantita, a_giacenza["id"]))
-                else:
-                    cursor.execute("""
-                        INSERT INTO giacenze (prodotto_id, magazzino_id, ubicazione, stato, quantita, note)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, (prodotto_id, a_magazzino_id, a_ubicazione, a_stato, quantita, note))
-                conn.commit()
+                upsert_giacenza(cursor, prodotto_id, a_magazzino_id, a_ubicazione, a_stato, quantita, note)
                 giacenza_updated = True
 
+            # Movimento, giacenze ed evento outbox in un'unica transazione
+            registra_evento(cursor, tipo_mov, prodotto_id, quantita, user_id, {
+                'da_stato': da_stato, 'a_stato': a_stato,
+                'da_ubicazione': da_ubicazione, 'a_ubicazione': a_ubicazione,
+                'da_magazzino_id': da_magazzino_id, 'a_magazzino_id': a_magazzino_id,
+            })
+            conn.commit()
+            sveglia_worker_notifiche()
+
             if giacenza_updated:
                 flash("Movimento e giacenza aggiornati con successo.", "success")
             else:
@@ -626,9 +646,14 @@ def nuovo_prodotto():
                 VALUES (%s, %s, %s, %s, %s)
             """, (prodotto_id, magazzino_id, ubicazione, stato, quantita_int))
 
+            registra_evento(cursor, 'CARICO', prodotto_id, quantita_int, session.get('user_id'), {
+                'a_stato': stato, 'a_ubicazione': ubicazione, 'a_magazzino_id': magazzino_id,
+                'nuovo_prodotto': True,
+            })
             conn.commit()
             cursor.close()
             conn.close()
+            sveglia_worker_notifiche()
             flash('Prodotto e giacenza registrati con successo.', 'success')
             return redirect(url_for('index'))
         except mysql.connector.IntegrityError as ie:
@@ -673,7 +698,7 @@ def api_giacenze_prodotto(prodotto_id):
         conn = connect_to_database()
         cursor = conn.cursor(dictionary=True)
         cursor.execute("""
-            SELECT g.id, g.quantita, g.stato, g.ubicazione, g.note, m.nome as magazzino_nome
+            SELECT g.id, g.quantita, g.stato, g.ubicazione, g.note, g.version, m.nome as magazzino_nome
             FROM giacenze g
             LEFT JOIN magazzini m ON g.magazzino_id = m.id
             WHERE g.prodotto_id = %s
@@ -687,6 +712,29 @@ def api_giacenze_prodotto(prodotto_id):
         return jsonify({'error': str(e)}), 500
 
 
+# API delta sync: giacenze inserite, modificate o eliminate dopo un cursore
+@app.route('/api/giacenze/changes', methods=['GET'])
+def api_giacenze_changes():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Non autorizzato'}), 401
+    
+    try:
+        since = int(request.args.get('since', 0))
+        limite = int(request.args.get('limit', LIMITE_DELTA_DEFAULT))
+    except ValueError:
+        return jsonify({'error': 'Parametri non validi'}), 400
+    
+    try:
+        conn = connect_to_database()
+        cursor = conn.cursor(dictionary=True)
+        delta = leggi_modifiche(cursor, since, limite)
+        cursor.close()
+        conn.close()
+        return jsonify(delta)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 # API per ottenere i dettagli di un prodotto
 @app.route('/api/prodotto/<int:prodotto_id>', methods=['GET'])
 def api_get_prodotto(prodotto_id):
@@ -762,9 +810,11 @@ def api_elimina_prodotto(prodotto_id):
         # Poi elimina il prodotto
         cursor.execute("DELETE FROM prodotti WHERE id = %s", (prodotto_id,))
         
+        registra_evento(cursor, 'ELIMINAZIONE', prodotto_id, None, session.get('user_id'), {'prodotto_eliminato': True})
         conn.commit()
         cursor.close()
         conn.close()
+        sveglia_worker_notifiche()
         
         return jsonify({'success': True, 'message': 'Prodotto e giacenze eliminate con successo'})
     except Exception as e:
@@ -802,17 +852,17 @@ def api_soglie_data():
         cursor.execute("""
             SELECT 
                 pt.id,
-                pt.codice_prodotto,
-                pt.nome_prodotto,
+                p.codice_prodotto,
+                p.nome_prodotto,
                 pt.soglia_minima,
                 pt.notifica_attiva,
                 COALESCE(SUM(g.quantita), 0) as quantita_attuale
             FROM product_thresholds pt
-            LEFT JOIN prodotti p ON pt.codice_prodotto COLLATE utf8mb4_unicode_ci = p.codice_prodotto COLLATE utf8mb4_unicode_ci
+            JOIN prodotti p ON p.id = pt.prodotto_id
             LEFT JOIN giacenze g ON p.id = g.prodotto_id
             WHERE pt.user_id = %s
-            GROUP BY pt.id, pt.codice_prodotto, pt.nome_prodotto, pt.soglia_minima, pt.notifica_attiva
-            ORDER BY pt.nome_prodotto
+            GROUP BY pt.id, p.codice_prodotto, p.nome_prodotto, pt.soglia_minima, pt.notifica_attiva
+            ORDER BY p.nome_prodotto
         """, (session['user_id'],))
         soglie = cursor.fetchall()
         
@@ -846,17 +896,17 @@ def gestione_soglie():
         cursor.execute("""
             SELECT 
                 pt.id,
-                pt.codice_prodotto,
-                pt.nome_prodotto,
+                p.codice_prodotto,
+                p.nome_prodotto,
                 pt.soglia_minima,
                 pt.notifica_attiva,
                 COALESCE(SUM(g.quantita), 0) as quantita_attuale
             FROM product_thresholds pt
-            LEFT JOIN prodotti p ON pt.codice_prodotto COLLATE utf8mb4_unicode_ci = p.codice_prodotto COLLATE utf8mb4_unicode_ci
+            JOIN prodotti p ON p.id = pt.prodotto_id
             LEFT JOIN giacenze g ON p.id = g.prodotto_id
             WHERE pt.user_id = %s
-            GROUP BY pt.id, pt.codice_prodotto, pt.nome_prodotto, pt.soglia_minima, pt.notifica_attiva
-            ORDER BY pt.nome_prodotto
+            GROUP BY pt.id, p.codice_prodotto, p.nome_prodotto, pt.soglia_minima, pt.notifica_attiva
+            ORDER BY p.nome_prodotto
         """, (session['user_id'],))
         soglie = cursor.fetchall()
         
@@ -888,7 +938,7 @@ def add_threshold():
         cursor = conn.cursor(dictionary=True)
         
         # Recupera il nome del prodotto
-        cursor.execute("SELECT nome_prodotto FROM prodotti WHERE codice_prodotto = %s", (codice_prodotto,))
+        cursor.execute("SELECT id, nome_prodotto FROM prodotti WHERE codice_prodotto = %s", (codice_prodotto,))
         prodotto = cursor.fetchone()
         
         if not prodotto:
@@ -897,9 +947,11 @@ def add_threshold():
         
         # Inserisci la soglia con user_id
         cursor.execute("""
-            INSERT INTO product_thresholds (user_id, codice_prodotto, nome_prodotto, soglia_minima, notifica_attiva)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (session['user_id'], codice_prodotto, prodotto['nome_prodotto'], soglia_minima, notifica_attiva))
+            INSERT INTO product_thresholds (user_id, prodotto_id, codice_prodotto, nome_prodotto, soglia_minima, notifica_attiva)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (session['user_id'], prodotto['id'], codice_prodotto, prodotto['nome_prodotto'], soglia_minima, notifica_attiva))
+        registra_evento(cursor, 'SOGLIA', prodotto['id'], None, session['user_id'],
+                        {'codice_prodotto': codice_prodotto, 'soglia_minima': soglia_minima})
         
         conn.commit()
         cursor.close()
@@ -907,8 +959,8 @@ def add_threshold():
         
         flash('Soglia aggiunta con successo!', 'success')
         
-        # Controlla immediatamente se va generata una notifica
-        check_and_create_notifications()
+        # Il controllo della notifica avviene nel worker in background
+        sveglia_worker_notifiche()
         
     except mysql.connector.IntegrityError:
         flash('Esiste già una soglia per questo prodotto.', 'error')
@@ -934,7 +986,7 @@ def update_threshold():
     
     try:
         conn = connect_to_database()
-        cursor = conn.cursor()
+        cursor = conn.cursor(dictionary=True)
         
         cursor.execute("""
             UPDATE product_thresholds 
@@ -942,14 +994,24 @@ def update_threshold():
             WHERE id = %s AND user_id = %s
         """, (soglia_minima, notifica_attiva, threshold_id, session['user_id']))
         
+        cursor.execute("""
+            SELECT prodotto_id AS id, codice_prodotto
+            FROM product_thresholds
+            WHERE id = %s AND user_id = %s
+        """, (threshold_id, session['user_id']))
+        soglia = cursor.fetchone()
+        if soglia:
+            registra_evento(cursor, 'SOGLIA', soglia['id'], None, session['user_id'],
+                            {'codice_prodotto': soglia['codice_prodotto'], 'soglia_minima': soglia_minima})
+        
         conn.commit()
         cursor.close()
         conn.close()
         
         flash('Soglia aggiornata con successo!', 'success')
         
-        # Controlla se va generata una notifica
-        check_and_create_notifications()
+        # Il controllo della notifica avviene nel worker in background
+        sveglia_worker_notifiche()
         
     except Exception as e:
         flash(f'Errore durante l\'aggiornamento: {e}', 'error')
@@ -1011,66 +1073,37 @@ def delete_threshold():
     return redirect(request.referrer or url_for('index'))
 
 
-def check_and_create_notifications():
-    """
-    Funzione che controlla tutte le soglie attive e crea notifiche
-    per i prodotti che sono sotto la soglia minima (per ogni utente)
-    """
+# Canale push delle notifiche: SSE con fallback a long-polling.
+# Le connessioni restano in attesa sul bus in-process (nessuna query finché
+# le notifiche dell'utente non cambiano); dopo DURATA_STREAM secondi lo
+# stream si chiude e il browser si riconnette, così un worker non resta
+# occupato per sempre dalla stessa scheda.
+DURATA_STREAM = 300         # secondi
+HEARTBEAT_STREAM = 20       # secondi, tiene aperti proxy e load balancer
+ATTESA_LONG_POLL = 25       # secondi
+RICONNESSIONE_STREAM_MS = 3000
+# Le versioni del bus sono per processo: il token le distingue dopo un
+# riavvio o su un altro worker, così un client non salta mai un aggiornamento
+TOKEN_PROCESSO = os.urandom(4).hex()
+
+
+def _versione_notifiche(user_id):
+    return f'{TOKEN_PROCESSO}:{notification_bus.versione_aggiornata(user_id)}'
+
+
+def _feed_notifiche(user_id, versione):
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
     try:
-        conn = connect_to_database()
-        cursor = conn.cursor(dictionary=True)
-        
-        # Trova tutti i prodotti sotto soglia per ogni utente
-        cursor.execute("""
-            SELECT 
-                pt.user_id,
-                pt.codice_prodotto,
-                pt.nome_prodotto,
-                pt.soglia_minima,
-                COALESCE(SUM(g.quantita), 0) as quantita_attuale,
-                m.nome as magazzino
-            FROM product_thresholds pt
-            LEFT JOIN prodotti p ON pt.codice_prodotto COLLATE utf8mb4_unicode_ci = p.codice_prodotto COLLATE utf8mb4_unicode_ci
-            LEFT JOIN giacenze g ON p.id = g.prodotto_id
-            LEFT JOIN magazzini m ON g.magazzino_id = m.id
-            WHERE pt.notifica_attiva = TRUE
-            GROUP BY pt.user_id, pt.codice_prodotto, pt.nome_prodotto, pt.soglia_minima, m.nome
-            HAVING quantita_attuale <= pt.soglia_minima
-        """)
-        
-        prodotti_sotto_soglia = cursor.fetchall()
-        
-        for prodotto in prodotti_sotto_soglia:
-            # Controlla se esiste già una notifica non visualizzata per questo prodotto e utente
-            cursor.execute("""
-                SELECT id FROM notifications 
-                WHERE codice_prodotto = %s AND user_id = %s AND visualizzata = FALSE
-                LIMIT 1
-            """, (prodotto['codice_prodotto'], prodotto['user_id']))
-            
-            existing = cursor.fetchone()
-            
-            if not existing:
-                # Crea nuova notifica per questo utente specifico
-                cursor.execute("""
-                    INSERT INTO notifications 
-                    (user_id, codice_prodotto, nome_prodotto, quantita_attuale, soglia_minima, magazzino)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (
-                    prodotto['user_id'],
-                    prodotto['codice_prodotto'],
-                    prodotto['nome_prodotto'],
-                    prodotto['quantita_attuale'],
-                    prodotto['soglia_minima'],
-                    prodotto.get('magazzino', 'N/A')
-                ))
-        
-        conn.commit()
+        notifiche = notifiche_non_lette(cursor, user_id)
+    finally:
         cursor.close()
         conn.close()
-        
-    except Exception as e:
-        print(f"Errore nel controllo soglie: {e}")
+    return {
+        'count': len(notifiche),
+        'notifications': notifiche,
+        'version': versione
+    }
 
 
 @app.route('/notifications')
@@ -1079,39 +1112,72 @@ def notifications():
         return jsonify({'error': 'Non autorizzato'}), 401
     
     try:
-        conn = connect_to_database()
-        cursor = conn.cursor(dictionary=True)
-        
-        # Recupera notifiche non visualizzate per l'utente corrente
-        cursor.execute("""
-            SELECT 
-                id,
-                codice_prodotto,
-                nome_prodotto,
-                quantita_attuale,
-                soglia_minima,
-                magazzino,
-                data_notifica
-            FROM notifications
-            WHERE visualizzata = FALSE AND user_id = %s
-            ORDER BY data_notifica DESC
-        """, (session['user_id'],))
-        
-        notifiche = cursor.fetchall()
-        
-        # Converti datetime in stringa per JSON
-        for n in notifiche:
-            if n.get('data_notifica'):
-                n['data_notifica'] = n['data_notifica'].strftime('%Y-%m-%d %H:%M:%S')
-        
-        cursor.close()
-        conn.close()
-        
-        return jsonify({
-            'count': len(notifiche),
-            'notifications': notifiche
-        })
-        
+        # Versione letta prima della query: una modifica concorrente non va persa
+        versione = _versione_notifiche(session['user_id'])
+        # Nessun cambiamento dall'ultima risposta: 304 senza connessione al database
+        if request.if_none_match.contains(versione):
+            response = make_response('', 304)
+        else:
+            response = jsonify(_feed_notifiche(session['user_id'], versione))
+        response.set_etag(versione)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/notifications/stream')
+def notifications_stream():
+    """Server-Sent Events: invia il feed alla connessione e a ogni cambio di versione."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Non autorizzato'}), 401
+    
+    user_id = session['user_id']
+    ultima_versione = request.headers.get('Last-Event-ID')
+
+    def genera():
+        versione_inviata = ultima_versione
+        yield f'retry: {RICONNESSIONE_STREAM_MS}\n\n'
+        scadenza = time.monotonic() + DURATA_STREAM
+        try:
+            while time.monotonic() < scadenza:
+                versione = _versione_notifiche(user_id)
+                if versione == versione_inviata:
+                    numero = int(versione.split(':')[1])
+                    attesa = min(HEARTBEAT_STREAM, max(scadenza - time.monotonic(), 0))
+                    if notification_bus.attendi(user_id, numero, attesa) == numero:
+                        yield ': keepalive\n\n'
+                    continue
+                feed = _feed_notifiche(user_id, versione)
+                versione_inviata = versione
+                yield f'id: {versione}\nevent: notifiche\ndata: {json.dumps(feed, default=str)}\n\n'
+        except Exception:
+            logger.exception('Errore nello stream notifiche (utente %s)', user_id)
+
+    response = Response(genera(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx: non bufferizzare lo stream
+    return response
+
+
+@app.route('/notifications/poll')
+def notifications_poll():
+    """
+    Long-polling per i browser senza EventSource: con ?v=<versione> attende
+    fino a ATTESA_LONG_POLL secondi un cambiamento; 204 se non è cambiato nulla.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Non autorizzato'}), 401
+    
+    user_id = session['user_id']
+    try:
+        versione = _versione_notifiche(user_id)
+        if request.args.get('v') == versione:
+            numero = int(versione.split(':')[1])
+            if notification_bus.attendi(user_id, numero, ATTESA_LONG_POLL) == numero:
+                return '', 204
+            versione = _versione_notifiche(user_id)
+        return jsonify(_feed_notifiche(user_id, versione))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1134,6 +1200,26 @@ def mark_notification_read(notification_id):
         conn.commit()
         cursor.close()
         conn.close()
+        notification_bus.pubblica([session['user_id']])
+        
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/mark_broadcast_read/<int:broadcast_id>', methods=['POST'])
+def mark_broadcast_read(broadcast_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Non autorizzato'}), 401
+    
+    try:
+        conn = connect_to_database()
+        cursor = conn.cursor()
+        segna_broadcast_letto(cursor, session['user_id'], broadcast_id)
+        conn.commit()
+        cursor.close()
+        conn.close()
+        notification_bus.pubblica([session['user_id']])
         
         return jsonify({'success': True})
     except Exception as e:
@@ -1154,10 +1240,12 @@ def mark_all_notifications_read():
             SET visualizzata = TRUE, data_visualizzazione = NOW()
             WHERE visualizzata = FALSE AND user_id = %s
         """, (session['user_id'],))
+        segna_broadcast_letti(cursor, session['user_id'])
         
         conn.commit()
         cursor.close()
         conn.close()
+        notification_bus.pubblica([session['user_id']])
         
         return jsonify({'success': True})
     except Exception as e:
@@ -1166,132 +1254,31 @@ def mark_all_notifications_read():
 
 @app.route('/esporta_magazzino')
 def esporta_magazzino():
-    # Recupera tutte le giacenze dal database
-    giacenze = get_all_giacenze()
-    now = datetime.now().strftime("%d/%m/%Y %H:%M")
-    output = io.StringIO()
-    output.write("PHARMAGEST - ESPORTAZIONE MAGAZZINO\n")
-    output.write(f"Data esportazione: {now}\n\n")
-
-    # Definisci larghezza colonne
-    widths = {
-        "codice": 14,
-        "prodotto": 32,
-        "magazzino": 20,
-        "ubicazione": 18,
-        "stato": 13,
-        "quantita": 9,
-        "note": 30
-    }
-
-    # Intestazione
-    header = (
-        f"{'Codice':<{widths['codice']}}"
-        f"{'Prodotto':<{widths['prodotto']}}"
-        f"{'Magazzino':<{widths['magazzino']}}"
-        f"{'Ubicazione':<{widths['ubicazione']}}"
-        f"{'Stato':<{widths['stato']}}"
-        f"{'Quantità':>{widths['quantita']}}  "
-        f"{'Note'}"
-    )
-    output.write(header + "\n")
-    output.write("-" * (sum(widths.values()) + 14) + "\n")
-
-    for g in giacenze:
-        output.write(
-            f"{str(g['codice_prodotto'])[:widths['codice']-1]:<{widths['codice']}}"
-            f"{str(g['nome_prodotto'])[:widths['prodotto']-1]:<{widths['prodotto']}}"
-            f"{str(g['magazzino'] or '')[:widths['magazzino']-1]:<{widths['magazzino']}}"
-            f"{str(g['ubicazione'] or '')[:widths['ubicazione']-1]:<{widths['ubicazione']}}"
-            f"{str(g['stato'] or '')[:widths['stato']-1]:<{widths['stato']}}"
-            f"{str(g['quantita']):>{widths['quantita']}}  "
-            f"{str(g['note'] or '')}\n"
-        )
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = f"attachment; filename=magazzino_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-    response.headers["Content-Type"] = "text/plain; charset=utf-8"
-    return response
+    # TXT a colonne fisse generato a blocchi durante l'invio (e salvato in cache)
+    filename = f"magazzino_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    return export_cache.invia_streaming(genera_txt_magazzino, 'magazzino_txt', 'txt', filename,
+                                        'text/plain; charset=utf-8')
 
 @app.route('/esporta_magazzino_xlsx')
 def esporta_magazzino_xlsx():
-    giacenze = get_all_giacenze()
-    now = datetime.now().strftime("%d/%m/%Y %H:%M")
-    temp = tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx')
-    workbook = xlsxwriter.Workbook(temp.name)
-    worksheet = workbook.add_worksheet("Magazzino")
-
-    # Formattazione header
-    bold = workbook.add_format({'bold': True, 'bg_color': '#e3f2fd'})
-    date_fmt = workbook.add_format({'num_format': 'dd/mm/yyyy hh:mm'})
-
-    # Scrivi la data di esportazione
-    worksheet.write('A1', 'PHARMAGEST - ESPORTAZIONE MAGAZZINO')
-    worksheet.write('A2', f'Data esportazione: {now}')
-
-    # Intestazioni colonne
-    headers = ["Codice", "Prodotto", "Magazzino", "Ubicazione", "Stato", "Quantità", "Note"]
-    for col, h in enumerate(headers):
-        worksheet.write(3, col, h, bold)
-
-    # Dati
-    for row, g in enumerate(giacenze, start=4):
-        worksheet.write(row, 0, g['codice_prodotto'])
-        worksheet.write(row, 1, g['nome_prodotto'])
-        worksheet.write(row, 2, g['magazzino'] or '')
-        worksheet.write(row, 3, g['ubicazione'] or '')
-        worksheet.write(row, 4, g['stato'] or '')
-        worksheet.write(row, 5, g['quantita'])
-        worksheet.write(row, 6, g['note'] or '')
-
-    worksheet.set_column(0, 0, 15)
-    worksheet.set_column(1, 1, 30)
-    worksheet.set_column(2, 2, 20)
-    worksheet.set_column(3, 3, 18)
-    worksheet.set_column(4, 4, 13)
-    worksheet.set_column(5, 5, 9)
-    worksheet.set_column(6, 6, 30)
-
-    workbook.close()
-    temp.seek(0)
+    file, versione, in_cache = export_cache.esportazione('magazzino_xlsx', 'xlsx', scrivi_xlsx_magazzino)
     filename = f"magazzino_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    response = send_file(temp.name, as_attachment=True, download_name=filename, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    # Pulizia file temporaneo dopo invio
-    @response.call_on_close
-    def cleanup():
-        try:
-            os.remove(temp.name)
-        except Exception:
-            pass
-    return response
+    return export_cache.invia(file, versione, 'magazzino_xlsx', filename,
+                              'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', in_cache)
 
-def get_all_giacenze():
-    """
-    Recupera tutte le giacenze dal database con tutte le informazioni necessarie per l'esportazione.
-    """
-    try:
-        conn = connect_to_database()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT 
-                p.codice_prodotto,
-                p.nome_prodotto,
-                m.nome AS magazzino,
-                g.ubicazione,
-                g.stato,
-                g.quantita,
-                g.note
-            FROM giacenze g
-            JOIN prodotti p ON g.prodotto_id = p.id
-            LEFT JOIN magazzini m ON g.magazzino_id = m.id
-            ORDER BY p.codice_prodotto ASC, m.nome ASC, g.ubicazione ASC
-        """)
-        giacenze = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return giacenze
-    except Exception as e:
-        # In caso di errore, ritorna una lista vuota
-        return []
+@app.route('/esporta_magazzino/<formato>')
+def esporta_magazzino_colonnare(formato):
+    """Giacenze in Parquet o Arrow IPC (Feather) per l'analisi con pandas."""
+    if 'user_id' not in session:
+        return redirect(url_for('auth.login'))
+    if formato not in FORMATI_COLONNARI:
+        return jsonify({'success': False, 'error': 'Formato non valido (parquet, feather)'}), 400
+    if not export_colonnare_disponibile():
+        return jsonify({'success': False, 'error': 'Dipendenza mancante: installa pyarrow'}), 501
+    estensione, mimetype = FORMATI_COLONNARI[formato]
+    filename = f"giacenze_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{estensione}"
+    return export_cache.invia_streaming(lambda: genera_giacenze_colonnare(formato), f'giacenze_{formato}',
+                                        estensione, filename, mimetype)
 
 from flask import request
 
@@ -1301,11 +1288,17 @@ def elimina_giacenza(giacenza_id):
         return redirect(url_for('auth.login'))
     try:
         conn = connect_to_database()
-        cursor = conn.cursor()
+        cursor = conn.cursor(dictionary=True)
+        giacenza = carica_giacenza(cursor, giacenza_id)
         cursor.execute("DELETE FROM giacenze WHERE id = %s", (giacenza_id,))
+        if giacenza:
+            registra_evento(cursor, 'ELIMINAZIONE', giacenza['prodotto_id'], giacenza['quantita'],
+                            session.get('user_id'), {'giacenza_id': giacenza_id, 'da_stato': giacenza['stato'],
+                                                     'da_ubicazione': giacenza['ubicazione']})
         conn.commit()
         cursor.close()
         conn.close()
+        sveglia_worker_notifiche()
         flash('Giacenza eliminata con successo.', 'success')
     except Exception as e:
         flash(f'Errore durante l\'eliminazione della giacenza: {e}', 'error')
@@ -1315,66 +1308,49 @@ def elimina_giacenza(giacenza_id):
 def logmovimenti():
     if 'user_id' not in session:
         return redirect(url_for('auth.login'))
+    # I movimenti vengono caricati a pagine da /api/logmovimenti
     try:
         conn = connect_to_database()
         cursor = conn.cursor(dictionary=True)
         
-        # Recupera movimenti unificati da entrambe le tabelle
-        cursor.execute("""
-            SELECT 
-                mv.data_ora,
-                u.username COLLATE utf8mb4_unicode_ci AS username,
-                p.nome_prodotto COLLATE utf8mb4_unicode_ci AS nome_prodotto,
-                m1.nome COLLATE utf8mb4_unicode_ci AS da_magazzino,
-                m2.nome COLLATE utf8mb4_unicode_ci AS a_magazzino,
-                mv.da_ubicazione COLLATE utf8mb4_unicode_ci AS da_ubicazione,
-                mv.a_ubicazione COLLATE utf8mb4_unicode_ci AS a_ubicazione,
-                mv.quantita,
-                mv.note COLLATE utf8mb4_unicode_ci AS note,
-                mv.stato COLLATE utf8mb4_unicode_ci AS stato,
-                mv.tipo_movimento COLLATE utf8mb4_unicode_ci AS tipo_movimento
-            FROM movimenti mv
-            LEFT JOIN utenti u ON mv.user_id = u.id
-            LEFT JOIN prodotti p ON mv.prodotto_id = p.id
-            LEFT JOIN magazzini m1 ON mv.da_magazzino_id = m1.id
-            LEFT JOIN magazzini m2 ON mv.a_magazzino_id = m2.id
-            
-            UNION ALL
-            
-            SELECT 
-                ls.data_ora,
-                u.username COLLATE utf8mb4_unicode_ci AS username,
-                p.nome_prodotto COLLATE utf8mb4_unicode_ci AS nome_prodotto,
-                NULL AS da_magazzino,
-                NULL AS a_magazzino,
-                NULL AS da_ubicazione,
-                NULL AS a_ubicazione,
-                ls.quantita,
-                CONCAT('Tipo scarico: ', COALESCE(ls.tipo_scarico, ''), 
-                       CASE WHEN ls.note IS NOT NULL AND ls.note != '' 
-                            THEN CONCAT(' - ', ls.note) 
-                            ELSE '' END) COLLATE utf8mb4_unicode_ci AS note,
-                NULL AS stato,
-                'SCARICO' COLLATE utf8mb4_unicode_ci AS tipo_movimento
-            FROM log_scarichi ls
-            LEFT JOIN utenti u ON ls.user_id = u.id
-            LEFT JOIN prodotti p ON ls.prodotto_id = p.id
-            
-            ORDER BY data_ora DESC
-        """)
-        movimenti = cursor.fetchall()
-        
         # Recupera lista magazzini per il filtro
-        cursor.execute("SELECT DISTINCT nome FROM magazzini ORDER BY nome")
-        magazzini_opzioni = [row['nome'] for row in cursor.fetchall()]
+        cursor.execute("SELECT id, nome FROM magazzini ORDER BY nome")
+        magazzini_opzioni = cursor.fetchall()
         
         cursor.close()
         conn.close()
     except Exception as e:
-        movimenti = []
         magazzini_opzioni = []
-        flash(f"Errore nel recupero dei movimenti: {e}", "error")
-    return render_template("logmovimenti.html", movimenti=movimenti, magazzini_opzioni=magazzini_opzioni)
+        flash(f"Errore nel recupero dei magazzini: {e}", "error")
+    return render_template("logmovimenti.html", magazzini_opzioni=magazzini_opzioni,
+                           limite_pagina=LIMITE_LOG_DEFAULT)
+
+
+# API log movimenti: pagina successiva al cursore, filtri applicati nel database
+@app.route('/api/logmovimenti', methods=['GET'])
+def api_logmovimenti():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Non autorizzato'}), 401
+    
+    try:
+        limite = int(request.args.get('limit', LIMITE_LOG_DEFAULT))
+    except ValueError:
+        return jsonify({'error': 'Parametri non validi'}), 400
+    
+    try:
+        conn = connect_to_database()
+        cursor = conn.cursor(dictionary=True)
+        try:
+            filtri = normalizza_filtri_log(cursor, request.args)
+            pagina = leggi_pagina_log(cursor, filtri, request.args.get('cursor'), limite)
+        finally:
+            cursor.close()
+            conn.close()
+        return jsonify(pagina)
+    except FiltroLogNonValido as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/scaricomerce', methods=['GET', 'POST'])
 def scaricomerce():
@@ -1448,19 +1424,23 @@ def scaricomerce():
                 if nuova_quantita == 0:
                     cursor.execute("DELETE FROM giacenze WHERE id = %s", (giacenza['id'],))
                 else:
-                    cursor.execute("UPDATE giacenze SET quantita = %s WHERE id = %s", (nuova_quantita, giacenza['id']))
+                    cursor.execute("UPDATE giacenze SET quantita = %s, version = version + 1 WHERE id = %s", (nuova_quantita, giacenza['id']))
                 
-                # Log dello scarico
+                # Scarico nel registro movimenti
                 cursor.execute("""
-                    INSERT INTO log_scarichi (prodotto_id, quantita, note, user_id, tipo_scarico)
-                    VALUES (%s, %s, %s, %s, %s)
+                    INSERT INTO stock_ledger (prodotto_id, quantita, note, user_id, tipo_movimento, tipo_scarico)
+                    VALUES (%s, %s, %s, %s, 'SCARICO', %s)
                 """, (prodotto_id, quantita, note, session.get('user_id'), 'DA_MAGAZZINO'))
+                registra_evento(cursor, 'SCARICO', giacenza['prodotto_id'], quantita, session.get('user_id'), {
+                    'giacenza_id': giacenza['id'], 'da_ubicazione': giacenza['ubicazione'],
+                    'quantita_precedente': giacenza['quantita'], 'quantita_nuova': nuova_quantita,
+                })
                 
                 conn.commit()
                 flash("Scarico effettuato con successo.", "success")
                 
-                # Controlla soglie dopo lo scarico
-                check_and_create_notifications()
+                # Controllo soglie nel worker in background
+                sveglia_worker_notifiche()
                 
             cursor.close()
             conn.close()
@@ -1505,9 +1485,14 @@ def scarico_merce_non_in_magazzino():
                 # Inserisci i log per ogni prodotto scaricato
                 for giacenza in giacenze_da_scaricare:
                     cursor.execute("""
-                        INSERT INTO log_scarichi (prodotto_id, quantita, note, user_id, tipo_scarico)
-                        VALUES (%s, %s, %s, %s, %s)
+                        INSERT INTO stock_ledger (prodotto_id, quantita, note, user_id, tipo_movimento, tipo_scarico)
+                        VALUES (%s, %s, %s, %s, 'SCARICO', %s)
                     """, (giacenza['prodotto_id'], giacenza['quantita'], giacenza['note'], session.get('user_id'), 'NON_IN_MAGAZZINO'))
+                registra_eventi(cursor, [
+                    ('SCARICO', g['prodotto_id'], g['quantita'], session.get('user_id'),
+                     {'giacenza_id': g['id'], 'da_stato': g['stato'], 'tipo_scarico': 'NON_IN_MAGAZZINO'})
+                    for g in giacenze_da_scaricare
+                ])
                 
                 # Elimina le giacenze
                 if len(ids_tuple) == 1:
@@ -1517,6 +1502,7 @@ def scarico_merce_non_in_magazzino():
                     cursor.execute(f"DELETE FROM giacenze WHERE id IN ({format_strings})", ids_tuple)
                 
                 conn.commit()
+                sveglia_worker_notifiche()
             cursor.close()
             conn.close()
             flash("Scarico effettuato per i prodotti selezionati.", "success")
@@ -1609,46 +1595,31 @@ def carico_merci():
             conn = connect_to_database()
             cursor = conn.cursor(dictionary=True)
 
-            # Recupera la giacenza esistente per il prodotto (e ubicazione se specificata)
-            query = "SELECT * FROM giacenze WHERE prodotto_id = %s AND stato = 'IN_MAGAZZINO'"
-            params = [prodotto_id]
-            if ubicazione:
-                query += " AND ubicazione = %s"
-                params.append(ubicazione)
+            # Trova il magazzino: preferisci quello della giacenza IN_MAGAZZINO
+            # nella stessa ubicazione, poi qualsiasi giacenza del prodotto
+            cursor.execute("""
+                SELECT magazzino_id FROM giacenze
+                WHERE prodotto_id = %s AND magazzino_id IS NOT NULL
+                ORDER BY (stato = 'IN_MAGAZZINO' AND ubicazione_norm = %s) DESC, id
+                LIMIT 1
+            """, (prodotto_id, ubicazione))
+            info = cursor.fetchone()
+            if info:
+                magazzino_id = info['magazzino_id']
             else:
-                query += " AND (ubicazione IS NULL OR ubicazione = '')"
-            cursor.execute(query, params)
-            giacenza = cursor.fetchone()
+                # Fallback: Usa il primo magazzino disponibile nel sistema
+                cursor.execute("SELECT id FROM magazzini ORDER BY id LIMIT 1")
+                magazzino_result = cursor.fetchone()
+                if not magazzino_result:
+                    raise Exception("Nessun magazzino trovato nel sistema")
+                magazzino_id = magazzino_result['id']
 
-            if giacenza:
-                nuova_quantita = giacenza['quantita'] + quantita
-                cursor.execute("UPDATE giacenze SET quantita = %s, note = %s WHERE id = %s", (nuova_quantita, note, giacenza['id']))
-                # Usa magazzino_id dalla giacenza esistente
-                magazzino_id = giacenza['magazzino_id']
-                stato = giacenza['stato']
-            else:
-                # Prima di inserire una nuova giacenza, trova un magazzino_id valido
-                # Opzione 1: Prova a recuperare magazzino_id da giacenze esistenti per questo prodotto
-                cursor.execute("SELECT magazzino_id FROM giacenze WHERE prodotto_id = %s LIMIT 1", (prodotto_id,))
-                info = cursor.fetchone()
-                # Opzione 2: Se non ci sono giacenze, usa il primo magazzino disponibile nel sistema
-                if info and info['magazzino_id']:
-                    magazzino_id = info['magazzino_id']
-                else:
-                    # Fallback: Usa il primo magazzino disponibile nel sistema
-                    cursor.execute("SELECT id FROM magazzini ORDER BY id LIMIT 1")
-                    magazzino_result = cursor.fetchone()
-                    if not magazzino_result:
-                        raise Exception("Nessun magazzino trovato nel sistema")
-                    magazzino_id = magazzino_result['id']
-                
-                # Lo stato per un carico merci è sempre 'IN_MAGAZZINO' (maiuscolo per coerenza)
-                stato = 'IN_MAGAZZINO'
-                
-                cursor.execute("""
-                    INSERT INTO giacenze (prodotto_id, magazzino_id, ubicazione, stato, quantita, note)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (prodotto_id, magazzino_id, ubicazione, stato, quantita, note))
+            # Lo stato per un carico merci è sempre 'IN_MAGAZZINO' (maiuscolo per coerenza)
+            stato = 'IN_MAGAZZINO'
+
+            # Upsert sulla chiave naturale: se esiste già una giacenza con stessa
+            # ubicazione e nota la quantità viene sommata, altrimenti viene creata
+            upsert_giacenza(cursor, prodotto_id, magazzino_id, ubicazione, stato, quantita, note)
 
             # Log movimento carico
             cursor.execute("""
@@ -1664,14 +1635,17 @@ def carico_merci():
                 magazzino_id,
                 'CARICO'
             ))
+            registra_evento(cursor, 'CARICO', prodotto_id, quantita, session.get('user_id'), {
+                'a_stato': stato, 'a_ubicazione': ubicazione, 'a_magazzino_id': magazzino_id,
+            })
 
             conn.commit()
             cursor.close()
             conn.close()
             flash('Carico effettuato con successo!', 'success')
             
-            # Controlla soglie dopo il carico (potrebbe aver riportato sopra soglia)
-            check_and_create_notifications()
+            # Controllo soglie nel worker in background
+            sveglia_worker_notifiche()
             
             return redirect(url_for('carico_merci'))
 
@@ -1685,6 +1659,83 @@ def carico_merci():
 
     return render_template('carico_merci.html', prodotti=prodotti, username=session.get('username'))
 
+@app.route('/carico_merci/import', methods=['POST'])
+def carico_merci_import():
+    """
+    Carico massivo da bolla di consegna (CSV/XLSX): un'unica transazione
+    per tutte le righe valide e un report con l'esito di ogni riga.
+    Con simula=1 le righe vengono solo validate, senza scrivere nulla.
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Non autenticato'}), 401
+
+    file = request.files.get('bolla')
+    if not file or not file.filename:
+        return jsonify({'success': False, 'error': 'Nessun file caricato'}), 400
+    simula = request.form.get('simula') in ('1', 'true', 'on')
+    user_id = session.get('user_id')
+
+    try:
+        righe = leggi_bolla(file.filename, file.read())
+    except BollaNonValida as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    if not righe:
+        return jsonify({'success': False, 'error': 'Il file non contiene righe da caricare'}), 400
+
+    def esegui(cursor):
+        report, giacenze, movimenti = prepara_carico(cursor, righe, user_id)
+        if simula:
+            raise AnnullaTransazione(report)
+        applica_carico(cursor, giacenze, movimenti)
+        return report
+
+    try:
+        report = esegui_transazione(esegui)
+    except TransazioneContesa as e:
+        return jsonify({'success': False, 'error': e.messaggio}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Errore durante il carico: {e}'}), 500
+
+    caricate = sum(1 for r in report if r['esito'] == 'ok')
+    if caricate and not simula:
+        # Controllo soglie nel worker in background (eventi deduplicati per prodotto)
+        sveglia_worker_notifiche()
+
+    return jsonify({
+        'success': True,
+        'simulazione': simula,
+        'righe_totali': len(report),
+        'righe_caricate': 0 if simula else caricate,
+        'righe_valide': caricate,
+        'righe_errore': len(report) - caricate,
+        'quantita_totale': sum(r['quantita'] for r in report if r['esito'] == 'ok'),
+        'report': report
+    })
+
+
+def risposta_conflitto_giacenza(cursor, giacenza_id, payload=None):
+    """
+    Risposta 409 per una modifica basata su una versione non più attuale:
+    include la giacenza riletta dal database, così il client può aggiornarsi.
+    """
+    risposta = dict(payload or {})
+    risposta.update({
+        'error': True,
+        'conflict': True,
+        'message': 'La giacenza è stata modificata da un altro utente. Valori aggiornati ricaricati.',
+        'giacenza': carica_giacenza(cursor, giacenza_id),
+    })
+    return jsonify(risposta), 409
+
+
+def leggi_versione(valore):
+    """Converte la versione inviata dal client (assente = nessun controllo)."""
+    if valore is None or valore == '':
+        return None
+    return int(valore)
+
+
 @app.route('/modifica_giacenza/<int:giacenza_id>', methods=['POST'])
 def modifica_giacenza(giacenza_id):
     from flask import jsonify
@@ -1698,8 +1749,9 @@ def modifica_giacenza(giacenza_id):
         quantita = request.form.get('quantita', '').strip()
         note = request.form.get('note', '').strip()
         
-        # Validazione quantità
+        # Validazione quantità e versione letta dal client
         try:
+            version = leggi_versione(request.form.get('version'))
             quantita_nuova = int(quantita)
             if quantita_nuova < 0:
                 flash('La quantità deve essere un numero positivo.', 'error')
@@ -1718,6 +1770,10 @@ def modifica_giacenza(giacenza_id):
             flash('Giacenza non trovata.', 'error')
             return redirect(url_for('index'))
         
+        # Il client ha modificato un valore non più attuale
+        if version is not None and giacenza_originale['version'] != version:
+            return risposta_conflitto_giacenza(cursor, giacenza_id)
+        
         quantita_originale = giacenza_originale['quantita']
         differenza_quantita = quantita_nuova - quantita_originale
         stato_originale = giacenza_originale['stato']
@@ -1790,16 +1846,19 @@ def modifica_giacenza(giacenza_id):
                     'ubicazione': ubicazione,
                     'stato': stato,
                     'quantita': quantita_nuova,
-                    'note': note
+                    'note': note,
+                    'version': giacenza_originale['version']
                 }
             })
         
-        # Aggiorna la giacenza direttamente (tutti gli altri casi)
-        cursor.execute("""
-            UPDATE giacenze 
-            SET ubicazione = %s, stato = %s, quantita = %s, note = %s 
-            WHERE id = %s
-        """, (ubicazione, stato, quantita_nuova, note, giacenza_id))
+        # Aggiorna la giacenza direttamente (tutti gli altri casi).
+        # Se la nuova chiave coincide con un'altra giacenza, le due vengono unite.
+        if not aggiorna_o_unisci_giacenza(
+            cursor, giacenza_id, giacenza_originale['prodotto_id'], giacenza_originale['magazzino_id'],
+            ubicazione, stato, quantita_nuova, note, version=giacenza_originale['version']
+        ):
+            conn.rollback()
+            return risposta_conflitto_giacenza(cursor, giacenza_id)
         
         # Log del movimento di modifica
         cursor.execute("""
@@ -1815,12 +1874,16 @@ def modifica_giacenza(giacenza_id):
             giacenza_originale['magazzino_id'],
             'MODIFICA'
         ))
+        registra_evento(cursor, 'MODIFICA', giacenza_originale['prodotto_id'], quantita_nuova, session.get('user_id'), {
+            'giacenza_id': giacenza_id, 'quantita_precedente': quantita_originale,
+            'da_stato': stato_originale, 'a_stato': stato, 'a_ubicazione': ubicazione,
+        })
         
         conn.commit()
         flash('Giacenza modificata con successo.', 'success')
         
-        # Controlla soglie dopo la modifica
-        check_and_create_notifications()
+        # Controllo soglie nel worker in background
+        sveglia_worker_notifiche()
         
     except Exception as e:
         flash(f'Errore durante la modifica: {e}', 'error')
@@ -1843,18 +1906,9 @@ def conferma_modifica_giacenza():
         giacenza_compensazione_id = data['giacenza_compensazione_id']
         form_data = data['form_data']
         differenza = data['differenza']
+        version = leggi_versione(form_data.get('version'))
+        user_id = session.get('user_id')
         
-        conn = connect_to_database()
-        cursor = conn.cursor(dictionary=True)
-        
-        # Recupera giacenza originale
-        cursor.execute("SELECT * FROM giacenze WHERE id = %s", (giacenza_id,))
-        giacenza_originale = cursor.fetchone()
-        
-        if not giacenza_originale:
-            return jsonify({'error': 'Giacenza originale non trovata'}), 400
-        
-        # Gestione ubicazione di compensazione
         if giacenza_compensazione_id == -1:  # Nuova ubicazione
             # Per le restituzioni (differenza < 0), creiamo una nuova giacenza
             if differenza >= 0:
@@ -1865,96 +1919,114 @@ def conferma_modifica_giacenza():
             ubicazione_destinazione = data.get('ubicazione_destinazione')
             if not ubicazione_destinazione:
                 return jsonify({'error': 'Ubicazione destinazione richiesta per nuova ubicazione'}), 400
-            
-            giacenza_compensazione = None  # Nessuna giacenza esistente da modificare
-            
-        else:  # Ubicazione esistente
-            # Recupera giacenza di compensazione esistente
-            cursor.execute("SELECT * FROM giacenze WHERE id = %s", (giacenza_compensazione_id,))
-            giacenza_compensazione = cursor.fetchone()
-            
-            if not giacenza_compensazione:
-                return jsonify({'error': 'Giacenza di compensazione non trovata'}), 400
-            
-            # Verifica disponibilità per prelievi
-            if differenza > 0 and giacenza_compensazione['quantita'] < differenza:
-                return jsonify({'error': 'Quantità insufficiente nell\'ubicazione selezionata'}), 400
         
-        # Aggiorna giacenza principale
-        cursor.execute("""
-            UPDATE giacenze 
-            SET ubicazione = %s, stato = %s, quantita = %s, note = %s 
-            WHERE id = %s
-        """, (form_data['ubicazione'], form_data['stato'], form_data['quantita'], form_data['note'], giacenza_id))
-        
-        # Gestione compensazione
-        if giacenza_compensazione_id == -1:  # Nuova ubicazione per restituzione
-            # Crea nuova giacenza nell'ubicazione specificata
-            ubicazione_destinazione = data.get('ubicazione_destinazione')
-            cursor.execute("""
-                INSERT INTO giacenze (prodotto_id, quantita, ubicazione, stato, magazzino_id, note)
-                VALUES (%s, %s, %s, 'IN_MAGAZZINO', %s, %s)
-            """, (
-                giacenza_originale['prodotto_id'],
-                abs(differenza),  # Quantità restituita (positiva)
-                ubicazione_destinazione,
-                giacenza_originale['magazzino_id'],
-                f"Restituzione da modifica giacenza {giacenza_id}"
-            ))
+        def esegui(cursor):
+            # Blocca giacenza originale e di compensazione in ordine di id
+            bloccate = blocca_giacenze(cursor, [giacenza_id, giacenza_compensazione_id])
+            giacenza_originale = bloccate.get(int(giacenza_id))
             
-            # Log movimento
-            cursor.execute("""
-                INSERT INTO movimenti (prodotto_id, quantita, note, user_id, stato, a_ubicazione, a_magazzino_id, da_ubicazione, da_magazzino_id, tipo_movimento)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                giacenza_originale['prodotto_id'],
-                abs(differenza),
-                f"Restituzione modifica giacenza: da {form_data['ubicazione']} a {ubicazione_destinazione}",
-                session.get('user_id'),
-                'IN_MAGAZZINO',
-                ubicazione_destinazione,
-                giacenza_originale['magazzino_id'],
-                form_data['ubicazione'],
-                giacenza_originale['magazzino_id'],
-                'MODIFICA'
-            ))
+            if not giacenza_originale:
+                raise AnnullaTransazione((jsonify({'error': 'Giacenza originale non trovata'}), 400))
             
-        else:  # Ubicazione esistente
-            # Aggiorna giacenza di compensazione esistente
-            nuova_quantita_compensazione = giacenza_compensazione['quantita'] - differenza
-            if nuova_quantita_compensazione <= 0:
-                cursor.execute("DELETE FROM giacenze WHERE id = %s", (giacenza_compensazione_id,))
-            else:
-                cursor.execute("UPDATE giacenze SET quantita = %s WHERE id = %s", 
-                             (nuova_quantita_compensazione, giacenza_compensazione_id))
+            if version is not None and giacenza_originale['version'] != version:
+                raise AnnullaTransazione(risposta_conflitto_giacenza(cursor, giacenza_id))
             
-            # Log movimento
-            cursor.execute("""
-                INSERT INTO movimenti (prodotto_id, quantita, note, user_id, stato, a_ubicazione, a_magazzino_id, da_ubicazione, da_magazzino_id, tipo_movimento)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                giacenza_originale['prodotto_id'],
-                abs(differenza),
-                f"Compensazione modifica giacenza: da {giacenza_compensazione['ubicazione']} a {form_data['ubicazione']}",
-                session.get('user_id'),
-                form_data['stato'],
-                form_data['ubicazione'],
-                giacenza_originale['magazzino_id'],
-                giacenza_compensazione['ubicazione'],
-                giacenza_compensazione['magazzino_id'],
-                'MODIFICA'
-            ))
+            # Gestione compensazione
+            if giacenza_compensazione_id == -1:  # Nuova ubicazione per restituzione
+                # Crea nuova giacenza nell'ubicazione specificata
+                upsert_giacenza(
+                    cursor,
+                    giacenza_originale['prodotto_id'],
+                    giacenza_originale['magazzino_id'],
+                    ubicazione_destinazione,
+                    'IN_MAGAZZINO',
+                    abs(differenza),  # Quantità restituita (positiva)
+                    f"Restituzione da modifica giacenza {giacenza_id}"
+                )
+                
+                # Log movimento
+                cursor.execute("""
+                    INSERT INTO movimenti (prodotto_id, quantita, note, user_id, stato, a_ubicazione, a_magazzino_id, da_ubicazione, da_magazzino_id, tipo_movimento)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, (
+                    giacenza_originale['prodotto_id'],
+                    abs(differenza),
+                    f"Restituzione modifica giacenza: da {form_data['ubicazione']} a {ubicazione_destinazione}",
+                    user_id,
+                    'IN_MAGAZZINO',
+                    ubicazione_destinazione,
+                    giacenza_originale['magazzino_id'],
+                    form_data['ubicazione'],
+                    giacenza_originale['magazzino_id'],
+                    'MODIFICA'
+                ))
+                
+            else:  # Ubicazione esistente
+                giacenza_compensazione = bloccate.get(int(giacenza_compensazione_id))
+                if not giacenza_compensazione:
+                    raise AnnullaTransazione((jsonify({'error': 'Giacenza di compensazione non trovata'}), 400))
+                
+                # Verifica disponibilità per prelievi
+                if differenza > 0 and giacenza_compensazione['quantita'] < differenza:
+                    raise AnnullaTransazione((jsonify({'error': 'Quantità insufficiente nell\'ubicazione selezionata'}), 400))
+                
+                # Aggiorna giacenza di compensazione esistente
+                nuova_quantita_compensazione = giacenza_compensazione['quantita'] - differenza
+                if nuova_quantita_compensazione <= 0:
+                    cursor.execute("DELETE FROM giacenze WHERE id = %s AND version = %s",
+                                   (giacenza_compensazione_id, giacenza_compensazione['version']))
+                    compensazione_applicata = cursor.rowcount > 0
+                else:
+                    compensazione_applicata = aggiorna_quantita_giacenza(
+                        cursor, giacenza_compensazione_id, nuova_quantita_compensazione,
+                        version=giacenza_compensazione['version']
+                    )
+                if not compensazione_applicata:
+                    raise AnnullaTransazione(risposta_conflitto_giacenza(cursor, giacenza_compensazione_id))
+                
+                # Log movimento
+                cursor.execute("""
+                    INSERT INTO movimenti (prodotto_id, quantita, note, user_id, stato, a_ubicazione, a_magazzino_id, da_ubicazione, da_magazzino_id, tipo_movimento)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, (
+                    giacenza_originale['prodotto_id'],
+                    abs(differenza),
+                    f"Compensazione modifica giacenza: da {giacenza_compensazione['ubicazione']} a {form_data['ubicazione']}",
+                    user_id,
+                    form_data['stato'],
+                    form_data['ubicazione'],
+                    giacenza_originale['magazzino_id'],
+                    giacenza_compensazione['ubicazione'],
+                    giacenza_compensazione['magazzino_id'],
+                    'MODIFICA'
+                ))
+            
+            # Aggiorna giacenza principale dopo la compensazione: se la nuova chiave
+            # coincide con un'altra giacenza (anche quella di compensazione) le quantità vengono unite
+            if not aggiorna_o_unisci_giacenza(
+                cursor, giacenza_id, giacenza_originale['prodotto_id'], giacenza_originale['magazzino_id'],
+                form_data['ubicazione'], form_data['stato'], form_data['quantita'], form_data['note'],
+                version=giacenza_originale['version']
+            ):
+                raise AnnullaTransazione(risposta_conflitto_giacenza(cursor, giacenza_id))
+            registra_evento(cursor, 'MODIFICA', giacenza_originale['prodotto_id'], form_data['quantita'], user_id, {
+                'giacenza_id': giacenza_id, 'quantita_precedente': giacenza_originale['quantita'],
+                'da_stato': giacenza_originale['stato'], 'a_stato': form_data['stato'],
+                'a_ubicazione': form_data['ubicazione'], 'compensazione': differenza,
+            })
+            return None
         
-        conn.commit()
+        # Ripetuta automaticamente in caso di deadlock / lock timeout
+        risposta = esegui_transazione(esegui)
+        if risposta is not None:
+            return risposta
+        sveglia_worker_notifiche()
         return jsonify({'success': True})
         
+    except TransazioneContesa as e:
+        return jsonify({'error': e.messaggio}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/changelogs', methods=['GET', 'POST'])
 def changelogs():
@@ -2077,31 +2149,9 @@ def admin_panel():
         cursor.execute("SELECT COUNT(*) as total FROM utenti WHERE is_admin = TRUE")
         total_admins = cursor.fetchone()['total']
         
-        # Conta notifiche inviate oggi (broadcast iniziano con [])
-        cursor.execute("""
-            SELECT COUNT(DISTINCT id) as total FROM notifications 
-            WHERE DATE(data_notifica) = CURDATE() AND codice_prodotto LIKE '[%'
-        """)
-        notifications_today = cursor.fetchone()['total']
-        
-        # Ultimi broadcast (notifiche con [TIPO] nel codice_prodotto)
-        cursor.execute("""
-            SELECT codice_prodotto as riferimento, 
-                   nome_prodotto as messaggio,
-                   data_notifica,
-                   CASE 
-                     WHEN magazzino = 'info' THEN 'info'
-                     WHEN magazzino = 'success' THEN 'success'
-                     WHEN magazzino = 'warning' THEN 'warning'
-                     WHEN magazzino = 'error' THEN 'error'
-                     ELSE 'info'
-                   END as tipo
-            FROM notifications
-            WHERE codice_prodotto LIKE '[%'
-            ORDER BY data_notifica DESC
-            LIMIT 5
-        """)
-        recent_broadcasts = cursor.fetchall()
+        # Broadcast inviati oggi e ultimi broadcast (tabella broadcasts, indice su created_at)
+        notifications_today = conta_broadcast_oggi(cursor)
+        recent_broadcasts = broadcast_recenti(cursor)
         
     except Exception as e:
         flash(f'Errore nel caricamento statistiche: {e}', 'error')
@@ -2168,27 +2218,21 @@ def admin_broadcast():
         conn = connect_to_database()
         cursor = conn.cursor()
         
-        # Ottieni tutti gli utenti
-        cursor.execute("SELECT id FROM utenti")
-        users = cursor.fetchall()
+        cursor.execute("SELECT COUNT(*) FROM utenti")
+        num_utenti = cursor.fetchone()[0]
         
-        if not users:
+        if not num_utenti:
             return jsonify({'success': False, 'message': 'Nessun utente trovato'}), 400
         
-        # Crea notifica per ogni utente usando i campi esistenti
-        # Uso nome_prodotto per il messaggio e codice_prodotto per il titolo
-        for user in users:
-            cursor.execute("""
-                INSERT INTO notifications 
-                (user_id, codice_prodotto, nome_prodotto, quantita_attuale, soglia_minima, magazzino, visualizzata)
-                VALUES (%s, %s, %s, 0, 0, %s, FALSE)
-            """, (user[0], f'[{tipo.upper()}] {titolo}', messaggio, tipo))
+        # Una sola riga: il broadcast viene unito al feed di ogni utente in lettura
+        crea_broadcast(cursor, titolo, messaggio, tipo, session.get('user_id'))
         
         conn.commit()
+        notification_bus.pubblica()
         
         return jsonify({
             'success': True, 
-            'message': f'Notifica inviata a {len(users)} utenti'
+            'message': f'Notifica inviata a {num_utenti} utenti'
         })
         
     except Exception as e:
@@ -2225,49 +2269,26 @@ def rientro_merce():
             flash('Quantità non valida.', 'error')
             return redirect(url_for('rientro_merce'))
 
-        try:
-            conn = connect_to_database()
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("""
-                SELECT g.*, p.nome_prodotto, p.codice_prodotto
-                FROM giacenze g
-                JOIN prodotti p ON g.prodotto_id = p.id
-                WHERE g.id = %s
-            """, (giacenza_id,))
-            sorgente = cursor.fetchone()
+        user_id = session.get('user_id')
+
+        def esegui(cursor):
+            # Blocca la giacenza di origine prima di leggerne la quantità
+            sorgente = blocca_giacenze(cursor, [giacenza_id]).get(int(giacenza_id))
             if not sorgente:
-                flash('Giacenza di origine non trovata.', 'error')
-                return redirect(url_for('rientro_merce'))
+                raise AnnullaTransazione('Giacenza di origine non trovata.')
             if sorgente['prodotto_id'] != int(prodotto_id):
-                flash('Mismatch prodotto/giacenza.', 'error')
-                return redirect(url_for('rientro_merce'))
+                raise AnnullaTransazione('Mismatch prodotto/giacenza.')
             if sorgente['quantita'] < quantita_da_rientrare:
-                flash('Quantità richiesta superiore alla disponibilità fuori magazzino.', 'error')
-                return redirect(url_for('rientro_merce'))
+                raise AnnullaTransazione('Quantità richiesta superiore alla disponibilità fuori magazzino.')
 
-            cursor.execute("""
-                SELECT * FROM giacenze
-                WHERE prodotto_id = %s AND ubicazione = %s AND stato = 'in_magazzino'
-            """, (prodotto_id, target_ubicazione))
-            destinazione = cursor.fetchone()
-            
             nuova_q_sorgente = sorgente['quantita'] - quantita_da_rientrare
-            cursor.execute("UPDATE giacenze SET quantita = %s WHERE id = %s", (nuova_q_sorgente, sorgente['id']))
+            cursor.execute("UPDATE giacenze SET quantita = %s, version = version + 1 WHERE id = %s", (nuova_q_sorgente, sorgente['id']))
             
-            if destinazione:
-                # Ubicazione esistente: aggiorna la quantità
-                cursor.execute("""
-                    UPDATE giacenze SET quantita = quantita + %s WHERE id = %s
-                """, (quantita_da_rientrare, destinazione['id']))
-            else:
-                # Nuova ubicazione: crea un nuovo record
-                cursor.execute("""
-                    INSERT INTO giacenze (prodotto_id, quantita, ubicazione, stato, magazzino_id)
-                    VALUES (%s, %s, %s, 'in_magazzino', %s)
-                """, (prodotto_id, quantita_da_rientrare, target_ubicazione, 1))
-                # Recupera l'ID della nuova giacenza creata
-                cursor.execute("SELECT LAST_INSERT_ID() as new_id")
-                destinazione = {'id': cursor.fetchone()['new_id'], 'ubicazione': target_ubicazione, 'magazzino_id': 1}
+            # Upsert sulla chiave naturale: somma alla giacenza esistente
+            # nell'ubicazione di destinazione oppure la crea
+            magazzino_destinazione = sorgente.get('magazzino_id') or 1
+            upsert_giacenza(cursor, sorgente['prodotto_id'], magazzino_destinazione,
+                            target_ubicazione, 'IN_MAGAZZINO', quantita_da_rientrare)
             
             if nuova_q_sorgente == 0:
                 cursor.execute("DELETE FROM giacenze WHERE id = %s", (sorgente['id'],))
@@ -2281,25 +2302,32 @@ def rientro_merce():
                 sorgente['prodotto_id'],
                 quantita_da_rientrare,
                 note or f"Rientro da stato {sorgente['stato']} verso {target_ubicazione}",
-                session.get('user_id'),
+                user_id,
                 'rientro',
-                destinazione['ubicazione'],
-                destinazione.get('magazzino_id'),
+                target_ubicazione,
+                magazzino_destinazione,
                 sorgente.get('ubicazione'),
                 sorgente.get('magazzino_id'),
                 'TRASFERIMENTO'
             ))
-            conn.commit()
-            flash('Rientro effettuato con successo.', 'success')
+            registra_evento(cursor, 'TRASFERIMENTO', sorgente['prodotto_id'], quantita_da_rientrare, user_id, {
+                'da_stato': sorgente['stato'], 'a_stato': 'IN_MAGAZZINO',
+                'da_ubicazione': sorgente.get('ubicazione'), 'a_ubicazione': target_ubicazione,
+                'rientro': True,
+            })
+            return None
+
+        try:
+            errore = esegui_transazione(esegui)
+            if errore:
+                flash(errore, 'error')
+            else:
+                sveglia_worker_notifiche()
+                flash('Rientro effettuato con successo.', 'success')
+        except TransazioneContesa as e:
+            flash(e.messaggio, 'error')
         except Exception as e:
-            if 'conn' in locals():
-                conn.rollback()
             flash(f'Errore durante il rientro: {e}', 'error')
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
         return redirect(url_for('rientro_merce'))
 
     # GET
@@ -2447,6 +2475,7 @@ def aggiorna_giacenza_rapida(giacenza_id):
     try:
         data = request.get_json()
         nuova_quantita = int(data.get('quantita', 0))
+        version = leggi_versione(data.get('version'))
         
         if nuova_quantita < 0:
             return jsonify({'success': False, 'error': 'Quantità non valida'}), 400
@@ -2468,12 +2497,12 @@ def aggiorna_giacenza_rapida(giacenza_id):
         
         quantita_originale = giacenza['quantita']
         
-        # Aggiorna la quantità
-        cursor.execute("""
-            UPDATE giacenze 
-            SET quantita = %s 
-            WHERE id = %s
-        """, (nuova_quantita, giacenza_id))
+        # Aggiorna la quantità solo se la giacenza non è cambiata dalla lettura
+        # del client (senza versione: confronto con il valore appena letto)
+        if not aggiorna_quantita_giacenza(cursor, giacenza_id, nuova_quantita,
+                                          version=version if version is not None else giacenza['version']):
+            conn.rollback()
+            return risposta_conflitto_giacenza(cursor, giacenza_id, {'success': False})
         
         # Registra il movimento se la quantità è cambiata
         if nuova_quantita != quantita_originale:
@@ -2494,13 +2523,20 @@ def aggiorna_giacenza_rapida(giacenza_id):
                 giacenza.get('magazzino_id', 1),
                 'MODIFICA'
             ))
+            registra_evento(cursor, 'MODIFICA', giacenza['prodotto_id'], nuova_quantita, session.get('user_id'), {
+                'giacenza_id': giacenza_id, 'quantita_precedente': quantita_originale,
+                'a_stato': giacenza['stato'], 'a_ubicazione': giacenza['ubicazione'],
+            })
         
         conn.commit()
+        if nuova_quantita != quantita_originale:
+            sveglia_worker_notifiche()
         
         return jsonify({
             'success': True,
             'message': 'Quantità aggiornata con successo',
-            'nuova_quantita': nuova_quantita
+            'nuova_quantita': nuova_quantita,
+            'version': (version if version is not None else giacenza['version']) + 1
         })
         
     except Exception as e:
@@ -2514,6 +2550,46 @@ def aggiorna_giacenza_rapida(giacenza_id):
         if 'conn' in locals():
             conn.close()
 
+@app.route('/api/sync', methods=['POST'])
+def api_sync():
+    """
+    Applica in un'unica transazione le operazioni accodate offline dal client
+    (modifiche rapide, scarichi, movimenti). Ogni operazione ha una chiave di
+    idempotenza e riceve il proprio esito: un reinvio non la ripete.
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Non autenticato'}), 401
+
+    data = request.get_json(silent=True) or {}
+    operazioni = data.get('operazioni') or []
+    if not isinstance(operazioni, list) or not operazioni:
+        return jsonify({'success': False, 'error': 'Nessuna operazione da sincronizzare'}), 400
+    if len(operazioni) > MAX_OPERAZIONI_SYNC:
+        return jsonify({'success': False, 'error': f'Massimo {MAX_OPERAZIONI_SYNC} operazioni per richiesta'}), 413
+
+    user_id = session.get('user_id')
+    try:
+        risultati = esegui_transazione(applica_operazioni, user_id, operazioni)
+    except TransazioneContesa as e:
+        return jsonify({'success': False, 'error': e.messaggio}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    if any(r['stato'] == 'ok' and not r.get('duplicata') for r in risultati):
+        # Controllo soglie nel worker in background (eventi deduplicati per prodotto)
+        sveglia_worker_notifiche()
+
+    return jsonify({'success': True, 'risultati': risultati})
+
+
+@app.route('/sw.js')
+def service_worker():
+    """Service worker servito dalla radice, così può gestire tutte le pagine."""
+    response = make_response(send_file(os.path.join(app.static_folder, 'sw.js'), mimetype='application/javascript'))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Service-Worker-Allowed'] = '/'
+    return response
+
 # --- DA INSERIRE IN TUTTI I TEMPLATE PRINCIPALI ---
 # {% with messages = get_flashed_messages(with_categories=true) %}
 #   {% if messages %}
@@ -2580,176 +2656,109 @@ def movimento_multiplo_execute():
     movimenti = data['movimenti']
     user_id = session.get('user_id')
     
-    conn = None
-    cursor = None
+    # Fase 1: Normalizzazione e controlli formali delle righe
+    righe, errori_validazione = normalizza_movimenti(movimenti)
+    if errori_validazione:
+        return jsonify({'success': False, 'error': errori_validazione[0]})
     
-    try:
-        conn = connect_to_database()
-        conn.autocommit = False  # Disabilita autocommit esplicitamente
-        cursor = conn.cursor(dictionary=True, buffered=True)
-        
-        # Fase 1: Validazione di tutti i movimenti
-        errori_validazione = []
-        for i, mov in enumerate(movimenti):
-            prodotto_id = mov.get('prodotto_id')
-            da_ubicazione = mov.get('da_ubicazione')
-            quantita = mov.get('quantita', 0)
-            
-            if not prodotto_id:
-                errori_validazione.append(f'Movimento {i+1}: prodotto mancante')
-                continue
-            
-            if quantita <= 0:
-                errori_validazione.append(f'Movimento {i+1}: quantità non valida')
-                continue
-            
-            # Verifica giacenza disponibile
-            cursor.execute("""
-                SELECT quantita FROM giacenze 
-                WHERE prodotto_id = %s AND stato = %s AND ubicazione = %s
-            """, (prodotto_id, stato_origine, da_ubicazione))
-            giacenza = cursor.fetchone()
-            
-            if not giacenza:
-                errori_validazione.append(f'Movimento {i+1}: giacenza non trovata per ubicazione {da_ubicazione}')
-                continue
-            
-            if giacenza['quantita'] < quantita:
-                errori_validazione.append(f'Movimento {i+1}: giacenza insufficiente (disponibili: {giacenza["quantita"]}, richiesti: {quantita})')
+    def esegui(cursor):
+        # Fase 2: Caricamento (con lock in ordine di id) di tutte le giacenze coinvolte
+        stati_coinvolti = {stato_origine} | {r['stato_destinazione'] for r in righe}
+        giacenze_coinvolte = carica_giacenze_coinvolte(
+            cursor, [r['prodotto_id'] for r in righe], stati_coinvolti
+        )
         
-        # Se ci sono errori di validazione, esci
-        if errori_validazione:
-            cursor.close()
-            conn.close()
-            return jsonify({'success': False, 'error': errori_validazione[0]})
-        
-        # Fase 2: Esecuzione movimenti
-        for mov in movimenti:
-            prodotto_id = mov.get('prodotto_id')
-            da_ubicazione = mov.get('da_ubicazione')
-            a_ubicazione = mov.get('a_ubicazione')
-            quantita = mov.get('quantita')
-            nota = mov.get('nota', '')
-            stato_dest = mov.get('stato_destinazione')
-            
-            # Determina magazzino_id (default)
-            cursor.execute("SELECT magazzino_id FROM giacenze WHERE prodotto_id = %s LIMIT 1", (prodotto_id,))
-            mag_result = cursor.fetchone()
-            magazzino_id = mag_result['magazzino_id'] if mag_result else None
-            
-            # Tipo movimento: sempre TRASFERIMENTO per movimento multiplo
-            # SCARICO e CARICO sono riservati alle rispettive pagine dedicate
-            tipo_mov = 'TRASFERIMENTO'
-            
-            # 1. Inserisci record movimento
-            cursor.execute("""
-                INSERT INTO movimenti (
-                    prodotto_id, da_magazzino_id, a_magazzino_id, 
-                    da_ubicazione, a_ubicazione, quantita, note, 
-                    user_id, stato, tipo_movimento
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (prodotto_id, magazzino_id, magazzino_id, da_ubicazione, a_ubicazione, quantita, nota, user_id, stato_dest, tipo_mov))
-            
-            # 2. Decrementa giacenza origine
-            cursor.execute("""
-                SELECT id, quantita FROM giacenze 
-                WHERE prodotto_id = %s AND stato = %s AND ubicazione = %s
-            """, (prodotto_id, stato_origine, da_ubicazione))
-            giacenza_origine = cursor.fetchone()
-            
-            nuova_qty_origine = giacenza_origine['quantita'] - quantita
-            if nuova_qty_origine <= 0:
-                cursor.execute("DELETE FROM giacenze WHERE id = %s", (giacenza_origine['id'],))
-            else:
-                cursor.execute("UPDATE giacenze SET quantita = %s WHERE id = %s", (nuova_qty_origine, giacenza_origine['id']))
-            
-            # 3. Incrementa/crea giacenza destinazione
-            # Cerca giacenza esistente con stesso prodotto, stato, ubicazione E nota
-            cursor.execute("""
-                SELECT id, quantita FROM giacenze 
-                WHERE prodotto_id = %s AND stato = %s 
-                AND (ubicazione = %s OR (ubicazione IS NULL AND %s IS NULL))
-                AND (note = %s OR (note IS NULL AND %s IS NULL) OR (note = '' AND %s = ''))
-            """, (prodotto_id, stato_dest, a_ubicazione, a_ubicazione, nota, nota, nota))
-            giacenza_dest = cursor.fetchone()
-            
-            if giacenza_dest:
-                cursor.execute("UPDATE giacenze SET quantita = quantita + %s WHERE id = %s", (quantita, giacenza_dest['id']))
-            else:
-                cursor.execute("""
-                    INSERT INTO giacenze (prodotto_id, magazzino_id, ubicazione, stato, quantita, note)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (prodotto_id, magazzino_id, a_ubicazione, stato_dest, quantita, nota))
+        # Fase 3: Validazione e pianificazione in memoria
+        errori, piano = pianifica_movimenti(righe, stato_origine, giacenze_coinvolte, user_id)
+        if errori:
+            raise AnnullaTransazione(errori[0])
         
-        conn.commit()
+        # Fase 4: Applicazione del piano con istruzioni batch
+        applica_piano(cursor, piano)
+        return None
+    
+    try:
+        # Ripetuta automaticamente in caso di deadlock / lock timeout
+        errore = esegui_transazione(esegui)
+        if errore:
+            return jsonify({'success': False, 'error': errore})
         
+        sveglia_worker_notifiche()
         return jsonify({
             'success': True, 
             'message': f'{len(movimenti)} movimenti eseguiti con successo!'
         })
-        
+    except TransazioneContesa as e:
+        return jsonify({'success': False, 'error': e.messaggio}), 503
     except Exception as e:
-        if conn:
-            try:
-                conn.rollback()
-            except:
-                pass
         return jsonify({'success': False, 'error': str(e)})
-    finally:
-        if cursor:
-            try:
-                cursor.close()
-            except:
-                pass
-        if conn:
-            try:
-                conn.close()
-            except:
-                pass
 
 
 @app.route('/api/movimento-multiplo/bozza', methods=['POST'])
 def movimento_multiplo_salva_bozza():
-    """Salva una bozza di movimento multiplo"""
+    """Salva una nuova bozza di movimento multiplo (righe salvate una per riga)"""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Non autenticato'}), 401
     
-    data = request.get_json()
+    data = request.get_json() or {}
     user_id = session.get('user_id')
     
-    nome_bozza = data.get('nome_bozza', '').strip()
-    if not nome_bozza:
-        return jsonify({'success': False, 'error': 'Nome bozza obbligatorio'})
-    
     try:
         conn = connect_to_database()
         cursor = conn.cursor(dictionary=True)
         
-        # Conta bozze esistenti per l'utente
-        cursor.execute("SELECT COUNT(*) as count FROM movimenti_batch_draft WHERE user_id = %s", (user_id,))
-        count = cursor.fetchone()['count']
+        riepilogo = crea_bozza(cursor, user_id, data, data.get('movimenti') or [])
         
-        # Se già 10 bozze, elimina la più vecchia
-        if count >= 10:
-            cursor.execute("""
-                DELETE FROM movimenti_batch_draft 
-                WHERE user_id = %s 
-                ORDER BY created_at ASC 
-                LIMIT 1
-            """, (user_id,))
+        conn.commit()
+        return jsonify({'success': True, 'bozza': serializza_riepilogo_bozza(riepilogo)})
         
-        # Salva nuova bozza
-        json_items = json.dumps(data.get('movimenti', []))
+    except BozzaNonValida as e:
+        conn.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
+
+@app.route('/api/movimento-multiplo/bozza/<int:bozza_id>', methods=['PATCH'])
+def movimento_multiplo_aggiorna_bozza(bozza_id):
+    """
+    Salvataggio incrementale (autosave): riceve solo le righe aggiunte,
+    modificate o rimosse e gli eventuali campi di testata cambiati.
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Non autenticato'}), 401
+    
+    data = request.get_json() or {}
+    
+    try:
+        conn = connect_to_database()
+        cursor = conn.cursor(dictionary=True)
+        
+        # Il lock sulla bozza serializza gli autosave concorrenti (più schede)
         cursor.execute("""
-            INSERT INTO movimenti_batch_draft (user_id, nome_bozza, json_items, nota_globale, stato_origine, stato_destinazione)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (user_id, nome_bozza, json_items, data.get('nota_globale', ''), data.get('stato_origine', ''), data.get('stato_destinazione', '')))
+            SELECT id FROM movimenti_batch_draft 
+            WHERE id = %s AND user_id = %s
+            FOR UPDATE
+        """, (bozza_id, session.get('user_id')))
+        if not cursor.fetchone():
+            conn.rollback()
+            return jsonify({'success': False, 'error': 'Bozza non trovata'}), 404
+        
+        riepilogo = applica_patch(cursor, bozza_id, data.get('testata'), data.get('operazioni'))
         
         conn.commit()
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'bozza': serializza_riepilogo_bozza(riepilogo)})
         
+    except BozzaNonValida as e:
+        conn.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        return jsonify({'success': False, 'error': str(e)}), 500
     finally:
         if 'cursor' in locals() and cursor:
             cursor.close()
@@ -2757,9 +2766,17 @@ def movimento_multiplo_salva_bozza():
             conn.close()
 
 
+def serializza_riepilogo_bozza(bozza):
+    """Converte le date del riepilogo bozza in stringhe ISO per il JSON"""
+    for campo in ('created_at', 'updated_at'):
+        if bozza.get(campo):
+            bozza[campo] = bozza[campo].isoformat()
+    return bozza
+
+
 @app.route('/api/movimento-multiplo/bozze')
 def movimento_multiplo_lista_bozze():
-    """Lista bozze dell'utente"""
+    """Lista bozze dell'utente (solo colonne di riepilogo, senza leggere le righe)"""
     if 'user_id' not in session:
         return jsonify([])
     
@@ -2768,18 +2785,13 @@ def movimento_multiplo_lista_bozze():
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("""
-            SELECT id, nome_bozza, created_at 
+            SELECT id, nome_bozza, num_righe, quantita_totale, num_prodotti, created_at, updated_at
             FROM movimenti_batch_draft 
             WHERE user_id = %s 
             ORDER BY created_at DESC
         """, (session.get('user_id'),))
         
-        bozze = cursor.fetchall()
-        
-        # Converti datetime in string
-        for b in bozze:
-            if b['created_at']:
-                b['created_at'] = b['created_at'].isoformat()
+        bozze = [serializza_riepilogo_bozza(b) for b in cursor.fetchall()]
         
         return jsonify(bozze)
         
@@ -2803,7 +2815,8 @@ def movimento_multiplo_carica_bozza(bozza_id):
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("""
-            SELECT * FROM movimenti_batch_draft 
+            SELECT id, nome_bozza, json_items, nota_globale, stato_origine, stato_destinazione
+            FROM movimenti_batch_draft 
             WHERE id = %s AND user_id = %s
         """, (bozza_id, session.get('user_id')))
         
@@ -2812,11 +2825,16 @@ def movimento_multiplo_carica_bozza(bozza_id):
         if not bozza:
             return jsonify({'error': 'Bozza non trovata'}), 404
         
+        movimenti = carica_righe(cursor, bozza)
+        conn.commit()  # conversione delle bozze salvate come json_items
+        
         return jsonify({
+            'id': bozza['id'],
+            'nome_bozza': bozza['nome_bozza'],
             'stato_origine': bozza['stato_origine'],
             'stato_destinazione': bozza['stato_destinazione'],
             'nota_globale': bozza['nota_globale'],
-            'movimenti': json.loads(bozza['json_items']) if bozza['json_items'] else []
+            'movimenti': movimenti
         })
         
     except Exception as e:
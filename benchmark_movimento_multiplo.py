@@ -0,0 +1,189 @@
+"""
+Benchmark del Movimento Multiplo set-based (10, 100, 1.000 righe).
+
+Uso:
+    python benchmark_movimento_multiplo.py          # solo pianificazione in memoria
+    python benchmark_movimento_multiplo.py --db     # anche sul database (in transazione, con ROLLBACK)
+
+In modalità --db lo script crea prodotti e giacenze di test dentro una
+transazione, misura il percorso per-riga (legacy) e quello set-based,
+conta le istruzioni inviate al database e annulla tutto con ROLLBACK.
+"""
+import sys
+import time
+
+from utils.movimento_multiplo import (
+    normalizza_movimenti, carica_giacenze_coinvolte, pianifica_movimenti, applica_piano
+)
+
+DIMENSIONI = [10, 100, 1000]
+STATO_ORIGINE = 'IN_MAGAZZINO'
+STATO_DESTINAZIONE = 'IN_MAGAZZINO'
+
+
+class CursorContatore:
+    """Wrapper del cursore che conta le istruzioni inviate al database."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.istruzioni = 0
+
+    def execute(self, *args, **kwargs):
+        self.istruzioni += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, query, params):
+        # mysql-connector riscrive gli INSERT in un'unica istruzione multi-riga,
+        # mentre UPDATE/DELETE vengono eseguiti una riga alla volta
+        if query.lstrip().upper().startswith('INSERT'):
+            self.istruzioni += 1
+        else:
+            self.istruzioni += len(params)
+        return self._cursor.executemany(query, params)
+
+    def __getattr__(self, nome):
+        return getattr(self._cursor, nome)
+
+
+def genera_righe(n, prodotto_ids=None):
+    """Genera n righe di movimento (una per prodotto, da A a B)."""
+    prodotto_ids = prodotto_ids or list(range(1, n + 1))
+    return [{
+        'prodotto_id': prodotto_ids[i],
+        'da_ubicazione': 'BENCH-A',
+        'a_ubicazione': 'BENCH-B',
+        'quantita': 1,
+        'nota': 'benchmark',
+        'stato_destinazione': STATO_DESTINAZIONE,
+    } for i in range(n)]
+
+
+def benchmark_pianificazione(n):
+    """Misura solo validazione e pianificazione in memoria."""
+    movimenti = genera_righe(n)
+    giacenze = [{
+        'id': i + 1, 'prodotto_id': i + 1, 'magazzino_id': 1,
+        'ubicazione': 'BENCH-A', 'stato': STATO_ORIGINE, 'quantita': 10, 'note': None
+    } for i in range(n)]
+
+    inizio = time.perf_counter()
+    righe, errori = normalizza_movimenti(movimenti)
+    errori, piano = pianifica_movimenti(righe, STATO_ORIGINE, giacenze, user_id=1)
+    durata = time.perf_counter() - inizio
+
+    assert not errori, errori
+    print(f"  {n:>5} righe | pianificazione in memoria: {durata * 1000:8.2f} ms | "
+          f"update: {len(piano['aggiornamenti'])}, insert: {len(piano['inserimenti'])}")
+
+
+def esegui_legacy(cursor, movimenti, user_id):
+    """Percorso precedente: validazione e 5-6 istruzioni per ogni riga."""
+    for mov in movimenti:
+        cursor.execute("""
+            SELECT quantita FROM giacenze
+            WHERE prodotto_id = %s AND stato = %s AND ubicazione = %s
+        """, (mov['prodotto_id'], STATO_ORIGINE, mov['da_ubicazione']))
+        cursor.fetchone()
+
+    for mov in movimenti:
+        cursor.execute("SELECT magazzino_id FROM giacenze WHERE prodotto_id = %s LIMIT 1", (mov['prodotto_id'],))
+        mag_result = cursor.fetchone()
+        magazzino_id = mag_result['magazzino_id'] if mag_result else None
+        cursor.execute("""
+            INSERT INTO movimenti (
+                prodotto_id, da_magazzino_id, a_magazzino_id,
+                da_ubicazione, a_ubicazione, quantita, note,
+                user_id, stato, tipo_movimento
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (mov['prodotto_id'], magazzino_id, magazzino_id, mov['da_ubicazione'], mov['a_ubicazione'],
+              mov['quantita'], mov['nota'], user_id, mov['stato_destinazione'], 'TRASFERIMENTO'))
+        cursor.execute("""
+            SELECT id, quantita FROM giacenze
+            WHERE prodotto_id = %s AND stato = %s AND ubicazione = %s
+        """, (mov['prodotto_id'], STATO_ORIGINE, mov['da_ubicazione']))
+        origine = cursor.fetchone()
+        cursor.execute("UPDATE giacenze SET quantita = %s WHERE id = %s", (origine['quantita'] - mov['quantita'], origine['id']))
+        cursor.execute("""
+            SELECT id, quantita FROM giacenze
+            WHERE prodotto_id = %s AND stato = %s
+            AND (ubicazione = %s OR (ubicazione IS NULL AND %s IS NULL))
+            AND (note = %s OR (note IS NULL AND %s IS NULL) OR (note = '' AND %s = ''))
+        """, (mov['prodotto_id'], mov['stato_destinazione'], mov['a_ubicazione'], mov['a_ubicazione'],
+              mov['nota'], mov['nota'], mov['nota']))
+        destinazione = cursor.fetchone()
+        if destinazione:
+            cursor.execute("UPDATE giacenze SET quantita = quantita + %s WHERE id = %s", (mov['quantita'], destinazione['id']))
+        else:
+            cursor.execute("""
+                INSERT INTO giacenze (prodotto_id, magazzino_id, ubicazione, stato, quantita, note)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (mov['prodotto_id'], magazzino_id, mov['a_ubicazione'], mov['stato_destinazione'], mov['quantita'], mov['nota']))
+
+
+def esegui_set_based(cursor, movimenti, user_id):
+    """Percorso set-based usato da /api/movimento-multiplo/execute."""
+    righe, errori = normalizza_movimenti(movimenti)
+    assert not errori, errori
+    giacenze = carica_giacenze_coinvolte(
+        cursor, [r['prodotto_id'] for r in righe], {STATO_ORIGINE, STATO_DESTINAZIONE}
+    )
+    errori, piano = pianifica_movimenti(righe, STATO_ORIGINE, giacenze, user_id)
+    assert not errori, errori
+    applica_piano(cursor, piano)
+
+
+def prepara_dati(cursor, n):
+    """Crea n prodotti di test con una giacenza ciascuno (dentro la transazione)."""
+    cursor.execute("SELECT id FROM magazzini ORDER BY id LIMIT 1")
+    magazzino_id = cursor.fetchone()['id']
+    cursor.execute("SELECT id FROM utenti ORDER BY id LIMIT 1")
+    user_id = cursor.fetchone()['id']
+
+    codice_base = f"BENCH-{int(time.time())}"
+    cursor.executemany(
+        "INSERT INTO prodotti (codice_prodotto, nome_prodotto) VALUES (%s, %s)",
+        [(f"{codice_base}-{i}", f"Prodotto benchmark {i}") for i in range(n)]
+    )
+    cursor.execute("SELECT id FROM prodotti WHERE codice_prodotto LIKE %s ORDER BY id", (f"{codice_base}-%",))
+    prodotto_ids = [row['id'] for row in cursor.fetchall()]
+    cursor.executemany("""
+        INSERT INTO giacenze (prodotto_id, magazzino_id, ubicazione, stato, quantita)
+        VALUES (%s, %s, 'BENCH-A', %s, 10)
+    """, [(pid, magazzino_id, STATO_ORIGINE) for pid in prodotto_ids])
+    return prodotto_ids, user_id
+
+
+def benchmark_database(n):
+    from database_connection import connect_to_database
+
+    risultati = {}
+    for nome, funzione in (('legacy', esegui_legacy), ('set-based', esegui_set_based)):
+        conn = connect_to_database()
+        conn.autocommit = False
+        cursor = conn.cursor(dictionary=True, buffered=True)
+        try:
+            prodotto_ids, user_id = prepara_dati(cursor, n)
+            movimenti = genera_righe(n, prodotto_ids)
+            contatore = CursorContatore(cursor)
+
+            inizio = time.perf_counter()
+            funzione(contatore, movimenti, user_id)
+            risultati[nome] = (time.perf_counter() - inizio, contatore.istruzioni)
+        finally:
+            conn.rollback()
+            cursor.close()
+            conn.close()
+
+    for nome, (durata, istruzioni) in risultati.items():
+        print(f"  {n:>5} righe | {nome:<9} | {durata * 1000:9.2f} ms | {istruzioni:>6} istruzioni")
+
+
+if __name__ == '__main__':
+    print("=== PIANIFICAZIONE IN MEMORIA ===")
+    for n in DIMENSIONI:
+        benchmark_pianificazione(n)
+
+    if '--db' in sys.argv:
+        print("\n=== DATABASE (ROLLBACK al termine) ===")
+        for n in DIMENSIONI:
+            benchmark_database(n)
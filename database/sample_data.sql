@@ -95,10 +95,10 @@ INSERT INTO `movimenti` (`prodotto_id`, `da_magazzino_id`, `a_magazzino_id`, `da
 -- =====================================================
 -- SAMPLE UNLOAD LOGS
 -- =====================================================
-INSERT INTO `log_scarichi` (`data_ora`, `user_id`, `prodotto_id`, `quantita`, `note`, `tipo_scarico`) VALUES
-(DATE_SUB(NOW(), INTERVAL 7 DAY), 1, 1, 25, 'Customer order #1234', 'VENDITA'),
-(DATE_SUB(NOW(), INTERVAL 5 DAY), 1, 3, 50, 'Internal project use', 'USO_INTERNO'),
-(DATE_SUB(NOW(), INTERVAL 3 DAY), 2, 2, 25, 'Customer order #1235', 'VENDITA');
+INSERT INTO `stock_ledger` (`data_ora`, `user_id`, `prodotto_id`, `quantita`, `note`, `tipo_movimento`, `tipo_scarico`) VALUES
+(DATE_SUB(NOW(), INTERVAL 7 DAY), 1, 1, 25, 'Customer order #1234', 'SCARICO', 'VENDITA'),
+(DATE_SUB(NOW(), INTERVAL 5 DAY), 1, 3, 50, 'Internal project use', 'SCARICO', 'USO_INTERNO'),
+(DATE_SUB(NOW(), INTERVAL 3 DAY), 2, 2, 25, 'Customer order #1235', 'SCARICO', 'VENDITA');
 
 -- =====================================================
 -- SAMPLE THRESHOLDS
@@ -51,54 +51,138 @@ CREATE TABLE IF NOT EXISTS `giacenze` (
     `stato` VARCHAR(50) DEFAULT 'IN_MAGAZZINO',
     `quantita` INT NOT NULL DEFAULT 0,
     `note` TEXT,
+    -- Incremented on every write (optimistic concurrency control)
+    `version` INT UNSIGNED NOT NULL DEFAULT 0,
     `created_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
     `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    -- Natural merge key: NULL and empty string are equivalent
+    `ubicazione_norm` VARCHAR(100) GENERATED ALWAYS AS (COALESCE(`ubicazione`, '')) STORED,
+    `note_hash` CHAR(32) GENERATED ALWAYS AS (MD5(COALESCE(`note`, ''))) STORED,
     FOREIGN KEY (`prodotto_id`) REFERENCES `prodotti`(`id`) ON DELETE CASCADE,
     FOREIGN KEY (`magazzino_id`) REFERENCES `magazzini`(`id`) ON DELETE SET NULL,
+    UNIQUE KEY `uq_giacenza_merge` (`prodotto_id`, `magazzino_id`, `ubicazione_norm`, `stato`, `note_hash`),
     INDEX `idx_prodotto` (`prodotto_id`),
     INDEX `idx_magazzino` (`magazzino_id`),
     INDEX `idx_ubicazione` (`ubicazione`),
     INDEX `idx_stato` (`stato`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
--- Movement history log
-CREATE TABLE IF NOT EXISTS `movimenti` (
-    `id` INT AUTO_INCREMENT PRIMARY KEY,
+-- Change feed for giacenze (delta sync, filled by triggers)
+CREATE TABLE IF NOT EXISTS `giacenze_changes` (
+    `seq` BIGINT AUTO_INCREMENT PRIMARY KEY,
+    `giacenza_id` INT NOT NULL,
+    `operazione` CHAR(1) NOT NULL,
+    `changed_at` DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    INDEX `idx_changed_at` (`changed_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+DROP TRIGGER IF EXISTS `trg_giacenze_changes_insert`;
+DROP TRIGGER IF EXISTS `trg_giacenze_changes_update`;
+DROP TRIGGER IF EXISTS `trg_giacenze_changes_delete`;
+
+CREATE TRIGGER `trg_giacenze_changes_insert` AFTER INSERT ON `giacenze`
+FOR EACH ROW INSERT INTO `giacenze_changes` (`giacenza_id`, `operazione`) VALUES (NEW.`id`, 'I');
+
+CREATE TRIGGER `trg_giacenze_changes_update` AFTER UPDATE ON `giacenze`
+FOR EACH ROW INSERT INTO `giacenze_changes` (`giacenza_id`, `operazione`) VALUES (NEW.`id`, 'U');
+
+CREATE TRIGGER `trg_giacenze_changes_delete` AFTER DELETE ON `giacenze`
+FOR EACH ROW INSERT INTO `giacenze_changes` (`giacenza_id`, `operazione`) VALUES (OLD.`id`, 'D');
+
+-- Data version counters for the export cache ('anagrafica': products, warehouses, usernames)
+CREATE TABLE IF NOT EXISTS `versioni_dati` (
+    `nome` VARCHAR(50) PRIMARY KEY,
+    `versione` BIGINT NOT NULL DEFAULT 0,
+    `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+INSERT IGNORE INTO `versioni_dati` (`nome`, `versione`) VALUES ('anagrafica', 0);
+
+DROP TRIGGER IF EXISTS `trg_versione_prodotti_update`;
+DROP TRIGGER IF EXISTS `trg_versione_prodotti_delete`;
+DROP TRIGGER IF EXISTS `trg_versione_magazzini_update`;
+DROP TRIGGER IF EXISTS `trg_versione_magazzini_delete`;
+DROP TRIGGER IF EXISTS `trg_versione_utenti_update`;
+DROP TRIGGER IF EXISTS `trg_versione_utenti_delete`;
+
+CREATE TRIGGER `trg_versione_prodotti_update` AFTER UPDATE ON `prodotti`
+FOR EACH ROW UPDATE `versioni_dati` SET `versione` = `versione` + 1 WHERE `nome` = 'anagrafica';
+
+CREATE TRIGGER `trg_versione_prodotti_delete` AFTER DELETE ON `prodotti`
+FOR EACH ROW UPDATE `versioni_dati` SET `versione` = `versione` + 1 WHERE `nome` = 'anagrafica';
+
+CREATE TRIGGER `trg_versione_magazzini_update` AFTER UPDATE ON `magazzini`
+FOR EACH ROW UPDATE `versioni_dati` SET `versione` = `versione` + 1 WHERE `nome` = 'anagrafica';
+
+CREATE TRIGGER `trg_versione_magazzini_delete` AFTER DELETE ON `magazzini`
+FOR EACH ROW UPDATE `versioni_dati` SET `versione` = `versione` + 1 WHERE `nome` = 'anagrafica';
+
+CREATE TRIGGER `trg_versione_utenti_update` AFTER UPDATE ON `utenti`
+FOR EACH ROW UPDATE `versioni_dati` SET `versione` = `versione` + 1
+WHERE `nome` = 'anagrafica' AND NOT (NEW.`username` <=> OLD.`username`);
+
+CREATE TRIGGER `trg_versione_utenti_delete` AFTER DELETE ON `utenti`
+FOR EACH ROW UPDATE `versioni_dati` SET `versione` = `versione` + 1 WHERE `nome` = 'anagrafica';
+
+-- Stock ledger: one append-only row per stock movement (loads, unloads, transfers, edits).
+-- Partitioned by month on data_ora: partitioned tables allow no foreign keys and no
+-- FULLTEXT index, and the primary key must include data_ora.
+-- After creating it run `python -m utils.ledger_archive crea` (monthly partitions).
+CREATE TABLE IF NOT EXISTS `stock_ledger` (
+    `id` INT AUTO_INCREMENT,
+    `data_ora` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    `tipo_movimento` VARCHAR(50) DEFAULT 'TRASFERIMENTO',
     `prodotto_id` INT NOT NULL,
+    `quantita` INT NOT NULL,
+    -- Signed stock change: + CARICO, - SCARICO, 0 for transfers and edits
+    `quantita_netta` INT GENERATED ALWAYS AS (
+        CASE `tipo_movimento` WHEN 'CARICO' THEN `quantita` WHEN 'SCARICO' THEN -`quantita` ELSE 0 END
+    ) STORED,
     `da_magazzino_id` INT,
     `a_magazzino_id` INT,
     `da_ubicazione` VARCHAR(100),
     `a_ubicazione` VARCHAR(100),
-    `quantita` INT NOT NULL,
-    `note` TEXT,
-    `data_ora` DATETIME DEFAULT CURRENT_TIMESTAMP,
-    `user_id` INT,
     `stato` VARCHAR(50),
-    `tipo_movimento` VARCHAR(50) DEFAULT 'TRASFERIMENTO',
-    FOREIGN KEY (`prodotto_id`) REFERENCES `prodotti`(`id`) ON DELETE CASCADE,
-    FOREIGN KEY (`da_magazzino_id`) REFERENCES `magazzini`(`id`) ON DELETE SET NULL,
-    FOREIGN KEY (`a_magazzino_id`) REFERENCES `magazzini`(`id`) ON DELETE SET NULL,
-    FOREIGN KEY (`user_id`) REFERENCES `utenti`(`id`) ON DELETE SET NULL,
-    INDEX `idx_prodotto` (`prodotto_id`),
-    INDEX `idx_data` (`data_ora`),
-    INDEX `idx_user` (`user_id`),
-    INDEX `idx_tipo` (`tipo_movimento`)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
-
--- Unload/Dispatch logs
-CREATE TABLE IF NOT EXISTS `log_scarichi` (
-    `id` INT AUTO_INCREMENT PRIMARY KEY,
-    `data_ora` DATETIME DEFAULT CURRENT_TIMESTAMP,
-    `user_id` INT,
-    `prodotto_id` INT NOT NULL,
-    `quantita` INT NOT NULL,
     `note` TEXT,
+    -- Set for unloads from scaricomerce / scarico_merce_non_in_magazzino
     `tipo_scarico` VARCHAR(50),
-    FOREIGN KEY (`user_id`) REFERENCES `utenti`(`id`) ON DELETE SET NULL,
-    FOREIGN KEY (`prodotto_id`) REFERENCES `prodotti`(`id`) ON DELETE CASCADE,
-    INDEX `idx_data` (`data_ora`),
-    INDEX `idx_prodotto` (`prodotto_id`)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    `user_id` INT,
+    PRIMARY KEY (`id`, `data_ora`),
+    -- Movement log filters, keyset-paginated on (data_ora, id)
+    INDEX `idx_ledger_data` (`data_ora`),
+    INDEX `idx_ledger_prodotto_data` (`prodotto_id`, `data_ora`),
+    INDEX `idx_ledger_utente_data` (`user_id`, `data_ora`),
+    INDEX `idx_ledger_da_magazzino_data` (`da_magazzino_id`, `data_ora`),
+    INDEX `idx_ledger_a_magazzino_data` (`a_magazzino_id`, `data_ora`),
+    INDEX `idx_ledger_tipo_data` (`tipo_movimento`, `data_ora`),
+    -- Covering index for the period statistics
+    INDEX `idx_ledger_statistiche` (`data_ora`, `tipo_movimento`, `quantita`, `prodotto_id`, `user_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+PARTITION BY RANGE COLUMNS (`data_ora`) (
+    PARTITION `pmax` VALUES LESS THAN (MAXVALUE)
+);
+
+DROP TRIGGER IF EXISTS `trg_stock_ledger_no_update`;
+DROP TRIGGER IF EXISTS `trg_stock_ledger_no_delete`;
+
+CREATE TRIGGER `trg_stock_ledger_no_update` BEFORE UPDATE ON `stock_ledger`
+FOR EACH ROW SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'stock_ledger è append-only';
+
+CREATE TRIGGER `trg_stock_ledger_no_delete` BEFORE DELETE ON `stock_ledger`
+FOR EACH ROW SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'stock_ledger è append-only';
+
+-- Compatibility views with the old table names and columns.
+-- movimenti is updatable: INSERT INTO movimenti writes to the ledger
+CREATE OR REPLACE ALGORITHM = MERGE VIEW `movimenti` AS
+SELECT `id`, `prodotto_id`, `da_magazzino_id`, `a_magazzino_id`, `da_ubicazione`, `a_ubicazione`,
+       `quantita`, `note`, `data_ora`, `user_id`, `stato`, `tipo_movimento`
+FROM `stock_ledger`;
+
+-- Unload log (read-only)
+CREATE OR REPLACE ALGORITHM = MERGE VIEW `log_scarichi` AS
+SELECT `id`, `data_ora`, `user_id`, `prodotto_id`, `quantita`, `note`, `tipo_scarico`
+FROM `stock_ledger`
+WHERE `tipo_scarico` IS NOT NULL;
 
 -- =====================================================
 -- CHANGELOG & VERSIONING
@@ -123,6 +207,8 @@ CREATE TABLE IF NOT EXISTS `changelogs` (
 -- Product threshold alerts
 CREATE TABLE IF NOT EXISTS `product_thresholds` (
     `id` INT AUTO_INCREMENT PRIMARY KEY,
+    `prodotto_id` INT NOT NULL,
+    -- Informational copies; joins use prodotto_id
     `codice_prodotto` VARCHAR(50) NOT NULL,
     `nome_prodotto` VARCHAR(255) NOT NULL,
     `soglia_minima` INT NOT NULL DEFAULT 0,
@@ -130,7 +216,10 @@ CREATE TABLE IF NOT EXISTS `product_thresholds` (
     `user_id` INT,
     `data_creazione` DATETIME DEFAULT CURRENT_TIMESTAMP,
     `data_modifica` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-    UNIQUE KEY `unique_product` (`codice_prodotto`),
+    FOREIGN KEY (`prodotto_id`) REFERENCES `prodotti`(`id`) ON DELETE CASCADE,
+    FOREIGN KEY (`user_id`) REFERENCES `utenti`(`id`) ON DELETE CASCADE,
+    UNIQUE KEY `unique_user_prodotto` (`user_id`, `prodotto_id`),
+    INDEX `idx_threshold_prodotto` (`prodotto_id`, `notifica_attiva`),
     INDEX `idx_codice` (`codice_prodotto`),
     INDEX `idx_attiva` (`notifica_attiva`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
@@ -138,6 +227,7 @@ CREATE TABLE IF NOT EXISTS `product_thresholds` (
 -- Generated notifications
 CREATE TABLE IF NOT EXISTS `notifications` (
     `id` INT AUTO_INCREMENT PRIMARY KEY,
+    `user_id` INT NOT NULL,
     `codice_prodotto` VARCHAR(50) NOT NULL,
     `nome_prodotto` VARCHAR(255) NOT NULL,
     `quantita_attuale` INT NOT NULL,
@@ -146,9 +236,58 @@ CREATE TABLE IF NOT EXISTS `notifications` (
     `data_notifica` DATETIME DEFAULT CURRENT_TIMESTAMP,
     `visualizzata` BOOLEAN DEFAULT FALSE,
     `data_visualizzazione` DATETIME NULL,
+    -- Unread threshold notification key: one unread notification per user/product
+    `codice_non_letto` VARCHAR(50) GENERATED ALWAYS AS (
+        CASE WHEN `visualizzata` = FALSE AND `codice_prodotto` NOT LIKE '[%' THEN `codice_prodotto` END
+    ) STORED,
+    FOREIGN KEY (`user_id`) REFERENCES `utenti`(`id`) ON DELETE CASCADE,
+    UNIQUE KEY `uq_notifica_non_letta` (`user_id`, `codice_non_letto`),
     INDEX `idx_codice` (`codice_prodotto`),
-    INDEX `idx_visualizzata` (`visualizzata`),
-    INDEX `idx_data` (`data_notifica`)
+    -- Unread feed: WHERE user_id = ? AND visualizzata = FALSE ORDER BY data_notifica DESC
+    INDEX `idx_notifiche_utente` (`user_id`, `visualizzata`, `data_notifica`),
+    INDEX `idx_data` (`data_notifica`),
+    -- Read notifications detected by the in-memory version watcher
+    INDEX `idx_data_visualizzazione` (`data_visualizzazione`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Read notifications moved out of the hot table by utils/notification_archive.py
+CREATE TABLE IF NOT EXISTS `notifications_archive` (
+    `id` INT PRIMARY KEY,
+    `user_id` INT NOT NULL,
+    `codice_prodotto` VARCHAR(50) NOT NULL,
+    `nome_prodotto` VARCHAR(255) NOT NULL,
+    `quantita_attuale` INT NOT NULL,
+    `soglia_minima` INT NOT NULL,
+    `magazzino` VARCHAR(100),
+    `data_notifica` DATETIME,
+    `visualizzata` BOOLEAN DEFAULT TRUE,
+    `data_visualizzazione` DATETIME NULL,
+    `archiviata_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
+    INDEX `idx_archivio_utente` (`user_id`, `data_notifica`),
+    INDEX `idx_archivio_data` (`archiviata_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Admin broadcasts: one row per broadcast, merged into the feed at read time
+CREATE TABLE IF NOT EXISTS `broadcasts` (
+    `id` INT AUTO_INCREMENT PRIMARY KEY,
+    `titolo` VARCHAR(255) NOT NULL,
+    `messaggio` TEXT NOT NULL,
+    `tipo` VARCHAR(20) NOT NULL DEFAULT 'info',
+    `created_by` INT NULL,
+    `created_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (`created_by`) REFERENCES `utenti`(`id`) ON DELETE SET NULL,
+    INDEX `idx_broadcasts_data` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Per-user broadcast read receipts
+CREATE TABLE IF NOT EXISTS `broadcast_reads` (
+    `user_id` INT NOT NULL,
+    `broadcast_id` INT NOT NULL,
+    `letto_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`user_id`, `broadcast_id`),
+    FOREIGN KEY (`user_id`) REFERENCES `utenti`(`id`) ON DELETE CASCADE,
+    FOREIGN KEY (`broadcast_id`) REFERENCES `broadcasts`(`id`) ON DELETE CASCADE,
+    INDEX `idx_broadcast_reads_data` (`letto_at`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- =====================================================
@@ -160,16 +299,89 @@ CREATE TABLE IF NOT EXISTS `movimenti_batch_draft` (
     `id` INT AUTO_INCREMENT PRIMARY KEY,
     `user_id` INT NOT NULL,
     `nome_bozza` VARCHAR(100) NOT NULL,
-    `json_items` JSON NOT NULL,
+    `json_items` JSON NULL,
     `nota_globale` TEXT,
     `stato_origine` VARCHAR(50),
     `stato_destinazione` VARCHAR(50),
+    `num_righe` INT NOT NULL DEFAULT 0,
+    `quantita_totale` INT NOT NULL DEFAULT 0,
+    `num_prodotti` INT NOT NULL DEFAULT 0,
     `created_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
     `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     FOREIGN KEY (`user_id`) REFERENCES `utenti`(`id`) ON DELETE CASCADE,
     INDEX `idx_user_created` (`user_id`, `created_at`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- Draft lines (one row per line, patched incrementally by autosave)
+CREATE TABLE IF NOT EXISTS `movimenti_batch_draft_righe` (
+    `id` INT AUTO_INCREMENT PRIMARY KEY,
+    `draft_id` INT NOT NULL,
+    `riga_key` VARCHAR(64) NOT NULL,
+    `prodotto_id` INT NOT NULL,
+    `quantita` INT NOT NULL DEFAULT 0,
+    `dati` TEXT NOT NULL,
+    FOREIGN KEY (`draft_id`) REFERENCES `movimenti_batch_draft`(`id`) ON DELETE CASCADE,
+    UNIQUE KEY `uq_draft_riga` (`draft_id`, `riga_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Idempotency keys for offline operations synced by handhelds (/api/sync)
+CREATE TABLE IF NOT EXISTS `sync_operations` (
+    `id` BIGINT AUTO_INCREMENT PRIMARY KEY,
+    `user_id` INT NOT NULL,
+    `idempotency_key` VARCHAR(64) NOT NULL,
+    `tipo` VARCHAR(30),
+    `stato` VARCHAR(20) NOT NULL,
+    `risultato` TEXT NOT NULL,
+    `created_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (`user_id`) REFERENCES `utenti`(`id`) ON DELETE CASCADE,
+    UNIQUE KEY `uq_sync_operation` (`user_id`, `idempotency_key`),
+    INDEX `idx_created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Transactional outbox: stock events written in the same transaction as the change
+CREATE TABLE IF NOT EXISTS `outbox_events` (
+    `id` BIGINT AUTO_INCREMENT PRIMARY KEY,
+    `tipo_evento` VARCHAR(30) NOT NULL,
+    `prodotto_id` INT NULL,
+    `quantita` INT NULL,
+    `user_id` INT NULL,
+    `payload` TEXT NULL,
+    `created_at` DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    INDEX `idx_created_at` (`created_at`),
+    INDEX `idx_prodotto` (`prodotto_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Outbox consumer checkpoints (last processed event id)
+CREATE TABLE IF NOT EXISTS `outbox_consumers` (
+    `consumer` VARCHAR(50) PRIMARY KEY,
+    `ultimo_id` BIGINT NOT NULL DEFAULT 0,
+    `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Asynchronous export jobs (/api/jobs); `chiave` deduplicates identical requests
+CREATE TABLE IF NOT EXISTS `export_jobs` (
+    `id` CHAR(32) PRIMARY KEY,
+    `chiave` CHAR(64) NULL,
+    `tipo` VARCHAR(30) NOT NULL,
+    `parametri` TEXT NOT NULL,
+    `user_id` INT NOT NULL,
+    `stato` VARCHAR(20) NOT NULL DEFAULT 'IN_CODA',
+    `progresso` TINYINT UNSIGNED NOT NULL DEFAULT 0,
+    `file` VARCHAR(255) NULL,
+    `errore` TEXT NULL,
+    `created_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
+    `started_at` DATETIME NULL,
+    `finished_at` DATETIME NULL,
+    `expires_at` DATETIME NULL,
+    -- Owning app process and its liveness: orphaned jobs are failed
+    `processo` CHAR(32) NULL,
+    `heartbeat_at` DATETIME NULL,
+    FOREIGN KEY (`user_id`) REFERENCES `utenti`(`id`) ON DELETE CASCADE,
+    UNIQUE KEY `uq_export_job_chiave` (`chiave`),
+    INDEX `idx_export_jobs_scadenza` (`expires_at`),
+    INDEX `idx_export_jobs_stato` (`stato`, `heartbeat_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 SET FOREIGN_KEY_CHECKS = 1;
 
 -- =====================================================
@@ -1,12 +1,24 @@
 """
 Routes per il pannello amministratore.
 """
+from datetime import datetime, timedelta
+from itertools import islice
+
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
 from database_connection import connect_to_database
 from utils.decorators import admin_required, api_admin_required
+from utils.transactions import get_metriche_transazioni
+from utils.outbox import leggi_eventi, conferma_eventi, stato_outbox, LIMITE_DEFAULT as LIMITE_OUTBOX
+from utils.notification_worker import get_metriche_worker
+from utils.notification_archive import stato_archivio
+from utils.ledger_archive import stato_archivio_movimenti, leggi_archivio
+from utils.notifications import crea_broadcast, broadcast_recenti, conta_broadcast_oggi
+from utils import notification_bus
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+LIMITE_ARCHIVIO_MOVIMENTI = 1000
+
 
 @admin_bp.route('')
 @admin_required
@@ -24,31 +36,9 @@ def admin_panel():
         cursor.execute("SELECT COUNT(*) as total FROM utenti WHERE is_admin = TRUE")
         total_admins = cursor.fetchone()['total']
         
-        # Conta notifiche inviate oggi (broadcast iniziano con [])
-        cursor.execute("""
-            SELECT COUNT(DISTINCT id) as total FROM notifications 
-            WHERE DATE(data_notifica) = CURDATE() AND codice_prodotto LIKE '[%'
-        """)
-        notifications_today = cursor.fetchone()['total']
-        
-        # Ultimi broadcast (notifiche con [TIPO] nel codice_prodotto)
-        cursor.execute("""
-            SELECT codice_prodotto as riferimento, 
-                   nome_prodotto as messaggio,
-                   data_notifica,
-                   CASE 
-                     WHEN magazzino = 'info' THEN 'info'
-                     WHEN magazzino = 'success' THEN 'success'
-                     WHEN magazzino = 'warning' THEN 'warning'
-                     WHEN magazzino = 'error' THEN 'error'
-                     ELSE 'info'
-                   END as tipo
-            FROM notifications
-            WHERE codice_prodotto LIKE '[%'
-            ORDER BY data_notifica DESC
-            LIMIT 5
-        """)
-        recent_broadcasts = cursor.fetchall()
+        # Broadcast inviati oggi e ultimi broadcast (tabella broadcasts, indice su created_at)
+        notifications_today = conta_broadcast_oggi(cursor)
+        recent_broadcasts = broadcast_recenti(cursor)
         
     except Exception as e:
         flash(f'Errore nel caricamento statistiche: {e}', 'error')
@@ -111,26 +101,21 @@ def admin_broadcast():
         conn = connect_to_database()
         cursor = conn.cursor()
         
-        # Ottieni tutti gli utenti
-        cursor.execute("SELECT id FROM utenti")
-        users = cursor.fetchall()
+        cursor.execute("SELECT COUNT(*) FROM utenti")
+        num_utenti = cursor.fetchone()[0]
         
-        if not users:
+        if not num_utenti:
             return jsonify({'success': False, 'message': 'Nessun utente trovato'}), 400
         
-        # Crea notifica per ogni utente usando i campi esistenti
-        for user in users:
-            cursor.execute("""
-                INSERT INTO notifications 
-                (user_id, codice_prodotto, nome_prodotto, quantita_attuale, soglia_minima, magazzino, visualizzata)
-                VALUES (%s, %s, %s, 0, 0, %s, FALSE)
-            """, (user[0], f'[{tipo.upper()}] {titolo}', messaggio, tipo))
+        # Una sola riga: il broadcast viene unito al feed di ogni utente in lettura
+        crea_broadcast(cursor, titolo, messaggio, tipo, session.get('user_id'))
         
         conn.commit()
+        notification_bus.pubblica()
         
         return jsonify({
             'success': True, 
-            'message': f'Notifica inviata a {len(users)} utenti'
+            'message': f'Notifica inviata a {num_utenti} utenti'
         })
         
     except Exception as e:
@@ -140,3 +125,125 @@ def admin_broadcast():
             cursor.close()
         if 'conn' in locals():
             conn.close()
+
+
+@admin_bp.route('/api/metriche-transazioni')
+@api_admin_required
+def admin_metriche_transazioni():
+    """Metriche dei retry su deadlock / lock timeout delle transazioni di scrittura."""
+    return jsonify({'success': True, 'metriche': get_metriche_transazioni()})
+
+
+@admin_bp.route('/api/metriche-notifiche')
+@api_admin_required
+def admin_metriche_notifiche():
+    """Metriche del worker notifiche: eventi in coda, ritardo, notifiche create, errori."""
+    return jsonify({'success': True, 'metriche': get_metriche_worker()})
+
+
+@admin_bp.route('/api/notifiche-archivio')
+@api_admin_required
+def admin_notifiche_archivio():
+    """Notifiche attive, lette, da archiviare e archiviate (retention in notifications_archive)."""
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        return jsonify({'success': True, 'archivio': stato_archivio(cursor)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Errore: {str(e)}'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@admin_bp.route('/api/movimenti-partizioni')
+@api_admin_required
+def admin_movimenti_partizioni():
+    """Partizioni mensili di stock_ledger e mesi archiviati su disco."""
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        return jsonify({'success': True, **stato_archivio_movimenti(cursor)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Errore: {str(e)}'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@admin_bp.route('/api/movimenti-archiviati')
+@api_admin_required
+def admin_movimenti_archiviati():
+    """
+    Movimenti dei mesi archiviati (file su disco, non più nel database):
+    data_da / data_a (AAAA-MM-GG) obbligatorie, prodotto_id, user_id, tipo facoltativi.
+    """
+    try:
+        data_da = datetime.strptime(request.args['data_da'], '%Y-%m-%d')
+        data_a = datetime.strptime(request.args['data_a'], '%Y-%m-%d') + timedelta(days=1)
+        prodotto_id = int(request.args['prodotto_id']) if request.args.get('prodotto_id') else None
+        user_id = int(request.args['user_id']) if request.args.get('user_id') else None
+        limite = min(int(request.args.get('limit', LIMITE_ARCHIVIO_MOVIMENTI)), LIMITE_ARCHIVIO_MOVIMENTI)
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'error': 'Parametri non validi (data_da e data_a nel formato AAAA-MM-GG)'}), 400
+
+    righe = list(islice(leggi_archivio(data_da, data_a, prodotto_id, user_id,
+                                       (request.args.get('tipo') or '').upper() or None), limite + 1))
+    for riga in righe:
+        riga['data_ora'] = riga['data_ora'].isoformat()
+    return jsonify({'success': True, 'movimenti': righe[:limite], 'troncato': len(righe) > limite})
+
+
+@admin_bp.route('/api/outbox')
+@api_admin_required
+def admin_outbox_stato():
+    """Stato dell'outbox: ultimo evento e checkpoint / arretrato di ogni consumer."""
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        return jsonify({'success': True, **stato_outbox(cursor)})
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@admin_bp.route('/api/outbox/<consumer>/eventi')
+@api_admin_required
+def admin_outbox_eventi(consumer):
+    """
+    Consumer API per worker esterni: eventi successivi al checkpoint, in ordine.
+    Dopo averli elaborati il worker conferma `ack` con POST .../ack.
+    """
+    try:
+        limite = int(request.args.get('limit', LIMITE_OUTBOX))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Parametro limit non valido'}), 400
+
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        return jsonify({'success': True, **leggi_eventi(cursor, consumer[:50], limite)})
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@admin_bp.route('/api/outbox/<consumer>/ack', methods=['POST'])
+@api_admin_required
+def admin_outbox_ack(consumer):
+    """Conferma gli eventi elaborati fino a `ultimo_id` (il checkpoint non torna mai indietro)."""
+    data = request.get_json(silent=True) or {}
+    try:
+        ultimo_id = int(data.get('ultimo_id'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'ultimo_id mancante o non valido'}), 400
+
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        conferma_eventi(cursor, consumer[:50], ultimo_id)
+        conn.commit()
+        return jsonify({'success': True})
+    finally:
+        cursor.close()
+        conn.close()
@@ -0,0 +1,139 @@
+"""
+Routes dei job asincroni di esportazione (/api/jobs/*) e tipi di job registrati.
+"""
+from datetime import date, datetime
+
+from flask import Blueprint, current_app, request, jsonify, session, send_file, url_for
+
+from database_connection import connect_to_database
+from utils.decorators import api_login_required
+from utils import export_cache
+from utils.export_magazzino import blocchi_giacenze, conta_giacenze, scrivi_xlsx
+from utils.jobs import (
+    registra_tipo, sottometti, leggi_job, stato_job, file_job, segna_interrotti, JobNonValido, COMPLETATO,
+)
+from routes.statistics import (
+    RANGE_VALIDI, get_date_range_from_param, scrivi_csv_movimenti, genera_pdf_statistiche,
+)
+
+jobs_bp = Blueprint('jobs', __name__)
+
+
+# ============================================================
+# TIPI DI JOB
+# ============================================================
+
+def _range_statistiche(parametri):
+    range_param = parametri.get('range', '30d')
+    if range_param not in RANGE_VALIDI:
+        raise JobNonValido('Periodo non valido')
+    return {'range': range_param}
+
+
+def _versione_dati(parametri):
+    # Un job completato vale finché i dati (e il giorno, per i periodi) non cambiano
+    return f"{date.today().isoformat()}:{export_cache.leggi_versione()[0]}"
+
+
+def _xlsx_magazzino(percorso, parametri, avanzamento):
+    totale = conta_giacenze() or 1
+
+    def blocchi():
+        lette = 0
+        for righe in blocchi_giacenze():
+            lette += len(righe)
+            avanzamento(lette * 100 / totale)
+            yield righe
+
+    scrivi_xlsx(percorso, blocchi())
+
+
+def _csv_statistiche(percorso, parametri, avanzamento):
+    start_date, end_date = get_date_range_from_param(parametri['range'])
+    scrivi_csv_movimenti(percorso, start_date, end_date, avanzamento)
+
+
+def _pdf_statistiche(percorso, parametri, avanzamento):
+    pdf = genera_pdf_statistiche(parametri['range'], avanzamento)
+    with open(percorso, 'wb') as file:
+        file.write(pdf)
+
+
+registra_tipo(
+    'magazzino_xlsx', _xlsx_magazzino, 'xlsx',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    lambda p: f"magazzino_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+    versione=_versione_dati)
+registra_tipo(
+    'statistiche_csv', _csv_statistiche, 'csv', 'text/csv; charset=utf-8',
+    lambda p: f"statistiche_{p['range']}_{datetime.now().strftime('%Y%m%d')}.csv",
+    normalizza=_range_statistiche, versione=_versione_dati)
+registra_tipo(
+    'statistiche_pdf', _pdf_statistiche, 'pdf', 'application/pdf',
+    lambda p: f"report_statistiche_{p['range']}_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf",
+    normalizza=_range_statistiche, versione=_versione_dati)
+
+
+# ============================================================
+# API
+# ============================================================
+
+@jobs_bp.route('/api/jobs', methods=['POST'])
+@api_login_required
+def api_job_sottometti():
+    """Crea un job (o riusa quello identico già esistente): {tipo, parametri} -> {job_id}."""
+    data = request.get_json(silent=True) or {}
+    try:
+        job_id, nuovo = sottometti(current_app._get_current_object(), data.get('tipo'),
+                                   data.get('parametri'), session['user_id'])
+    except JobNonValido as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Errore: {str(e)}'}), 500
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'nuovo': nuovo,
+        'stato_url': url_for('jobs.api_job_stato', job_id=job_id),
+        'download_url': url_for('jobs.api_job_download', job_id=job_id),
+    }), 202 if nuovo else 200
+
+
+@jobs_bp.route('/api/jobs/<job_id>')
+@api_login_required
+def api_job_stato(job_id):
+    """Stato e progresso del job."""
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        # Un job perso (processo riavviato) risulta subito in errore
+        segna_interrotti(cursor, job_id)
+        conn.commit()
+        job = leggi_job(cursor, job_id)
+    finally:
+        cursor.close()
+        conn.close()
+    if not job:
+        return jsonify({'success': False, 'error': 'Job non trovato o scaduto'}), 404
+    return jsonify({'success': True, **stato_job(job)})
+
+
+@jobs_bp.route('/api/jobs/<job_id>/download')
+@api_login_required
+def api_job_download(job_id):
+    """File generato dal job (409 se non è ancora completato)."""
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        job = leggi_job(cursor, job_id)
+    finally:
+        cursor.close()
+        conn.close()
+    if not job:
+        return jsonify({'success': False, 'error': 'Job non trovato o scaduto'}), 404
+    risultato = file_job(job)
+    if not risultato:
+        stato = 409 if job['stato'] != COMPLETATO else 410
+        return jsonify({'success': False, 'error': 'File non disponibile', **stato_job(job)}), stato
+    percorso, mimetype, download_name = risultato
+    return send_file(percorso, as_attachment=True, download_name=download_name, mimetype=mimetype, max_age=0)
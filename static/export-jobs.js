@@ -0,0 +1,69 @@
+/*
+ * Esportazioni asincrone (XLSX del magazzino, CSV e PDF delle statistiche).
+ *
+ * Il job viene creato con POST /api/jobs; lo stato viene interrogato ogni
+ * INTERVALLO_MS finché il file è pronto, poi parte il download. La pagina
+ * resta utilizzabile durante la generazione.
+ *
+ *   ExportJobs.avvia('statistiche_csv', { range: '30d' }, { onProgresso: p => ... })
+ *
+ * Se il job non può essere creato (es. endpoint non disponibile) si usa
+ * l'URL diretto passato in opzioni.fallback.
+ */
+(function (scope) {
+  'use strict';
+
+  const JOBS_URL = '/api/jobs';
+  const INTERVALLO_MS = 1000;
+  const TIMEOUT_MS = 30 * 60 * 1000;
+
+  function attendi(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+  }
+
+  function leggiJson(risposta) {
+    return risposta.json().catch(() => ({})).then(dati => {
+      if (!risposta.ok || dati.success === false) {
+        throw new Error(dati.error || ('HTTP ' + risposta.status));
+      }
+      return dati;
+    });
+  }
+
+  async function avvia(tipo, parametri, opzioni) {
+    opzioni = opzioni || {};
+    const onProgresso = opzioni.onProgresso || function () {};
+    let job;
+    try {
+      job = await fetch(JOBS_URL, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        credentials: 'same-origin',
+        body: JSON.stringify({ tipo: tipo, parametri: parametri || {} })
+      }).then(leggiJson);
+    } catch (errore) {
+      if (opzioni.fallback) {
+        window.location.href = opzioni.fallback;
+        return;
+      }
+      throw errore;
+    }
+
+    const inizio = Date.now();
+    while (Date.now() - inizio < TIMEOUT_MS) {
+      const stato = await fetch(job.stato_url, { credentials: 'same-origin' }).then(leggiJson);
+      onProgresso(stato.progresso, stato.stato);
+      if (stato.stato === 'COMPLETATO') {
+        window.location.href = job.download_url;
+        return stato;
+      }
+      if (stato.stato === 'ERRORE') {
+        throw new Error(stato.errore || 'Esportazione non riuscita');
+      }
+      await attendi(INTERVALLO_MS);
+    }
+    throw new Error('Esportazione troppo lunga, riprova più tardi');
+  }
+
+  scope.ExportJobs = { avvia: avvia };
+})(window);
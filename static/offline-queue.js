@@ -0,0 +1,146 @@
+/*
+ * Coda offline delle operazioni di scrittura (modifiche rapide, scarichi, movimenti).
+ *
+ * Le operazioni vengono salvate in IndexedDB con una chiave di idempotenza
+ * e inviate in blocco a POST /api/sync. L'operatore non attende la rete:
+ * la coda si svuota quando la connessione è disponibile (evento "online",
+ * timer periodico o Background Sync del service worker).
+ *
+ * Funziona sia nella pagina sia nel service worker (importScripts).
+ * Nella pagina ogni esito viene notificato con l'evento "offline-queue:esito".
+ */
+(function (scope) {
+  'use strict';
+
+  const DB_NOME = 'magazzino-offline';
+  const STORE = 'operazioni';
+  const SYNC_URL = '/api/sync';
+  const SYNC_TAG = 'sync-operazioni';
+  const MAX_BATCH = 200;
+  const INTERVALLO_MS = 15000;
+
+  let sincronizzazioneInCorso = null;
+
+  function apriDb() {
+    return new Promise((resolve, reject) => {
+      const richiesta = indexedDB.open(DB_NOME, 1);
+      richiesta.onupgradeneeded = () => {
+        richiesta.result.createObjectStore(STORE, { keyPath: 'seq', autoIncrement: true });
+      };
+      richiesta.onsuccess = () => resolve(richiesta.result);
+      richiesta.onerror = () => reject(richiesta.error);
+    });
+  }
+
+  function transazione(modalita, operazione) {
+    return apriDb().then(db => new Promise((resolve, reject) => {
+      const tx = db.transaction(STORE, modalita);
+      const risultato = operazione(tx.objectStore(STORE));
+      tx.oncomplete = () => { db.close(); resolve(risultato && risultato.result); };
+      tx.onerror = () => { db.close(); reject(tx.error); };
+    }));
+  }
+
+  function generaChiave() {
+    if (scope.crypto && scope.crypto.randomUUID) {
+      return scope.crypto.randomUUID();
+    }
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+  }
+
+  function inAttesa() {
+    return transazione('readonly', store => store.getAll());
+  }
+
+  function rimuovi(seqs) {
+    return transazione('readwrite', store => {
+      seqs.forEach(seq => store.delete(seq));
+    });
+  }
+
+  function notifica(esito, operazione) {
+    if (typeof scope.dispatchEvent === 'function' && typeof CustomEvent !== 'undefined' && scope.document) {
+      scope.dispatchEvent(new CustomEvent('offline-queue:esito', { detail: { esito, operazione } }));
+    }
+  }
+
+  function registraBackgroundSync() {
+    if (!scope.navigator || !scope.navigator.serviceWorker) return;
+    scope.navigator.serviceWorker.ready
+      .then(reg => reg.sync && reg.sync.register(SYNC_TAG))
+      .catch(() => {});
+  }
+
+  /**
+   * Accoda un'operazione e prova subito a sincronizzare.
+   * tipo: 'modifica_rapida' | 'scarico' | 'movimento'
+   */
+  function accoda(tipo, dati) {
+    const operazione = { id: generaChiave(), tipo, dati, creata: Date.now() };
+    return transazione('readwrite', store => store.add(operazione)).then(() => {
+      registraBackgroundSync();
+      sincronizza();
+      return operazione;
+    });
+  }
+
+  /**
+   * Invia le operazioni in attesa a /api/sync in blocchi da MAX_BATCH.
+   * Le operazioni restano in coda se la rete o il server non rispondono.
+   */
+  function sincronizza() {
+    if (sincronizzazioneInCorso) return sincronizzazioneInCorso;
+
+    sincronizzazioneInCorso = (async () => {
+      let inviate = 0;
+      while (true) {
+        const operazioni = (await inAttesa()).slice(0, MAX_BATCH);
+        if (!operazioni.length) break;
+
+        let risposta;
+        try {
+          risposta = await fetch(SYNC_URL, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+              operazioni: operazioni.map(op => ({ id: op.id, tipo: op.tipo, dati: op.dati }))
+            })
+          });
+        } catch (e) {
+          break; // offline: riprova più tardi
+        }
+        if (!risposta.ok) break;
+
+        const data = await risposta.json();
+        const perChiave = {};
+        operazioni.forEach(op => { perChiave[op.id] = op; });
+        data.risultati.forEach(esito => notifica(esito, perChiave[esito.id]));
+        await rimuovi(operazioni.map(op => op.seq));
+        inviate += operazioni.length;
+      }
+      return inviate;
+    })().finally(() => {
+      sincronizzazioneInCorso = null;
+    });
+    return sincronizzazioneInCorso;
+  }
+
+  function numeroInAttesa() {
+    return transazione('readonly', store => store.count());
+  }
+
+  scope.OfflineQueue = { accoda, sincronizza, numeroInAttesa, SYNC_TAG };
+
+  // Nella pagina: registra il service worker e sincronizza periodicamente
+  if (scope.document) {
+    if (scope.navigator.serviceWorker) {
+      scope.navigator.serviceWorker.register('/sw.js').catch(() => {});
+    }
+    scope.addEventListener('online', () => sincronizza());
+    scope.setInterval(() => {
+      if (scope.navigator.onLine) sincronizza();
+    }, INTERVALLO_MS);
+    sincronizza();
+  }
+})(self);
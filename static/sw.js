@@ -0,0 +1,17 @@
+/*
+ * Service worker: svuota la coda offline (static/offline-queue.js)
+ * con Background Sync quando torna la connessione, anche se la pagina è chiusa.
+ */
+importScripts('/static/offline-queue.js');
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', event => {
+  event.waitUntil(self.clients.claim());
+});
+
+self.addEventListener('sync', event => {
+  if (event.tag === self.OfflineQueue.SYNC_TAG) {
+    event.waitUntil(self.OfflineQueue.sincronizza());
+  }
+});
@@ -0,0 +1,104 @@
+"""
+Verifica con EXPLAIN che le join soglie -> prodotti usino gli indici
+(richiede add_thresholds_prodotto_id.sql).
+
+Uso:
+    python test_indici_soglie.py
+
+Per ogni query controlla il piano: la join soglie/prodotti deve usare un
+indice (PRIMARY di prodotti o idx_threshold_prodotto) e, quando la query
+filtra per prodotto o per utente, product_thresholds deve essere letta per
+indice e non con una scansione completa. Esce con codice 1 se un controllo fallisce.
+Con tabelle quasi vuote l'ottimizzatore può preferire una scansione:
+eseguire su un database con dati reali.
+"""
+import sys
+
+from database_connection import connect_to_database
+from utils.notifications import _select_sotto_soglia
+
+ACCESSI_PER_INDICE = ('const', 'eq_ref', 'ref', 'range')
+
+
+def piano(cursor, query, params=()):
+    cursor.execute('EXPLAIN ' + query, params)
+    return {riga['table']: riga for riga in cursor.fetchall()}
+
+
+def controlla(nome, righe, tabella, tipi, chiavi=None):
+    riga = righe.get(tabella)
+    if riga is None:
+        print(f"  FAIL {nome}: tabella {tabella} assente dal piano")
+        return False
+    ok = riga['type'] in tipi and (chiavi is None or riga['key'] in chiavi)
+    esito = 'OK  ' if ok else 'FAIL'
+    print(f"  {esito} {nome}: {tabella} type={riga['type']} key={riga['key']}")
+    return ok
+
+
+def controlla_join(nome, righe):
+    """La join soglie/prodotti usa un indice su almeno un lato (l'altro guida la join)."""
+    p, pt = righe.get('p') or {}, righe.get('pt') or {}
+    ok = ((p.get('type') == 'eq_ref' and p.get('key') == 'PRIMARY')
+          or (pt.get('type') in ('ref', 'eq_ref') and pt.get('key') in ('idx_threshold_prodotto', 'unique_user_prodotto')))
+    esito = 'OK  ' if ok else 'FAIL'
+    print(f"  {esito} {nome}: p type={p.get('type')} key={p.get('key')}, "
+          f"pt type={pt.get('type')} key={pt.get('key')}")
+    return ok
+
+
+def main():
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    risultati = []
+    try:
+        cursor.execute("SELECT id FROM prodotti ORDER BY id LIMIT 2")
+        prodotto_ids = [r['id'] for r in cursor.fetchall()] or [1, 2]
+        cursor.execute("SELECT id FROM utenti ORDER BY id LIMIT 1")
+        riga = cursor.fetchone()
+        user_id = riga['id'] if riga else 1
+
+        print('Controllo soglie dopo una scrittura (valuta_soglie con prodotto_ids):')
+        filtro = f"AND pt.prodotto_id IN ({','.join(['%s'] * len(prodotto_ids))})"
+        righe = piano(cursor, _select_sotto_soglia(filtro), prodotto_ids)
+        risultati.append(controlla('valuta_soglie', righe, 'pt', ACCESSI_PER_INDICE))
+        risultati.append(controlla_join('valuta_soglie', righe))
+
+        print('Controllo completo (valuta_soglie senza filtro):')
+        righe = piano(cursor, _select_sotto_soglia())
+        risultati.append(controlla_join('controllo completo', righe))
+
+        print('Soglie dell\'utente (gestione_soglie / api soglie):')
+        righe = piano(cursor, """
+            SELECT pt.id, p.codice_prodotto, p.nome_prodotto, pt.soglia_minima, pt.notifica_attiva,
+                   COALESCE(SUM(g.quantita), 0) as quantita_attuale
+            FROM product_thresholds pt
+            JOIN prodotti p ON p.id = pt.prodotto_id
+            LEFT JOIN giacenze g ON p.id = g.prodotto_id
+            WHERE pt.user_id = %s
+            GROUP BY pt.id, p.codice_prodotto, p.nome_prodotto, pt.soglia_minima, pt.notifica_attiva
+        """, (user_id,))
+        risultati.append(controlla('gestione_soglie', righe, 'pt', ACCESSI_PER_INDICE))
+        risultati.append(controlla_join('gestione_soglie', righe))
+
+        print('Prodotti sotto soglia (statistiche e report PDF):')
+        righe = piano(cursor, """
+            SELECT p.codice_prodotto, COALESCE(SUM(g.quantita), 0) as giacenza, pt.soglia_minima
+            FROM product_thresholds pt
+            JOIN prodotti p ON p.id = pt.prodotto_id
+            LEFT JOIN giacenze g ON p.id = g.prodotto_id
+            WHERE pt.notifica_attiva = 1
+            GROUP BY p.id, p.codice_prodotto, pt.soglia_minima
+        """)
+        risultati.append(controlla_join('statistiche', righe))
+    finally:
+        cursor.close()
+        conn.close()
+
+    falliti = risultati.count(False)
+    print(f"\n{len(risultati) - falliti}/{len(risultati)} controlli superati")
+    return 1 if falliti else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Bozze del movimento multiplo salvate per righe.
+
+Ogni riga della bozza è una riga di movimenti_batch_draft_righe, identificata
+dalla chiave generata dal client (`key`). Il salvataggio automatico invia
+solo le operazioni sulle righe (add / update / remove / clear) invece di
+riscrivere tutta la lista; dopo ogni salvataggio le colonne di riepilogo
+della bozza (num_righe, quantita_totale, num_prodotti) vengono ricalcolate
+con una sola query, così la lista delle bozze non legge mai le righe.
+"""
+import json
+
+MAX_BOZZE_UTENTE = 10
+MAX_RIGHE_BOZZA = 5000
+CAMPI_TESTATA = ('nome_bozza', 'nota_globale', 'stato_origine', 'stato_destinazione')
+
+COLONNE_RIEPILOGO = "id, nome_bozza, num_righe, quantita_totale, num_prodotti, created_at, updated_at"
+
+
+class BozzaNonValida(Exception):
+    """Riga o operazione della bozza non valida."""
+
+
+def _riga_db(bozza_id, riga):
+    """Riga inviata dal client -> tupla per movimenti_batch_draft_righe."""
+    if not isinstance(riga, dict):
+        raise BozzaNonValida('Riga non valida')
+    chiave = str(riga.get('key') or '')
+    if not chiave or len(chiave) > 64:
+        raise BozzaNonValida('Chiave della riga mancante o non valida')
+    try:
+        prodotto_id = int(riga.get('prodottoId'))
+        quantita = int(riga.get('quantita') or 0)
+    except (TypeError, ValueError):
+        raise BozzaNonValida(f'Riga {chiave}: prodotto o quantità non validi')
+    return (bozza_id, chiave, prodotto_id, quantita, json.dumps(riga))
+
+
+def _salva_righe(cursor, bozza_id, righe):
+    """Aggiunge o sostituisce righe (upsert sulla chiave della riga), con executemany."""
+    valori = [_riga_db(bozza_id, r) for r in righe]
+    if valori:
+        cursor.executemany("""
+            INSERT INTO movimenti_batch_draft_righe (draft_id, riga_key, prodotto_id, quantita, dati)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE prodotto_id = VALUES(prodotto_id), quantita = VALUES(quantita), dati = VALUES(dati)
+        """, valori)
+
+
+def _aggiorna_testata(cursor, bozza_id, testata):
+    campi = [c for c in CAMPI_TESTATA if c in (testata or {})]
+    if not campi:
+        return
+    if 'nome_bozza' in campi and not str(testata['nome_bozza'] or '').strip():
+        raise BozzaNonValida('Nome bozza obbligatorio')
+    assegnazioni = ', '.join(f"{c} = %s" for c in campi)
+    cursor.execute(f"UPDATE movimenti_batch_draft SET {assegnazioni} WHERE id = %s",
+                   (*[testata[c] or '' for c in campi], bozza_id))
+
+
+def aggiorna_riepilogo(cursor, bozza_id):
+    """Ricalcola le colonne di riepilogo dalle righe (scansione dell'indice della bozza)."""
+    cursor.execute("""
+        UPDATE movimenti_batch_draft b
+        JOIN (
+            SELECT COUNT(*) AS num_righe,
+                   COALESCE(SUM(quantita), 0) AS quantita_totale,
+                   COUNT(DISTINCT prodotto_id) AS num_prodotti
+            FROM movimenti_batch_draft_righe
+            WHERE draft_id = %s
+        ) r
+        SET b.num_righe = r.num_righe, b.quantita_totale = r.quantita_totale,
+            b.num_prodotti = r.num_prodotti, b.updated_at = CURRENT_TIMESTAMP
+        WHERE b.id = %s
+    """, (bozza_id, bozza_id))
+    cursor.execute(f"SELECT {COLONNE_RIEPILOGO} FROM movimenti_batch_draft WHERE id = %s", (bozza_id,))
+    riepilogo = cursor.fetchone()
+    if riepilogo['num_righe'] > MAX_RIGHE_BOZZA:
+        raise BozzaNonValida(f'Una bozza può contenere al massimo {MAX_RIGHE_BOZZA} righe')
+    return riepilogo
+
+
+def crea_bozza(cursor, user_id, testata, righe):
+    """Crea una bozza con tutte le sue righe; oltre MAX_BOZZE_UTENTE elimina la più vecchia."""
+    nome = str(testata.get('nome_bozza') or '').strip()
+    if not nome:
+        raise BozzaNonValida('Nome bozza obbligatorio')
+    if len(righe) > MAX_RIGHE_BOZZA:
+        raise BozzaNonValida(f'Una bozza può contenere al massimo {MAX_RIGHE_BOZZA} righe')
+
+    cursor.execute("SELECT COUNT(*) as count FROM movimenti_batch_draft WHERE user_id = %s", (user_id,))
+    if cursor.fetchone()['count'] >= MAX_BOZZE_UTENTE:
+        cursor.execute("""
+            DELETE FROM movimenti_batch_draft
+            WHERE user_id = %s
+            ORDER BY created_at ASC
+            LIMIT 1
+        """, (user_id,))
+
+    cursor.execute("""
+        INSERT INTO movimenti_batch_draft (user_id, nome_bozza, nota_globale, stato_origine, stato_destinazione)
+        VALUES (%s, %s, %s, %s, %s)
+    """, (user_id, nome, testata.get('nota_globale') or '', testata.get('stato_origine') or '',
+          testata.get('stato_destinazione') or ''))
+    bozza_id = cursor.lastrowid
+    _salva_righe(cursor, bozza_id, righe)
+    return aggiorna_riepilogo(cursor, bozza_id)
+
+
+def applica_patch(cursor, bozza_id, testata, operazioni):
+    """
+    Applica al database solo le modifiche della bozza:
+      {op: 'add' | 'update', riga: {...}}  aggiunge o sostituisce la riga `riga.key`
+      {op: 'remove', key: ...}             rimuove la riga
+      {op: 'clear'}                        rimuove tutte le righe
+    Più operazioni sulla stessa riga vengono compattate (vince l'ultima).
+    Restituisce il riepilogo aggiornato della bozza.
+    """
+    svuota = False
+    ultime = {}
+    for operazione in operazioni or []:
+        tipo = (operazione or {}).get('op')
+        if tipo == 'clear':
+            svuota = True
+            ultime = {}
+        elif tipo in ('add', 'update'):
+            riga = operazione.get('riga') or {}
+            ultime[str(riga.get('key') or '')] = riga
+        elif tipo == 'remove':
+            ultime[str(operazione.get('key') or '')] = None
+        else:
+            raise BozzaNonValida(f'Operazione non supportata: {tipo}')
+
+    _aggiorna_testata(cursor, bozza_id, testata)
+
+    if svuota:
+        cursor.execute("DELETE FROM movimenti_batch_draft_righe WHERE draft_id = %s", (bozza_id,))
+    rimosse = [chiave for chiave, riga in ultime.items() if riga is None and chiave]
+    if rimosse:
+        placeholder = ','.join(['%s'] * len(rimosse))
+        cursor.execute(f"""
+            DELETE FROM movimenti_batch_draft_righe
+            WHERE draft_id = %s AND riga_key IN ({placeholder})
+        """, (bozza_id, *rimosse))
+    _salva_righe(cursor, bozza_id, [riga for riga in ultime.values() if riga is not None])
+
+    return aggiorna_riepilogo(cursor, bozza_id)
+
+
+def carica_righe(cursor, bozza):
+    """
+    Righe della bozza nell'ordine di inserimento. Una bozza salvata prima
+    delle righe (solo json_items) viene convertita alla prima apertura.
+    """
+    if bozza.get('json_items'):
+        righe = json.loads(bozza['json_items']) or []
+        for indice, riga in enumerate(righe):
+            riga.setdefault('key', f'r{bozza["id"]}-{indice}')
+        cursor.execute("DELETE FROM movimenti_batch_draft_righe WHERE draft_id = %s", (bozza['id'],))
+        _salva_righe(cursor, bozza['id'], righe)
+        cursor.execute("UPDATE movimenti_batch_draft SET json_items = NULL WHERE id = %s", (bozza['id'],))
+        aggiorna_riepilogo(cursor, bozza['id'])
+        return righe
+
+    cursor.execute("""
+        SELECT dati FROM movimenti_batch_draft_righe
+        WHERE draft_id = %s
+        ORDER BY id
+    """, (bozza['id'],))
+    return [json.loads(r['dati']) for r in cursor.fetchall()]
@@ -0,0 +1,210 @@
+"""
+Carico merci massivo da bolla di consegna (CSV o XLSX).
+
+Il file viene letto in memoria, i codici prodotto vengono risolti con
+un'unica query e tutte le righe valide vengono scritte in una sola
+transazione: upsert delle giacenze e movimenti CARICO con executemany.
+Per ogni riga del file viene restituito l'esito (report per riga).
+"""
+import csv
+import io
+
+from openpyxl import load_workbook
+
+from utils.giacenze import upsert_giacenze
+from utils.outbox import registra_eventi
+
+MAX_RIGHE = 10000
+
+# Intestazioni accettate (minuscole, senza spazi ai lati) -> campo
+COLONNE = {
+    'codice_prodotto': 'codice_prodotto',
+    'codice prodotto': 'codice_prodotto',
+    'codice': 'codice_prodotto',
+    'cod': 'codice_prodotto',
+    'quantita': 'quantita',
+    'quantità': 'quantita',
+    'qta': 'quantita',
+    'qtà': 'quantita',
+    'ubicazione': 'ubicazione',
+    'note': 'note',
+    'nota': 'note',
+}
+
+
+class _DialettoBolla(csv.excel):
+    """Formato di default (Excel italiano) se il separatore non è riconoscibile."""
+    delimiter = ';'
+
+
+class BollaNonValida(Exception):
+    """File non leggibile o senza le colonne obbligatorie."""
+
+
+def _normalizza_intestazioni(intestazioni):
+    campi = []
+    for valore in intestazioni:
+        nome = str(valore).strip().lower() if valore is not None else ''
+        campi.append(COLONNE.get(nome))
+    if 'codice_prodotto' not in campi or 'quantita' not in campi:
+        raise BollaNonValida("Il file deve contenere almeno le colonne 'codice_prodotto' e 'quantita'")
+    return campi
+
+
+def _righe_csv(contenuto):
+    testo = contenuto.decode('utf-8-sig', errors='replace')
+    try:
+        dialetto = csv.Sniffer().sniff(testo[:4096], delimiters=';,\t')
+    except csv.Error:
+        dialetto = _DialettoBolla
+    return csv.reader(io.StringIO(testo), dialetto)
+
+
+def _righe_xlsx(contenuto):
+    try:
+        workbook = load_workbook(io.BytesIO(contenuto), read_only=True, data_only=True)
+    except Exception as e:
+        raise BollaNonValida(f'File Excel non leggibile: {e}')
+    return workbook.active.iter_rows(values_only=True)
+
+
+def leggi_bolla(nome_file, contenuto):
+    """
+    Legge la bolla e restituisce una lista di dizionari
+    {riga, codice_prodotto, quantita, ubicazione, note} (valori grezzi).
+    `riga` è il numero di riga nel file (intestazione = riga 1).
+    """
+    if nome_file.lower().endswith(('.xlsx', '.xlsm')):
+        righe_file = _righe_xlsx(contenuto)
+    elif nome_file.lower().endswith(('.csv', '.txt')):
+        righe_file = _righe_csv(contenuto)
+    else:
+        raise BollaNonValida('Formato non supportato: carica un file .csv o .xlsx')
+
+    campi = None
+    righe = []
+    for numero, valori in enumerate(righe_file, start=1):
+        if campi is None:
+            campi = _normalizza_intestazioni(valori)
+            continue
+        if not any(v not in (None, '') for v in valori):
+            continue  # riga vuota
+        riga = {'riga': numero, 'codice_prodotto': None, 'quantita': None, 'ubicazione': None, 'note': None}
+        for campo, valore in zip(campi, valori):
+            if campo:
+                riga[campo] = valore
+        righe.append(riga)
+        if len(righe) > MAX_RIGHE:
+            raise BollaNonValida(f'Il file supera il limite di {MAX_RIGHE} righe')
+
+    if campi is None:
+        raise BollaNonValida('Il file è vuoto')
+    return righe
+
+
+def _testo(valore):
+    if valore is None:
+        return ''
+    if isinstance(valore, float) and valore.is_integer():
+        valore = int(valore)
+    return str(valore).strip()
+
+
+def _quantita(valore):
+    testo = _testo(valore).replace(',', '.')
+    try:
+        numero = float(testo)
+    except ValueError:
+        return None
+    if not numero.is_integer() or numero < 1:
+        return None
+    return int(numero)
+
+
+def prepara_carico(cursor, righe, user_id):
+    """
+    Valida le righe e risolve codici prodotto e magazzini con query set-based.
+    Restituisce (report, giacenze, movimenti): il report ha un esito per
+    ogni riga, giacenze e movimenti contengono solo le righe valide.
+    """
+    codici = {_testo(r['codice_prodotto']) for r in righe} - {''}
+    prodotti = {}
+    if codici:
+        placeholder = ','.join(['%s'] * len(codici))
+        cursor.execute(f"""
+            SELECT id, codice_prodotto FROM prodotti WHERE codice_prodotto IN ({placeholder})
+        """, tuple(codici))
+        # Confronto case-insensitive come la collation della colonna
+        prodotti = {row['codice_prodotto'].strip().casefold(): row['id'] for row in cursor.fetchall()}
+
+    # Magazzino di ogni prodotto (stesse preferenze del carico singolo):
+    # giacenza IN_MAGAZZINO nella stessa ubicazione, poi qualsiasi giacenza
+    magazzini = {}
+    if prodotti:
+        ids = sorted(set(prodotti.values()))
+        placeholder = ','.join(['%s'] * len(ids))
+        cursor.execute(f"""
+            SELECT prodotto_id, magazzino_id, stato, ubicazione_norm
+            FROM giacenze
+            WHERE prodotto_id IN ({placeholder}) AND magazzino_id IS NOT NULL
+            ORDER BY id
+        """, ids)
+        for row in cursor.fetchall():
+            magazzini.setdefault(row['prodotto_id'], []).append(row)
+
+    cursor.execute("SELECT id FROM magazzini ORDER BY id LIMIT 1")
+    magazzino_default = cursor.fetchone()
+    magazzino_default = magazzino_default['id'] if magazzino_default else None
+
+    report = []
+    giacenze = []
+    movimenti = []
+    for r in righe:
+        codice = _testo(r['codice_prodotto'])
+        ubicazione = _testo(r['ubicazione'])
+        note = _testo(r['note'])
+        quantita = _quantita(r['quantita'])
+        esito = {'riga': r['riga'], 'codice_prodotto': codice, 'quantita': quantita,
+                 'ubicazione': ubicazione, 'esito': 'ok', 'messaggio': ''}
+        report.append(esito)
+
+        prodotto_id = prodotti.get(codice.casefold()) if codice else None
+        if not codice:
+            esito.update(esito='errore', messaggio='Codice prodotto mancante')
+            continue
+        if not prodotto_id:
+            esito.update(esito='errore', messaggio='Prodotto non trovato')
+            continue
+        if quantita is None:
+            esito.update(esito='errore', messaggio=f"Quantità non valida: {_testo(r['quantita']) or 'vuota'}")
+            continue
+
+        candidati = magazzini.get(prodotto_id, [])
+        stessa_ubicazione = [g for g in candidati
+                             if str(g['stato']).upper() == 'IN_MAGAZZINO'
+                             and (g['ubicazione_norm'] or '').casefold() == ubicazione.casefold()]
+        scelta = (stessa_ubicazione or candidati or [None])[0]
+        magazzino_id = scelta['magazzino_id'] if scelta else magazzino_default
+        if magazzino_id is None:
+            esito.update(esito='errore', messaggio='Nessun magazzino trovato nel sistema')
+            continue
+
+        giacenze.append((prodotto_id, magazzino_id, ubicazione, 'IN_MAGAZZINO', quantita, note))
+        movimenti.append((prodotto_id, quantita, note, user_id, 'IN_MAGAZZINO', ubicazione, magazzino_id, 'CARICO'))
+
+    return report, giacenze, movimenti
+
+
+def applica_carico(cursor, giacenze, movimenti):
+    """Scrive giacenze (upsert), movimenti CARICO ed eventi outbox con executemany."""
+    upsert_giacenze(cursor, giacenze)
+    if movimenti:
+        cursor.executemany("""
+            INSERT INTO movimenti (prodotto_id, quantita, note, user_id, stato, a_ubicazione, a_magazzino_id, tipo_movimento)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, movimenti)
+        registra_eventi(cursor, [
+            ('CARICO', prodotto_id, quantita, user_id,
+             {'a_stato': stato, 'a_ubicazione': ubicazione, 'a_magazzino_id': magazzino_id, 'bolla': True})
+            for prodotto_id, quantita, _note, user_id, stato, ubicazione, magazzino_id, _tipo in movimenti
+        ])
@@ -0,0 +1,140 @@
+"""
+Delta sync delle giacenze basato sul feed giacenze_changes.
+
+I trigger su giacenze (vedi add_giacenze_changes.sql) registrano ogni
+modifica con un numero di sequenza `seq`. Il client conserva l'ultimo
+cursore ricevuto e chiede solo le giacenze cambiate dopo quel cursore.
+
+Nota sull'ordine di commit: `seq` viene assegnato durante la transazione,
+quindi una transazione ancora aperta può rendere visibile un seq più basso
+dopo uno più alto. Il cursore restituito non supera mai le modifiche più
+recenti dell'orizzonte stabile (orizzonte_stabile()): queste vengono
+incluse nella risposta ma reinviate alla richiesta successiva (applicarle
+due volte è innocuo, il client riceve lo stato corrente).
+
+L'orizzonte è l'inizio della più vecchia transazione aperta che ha già
+scritto righe (information_schema.innodb_trx), meno MARGINE_SECONDI: una
+modifica non ancora in commit ha sempre changed_at successivo all'inizio
+della sua transazione, quindi nessun seq viene saltato, qualunque sia la
+durata della transazione (carico massivo, attese sui lock). Se l'utente
+del database non può leggere innodb_trx (serve il privilegio PROCESS) si
+usa una finestra fissa di STABILITA_SECONDI: il default supera
+innodb_lock_wait_timeout (50 s), ma una transazione più lunga della
+finestra può ancora far perdere una modifica. Una finestra più ampia non
+perde modifiche ma reinvia più righe a ogni richiesta.
+"""
+import logging
+import os
+
+from mysql.connector import Error as ErroreDatabase, errorcode
+
+LIMITE_DEFAULT = 500
+LIMITE_MASSIMO = 5000
+MARGINE_SECONDI = int(os.getenv('DELTA_SYNC_MARGINE_SECONDI', '2'))
+STABILITA_SECONDI = int(os.getenv('DELTA_SYNC_STABILITA_SECONDI', '60'))
+
+ERRORI_PERMESSO = {
+    errorcode.ER_SPECIFIC_ACCESS_DENIED_ERROR,   # 1227
+    errorcode.ER_DBACCESS_DENIED_ERROR,          # 1044
+    errorcode.ER_TABLEACCESS_DENIED_ERROR,       # 1142
+}
+
+logger = logging.getLogger(__name__)
+
+_innodb_trx_leggibile = True
+
+
+def orizzonte_stabile(cursor):
+    """
+    Istante prima del quale tutte le modifiche registrate (giacenze_changes,
+    outbox_events) sono già in commit. Le righe più recenti possono ancora
+    avere davanti un seq/id più basso non visibile.
+    """
+    global _innodb_trx_leggibile
+    if _innodb_trx_leggibile:
+        try:
+            cursor.execute("""
+                SELECT LEAST(NOW(6), COALESCE(MIN(trx_started), NOW(6))) - INTERVAL %s SECOND AS orizzonte
+                FROM information_schema.innodb_trx
+                WHERE trx_rows_modified > 0
+            """, (MARGINE_SECONDI,))
+            return cursor.fetchone()['orizzonte']
+        except ErroreDatabase as e:
+            if e.errno not in ERRORI_PERMESSO:
+                raise
+            _innodb_trx_leggibile = False
+            logger.warning('information_schema.innodb_trx non leggibile (privilegio PROCESS mancante): '
+                           'uso la finestra fissa di %s secondi', STABILITA_SECONDI)
+    cursor.execute("SELECT NOW(6) - INTERVAL %s SECOND AS orizzonte", (STABILITA_SECONDI,))
+    return cursor.fetchone()['orizzonte']
+
+# Stessa proiezione della lista giacenze in index()
+COLONNE_GIACENZA = """
+    g.id, p.codice_prodotto, p.nome_prodotto, m.nome AS magazzino, g.ubicazione,
+    g.stato, g.quantita, g.note, g.version
+"""
+
+
+def cursore_corrente(cursor):
+    """Ultimo seq del feed: da leggere PRIMA di caricare la lista completa."""
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM giacenze_changes")
+    return cursor.fetchone()['seq']
+
+
+def leggi_modifiche(cursor, since, limite=LIMITE_DEFAULT):
+    """
+    Restituisce le giacenze cambiate dopo il cursore `since`:
+    {cursor, has_more, reset, modificate: [giacenze], eliminate: [id]}.
+    Ogni giacenza compare una sola volta, con il suo stato attuale.
+    """
+    limite = max(1, min(int(limite), LIMITE_MASSIMO))
+
+    # Cursore più vecchio dei dati conservati: il client deve ricaricare tutto
+    cursor.execute("SELECT MIN(seq) AS primo FROM giacenze_changes")
+    primo = cursor.fetchone()['primo']
+    if since and primo is not None and since < primo - 1:
+        return {'cursor': cursore_corrente(cursor), 'has_more': False, 'reset': True,
+                'modificate': [], 'eliminate': []}
+
+    orizzonte = orizzonte_stabile(cursor)
+    cursor.execute("""
+        SELECT giacenza_id,
+               MAX(seq) AS ultimo_seq,
+               MIN(CASE WHEN changed_at >= %s THEN seq END) AS primo_recente
+        FROM giacenze_changes
+        WHERE seq > %s
+        GROUP BY giacenza_id
+        ORDER BY ultimo_seq
+        LIMIT %s
+    """, (orizzonte, since, limite + 1))
+    cambiate = cursor.fetchall()
+
+    has_more = len(cambiate) > limite
+    cambiate = cambiate[:limite]
+    if not cambiate:
+        return {'cursor': since, 'has_more': False, 'reset': False, 'modificate': [], 'eliminate': []}
+
+    nuovo_cursore = cambiate[-1]['ultimo_seq']
+    recenti = [c['primo_recente'] for c in cambiate if c['primo_recente'] is not None]
+    if recenti:
+        nuovo_cursore = max(since, min(nuovo_cursore, min(recenti) - 1))
+
+    ids = [c['giacenza_id'] for c in cambiate]
+    placeholder = ','.join(['%s'] * len(ids))
+    cursor.execute(f"""
+        SELECT {COLONNE_GIACENZA}
+        FROM giacenze g
+        JOIN prodotti p ON g.prodotto_id = p.id
+        LEFT JOIN magazzini m ON g.magazzino_id = m.id
+        WHERE g.id IN ({placeholder})
+    """, ids)
+    modificate = cursor.fetchall()
+    presenti = {g['id'] for g in modificate}
+
+    return {
+        'cursor': nuovo_cursore,
+        'has_more': has_more,
+        'reset': False,
+        'modificate': modificate,
+        'eliminate': [i for i in ids if i not in presenti],
+    }
@@ -0,0 +1,203 @@
+"""
+Esportazioni colonnari (Parquet e Arrow IPC/Feather) per l'analisi con pandas.
+
+Giacenze e movimenti del registro (stock_ledger) vengono letti con un
+cursore non bufferizzato a blocchi di BLOCCO_RIGHE righe; ogni blocco
+diventa un RecordBatch Arrow e viene scritto subito:
+  - Parquet: un row group per blocco, compressione zstd (i testi ripetuti
+    come stato, magazzino e tipo movimento sono codificati a dizionario)
+  - Feather: formato file Arrow IPC con buffer compressi zstd
+Il writer scrive su un buffer in memoria che viene svuotato dopo ogni
+blocco: la risposta parte con il primo blocco e la memoria non dipende dal
+numero di righe.
+
+Lato analisi:
+    pandas.read_parquet('movimenti.parquet')
+    pandas.read_feather('giacenze.feather')
+
+pyarrow è una dipendenza opzionale: senza, disponibile() è False e le
+rotte rispondono con un errore.
+"""
+from database_connection import connect_to_database
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+BLOCCO_RIGHE = 50000
+
+FORMATI = {
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'feather': ('feather', 'application/vnd.apache.arrow.file'),
+}
+
+QUERY_GIACENZE = """
+    SELECT
+        g.id,
+        g.prodotto_id,
+        p.codice_prodotto,
+        p.nome_prodotto,
+        g.magazzino_id,
+        m.nome AS magazzino,
+        g.ubicazione,
+        g.stato,
+        g.quantita,
+        g.note,
+        g.updated_at
+    FROM giacenze g
+    JOIN prodotti p ON g.prodotto_id = p.id
+    LEFT JOIN magazzini m ON g.magazzino_id = m.id
+    ORDER BY g.id
+"""
+
+QUERY_MOVIMENTI = """
+    SELECT
+        l.id,
+        l.data_ora,
+        l.tipo_movimento,
+        l.prodotto_id,
+        p.codice_prodotto,
+        p.nome_prodotto,
+        l.quantita,
+        l.quantita_netta,
+        l.da_magazzino_id,
+        l.a_magazzino_id,
+        l.da_ubicazione,
+        l.a_ubicazione,
+        l.stato,
+        l.tipo_scarico,
+        u.username,
+        l.note
+    FROM stock_ledger l
+    JOIN prodotti p ON l.prodotto_id = p.id
+    LEFT JOIN utenti u ON l.user_id = u.id
+    WHERE l.data_ora BETWEEN %s AND %s
+    ORDER BY l.data_ora, l.id
+"""
+
+
+def disponibile():
+    return pa is not None
+
+
+def _schema_giacenze():
+    return pa.schema([
+        ('id', pa.int32()),
+        ('prodotto_id', pa.int32()),
+        ('codice_prodotto', pa.string()),
+        ('nome_prodotto', pa.string()),
+        ('magazzino_id', pa.int32()),
+        ('magazzino', pa.string()),
+        ('ubicazione', pa.string()),
+        ('stato', pa.string()),
+        ('quantita', pa.int32()),
+        ('note', pa.string()),
+        ('updated_at', pa.timestamp('s')),
+    ])
+
+
+def _schema_movimenti():
+    return pa.schema([
+        ('id', pa.int32()),
+        ('data_ora', pa.timestamp('s')),
+        ('tipo_movimento', pa.string()),
+        ('prodotto_id', pa.int32()),
+        ('codice_prodotto', pa.string()),
+        ('nome_prodotto', pa.string()),
+        ('quantita', pa.int32()),
+        ('quantita_netta', pa.int32()),
+        ('da_magazzino_id', pa.int32()),
+        ('a_magazzino_id', pa.int32()),
+        ('da_ubicazione', pa.string()),
+        ('a_ubicazione', pa.string()),
+        ('stato', pa.string()),
+        ('tipo_scarico', pa.string()),
+        ('username', pa.string()),
+        ('note', pa.string()),
+    ])
+
+
+def _blocchi(query, params=(), blocco=BLOCCO_RIGHE):
+    """Righe della query (tuple, nell'ordine dello schema) a blocchi di `blocco`."""
+    conn = connect_to_database()
+    cursor = conn.cursor(buffered=False)
+    try:
+        cursor.execute(query, params)
+        while True:
+            righe = cursor.fetchmany(blocco)
+            if not righe:
+                break
+            yield righe
+    finally:
+        # Come in export_magazzino: righe non lette consumate prima di
+        # restituire la connessione al pool
+        if conn.unread_result:
+            conn.consume_results()
+        cursor.close()
+        conn.close()
+
+
+def _record_batch(schema, righe):
+    colonne = zip(*righe)
+    return pa.RecordBatch.from_arrays(
+        [pa.array(valori, type=campo.type) for campo, valori in zip(schema, colonne)],
+        schema=schema)
+
+
+class _Buffer:
+    """File in sola scrittura per i writer pyarrow, svuotato dopo ogni blocco."""
+
+    def __init__(self):
+        self.parti = []
+        self.closed = False
+
+    def write(self, dati):
+        self.parti.append(bytes(dati))
+        return len(dati)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def svuota(self):
+        dati = b''.join(self.parti)
+        self.parti.clear()
+        return dati
+
+
+def _genera(formato, schema, blocchi):
+    buffer = _Buffer()
+    if formato == 'parquet':
+        writer = pq.ParquetWriter(buffer, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(buffer, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+    try:
+        for righe in blocchi:
+            writer.write_batch(_record_batch(schema, righe))
+            dati = buffer.svuota()
+            if dati:
+                yield dati
+    finally:
+        blocchi.close()
+        writer.close()
+    # Footer del file (metadati Parquet / indice dei batch Arrow)
+    dati = buffer.svuota()
+    if dati:
+        yield dati
+
+
+def genera_giacenze(formato):
+    """Generatore dei byte del file delle giacenze nel formato richiesto."""
+    schema = _schema_giacenze()
+    return _genera(formato, schema, _blocchi(QUERY_GIACENZE))
+
+
+def genera_movimenti(formato, start_date, end_date):
+    """Generatore dei byte del file dei movimenti del periodo (data_ora tra start_date ed end_date)."""
+    schema = _schema_movimenti()
+    return _genera(formato, schema, _blocchi(QUERY_MOVIMENTI, (start_date, end_date)))
@@ -0,0 +1,208 @@
+"""
+Cache su disco delle esportazioni, per versione dei dati.
+
+Ogni file esportato (XLSX e TXT del magazzino, CSV delle statistiche) viene
+salvato in CARTELLA_CACHE con la versione dei dati nel nome:
+
+    <nome>_<seq giacenze_changes>-<versione anagrafica>.<estensione>
+
+Finché nessuna scrittura cambia la versione (vedi add_versioni_dati.sql),
+i download successivi sono serviti con send_file direttamente dal disco,
+con ETag: il browser può rivalidare e ricevere 304.
+
+Una versione viene salvata solo se è stabile: come nel delta sync, seq è
+assegnato durante la transazione, quindi una modifica con seq più basso
+può diventare visibile dopo. L'ultima modifica deve precedere l'orizzonte
+stabile (delta_sync.orizzonte_stabile(): inizio della più vecchia
+transazione di scrittura aperta), altrimenti il file viene generato e
+inviato senza salvarlo in cache.
+
+La cartella è limitata a DIMENSIONE_MASSIMA byte: salvando un file vengono
+eliminate le versioni precedenti dello stesso nome e poi, se serve, i file
+usati meno di recente.
+"""
+import logging
+import os
+import threading
+
+from flask import Response, send_file, stream_with_context
+
+from database_connection import connect_to_database
+from utils.delta_sync import orizzonte_stabile
+
+CARTELLA_CACHE = os.getenv(
+    'EXPORT_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache_esportazioni'))
+DIMENSIONE_MASSIMA = int(os.getenv('EXPORT_CACHE_MAX_MB', '200')) * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+_lock_pulizia = threading.Lock()
+
+
+def versione_dati(cursor):
+    """Versione corrente dei dati esportati: (versione, stabile)."""
+    orizzonte = orizzonte_stabile(cursor)
+    cursor.execute("""
+        SELECT c.seq,
+               c.changed_at < %s AS stabile,
+               (SELECT versione FROM versioni_dati WHERE nome = 'anagrafica') AS anagrafica
+        FROM (SELECT 1) AS uno
+        LEFT JOIN giacenze_changes c ON c.seq = (SELECT MAX(seq) FROM giacenze_changes)
+    """, (orizzonte,))
+    riga = cursor.fetchone()
+    versione = f"{riga['seq'] or 0}-{riga['anagrafica'] or 0}"
+    return versione, riga['seq'] is None or bool(riga['stabile'])
+
+
+def leggi_versione():
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        return versione_dati(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def percorso(nome, versione, estensione):
+    return os.path.join(CARTELLA_CACHE, f'{nome}_{versione}.{estensione}')
+
+
+def etag(nome, versione):
+    return f'{nome}-{versione}'
+
+
+def cerca(nome, versione, estensione):
+    """Percorso del file in cache, o None. Un file trovato diventa il più recente per l'eviction."""
+    file = percorso(nome, versione, estensione)
+    try:
+        os.utime(file)
+    except FileNotFoundError:
+        return None
+    return file
+
+
+def file_temporaneo(nome, estensione):
+    os.makedirs(CARTELLA_CACHE, exist_ok=True)
+    return os.path.join(CARTELLA_CACHE, f'.{nome}.{os.getpid()}.{threading.get_ident()}.{estensione}.tmp')
+
+
+def salva(temporaneo, nome, versione, estensione):
+    """Sposta il file generato in cache (rinomina atomica) e applica il limite di spazio."""
+    file = percorso(nome, versione, estensione)
+    os.replace(temporaneo, file)
+    _pulisci(nome, file)
+    return file
+
+
+def _pulisci(nome, appena_salvato):
+    with _lock_pulizia:
+        voci = []
+        for voce in os.scandir(CARTELLA_CACHE):
+            if not voce.is_file() or voce.name.startswith('.') or voce.path == appena_salvato:
+                continue
+            try:
+                stat = voce.stat()
+            except FileNotFoundError:
+                continue
+            # Le versioni precedenti dello stesso file non verranno più richieste
+            if voce.name.rsplit('_', 1)[0] == nome:
+                _rimuovi(voce.path)
+                continue
+            voci.append((stat.st_mtime, stat.st_size, voce.path))
+
+        totale = sum(dimensione for _, dimensione, _ in voci) + os.path.getsize(appena_salvato)
+        for _, dimensione, file in sorted(voci):
+            if totale <= DIMENSIONE_MASSIMA:
+                break
+            _rimuovi(file)
+            totale -= dimensione
+
+
+def _rimuovi(file):
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning('Impossibile eliminare %s dalla cache esportazioni: %s', file, e)
+
+
+def esportazione(nome, estensione, genera):
+    """
+    File dell'esportazione per la versione corrente: dalla cache o generato
+    con genera(percorso). Restituisce (percorso, versione, in_cache):
+    se in_cache è False il file è temporaneo e va eliminato dopo l'invio.
+    """
+    versione, stabile = leggi_versione()
+    file = cerca(nome, versione, estensione)
+    if file:
+        return file, versione, True
+    temporaneo = file_temporaneo(nome, estensione)
+    try:
+        genera(temporaneo)
+    except Exception:
+        _rimuovi(temporaneo)
+        raise
+    if not stabile:
+        return temporaneo, versione, False
+    return salva(temporaneo, nome, versione, estensione), versione, True
+
+
+def salva_durante_invio(blocchi, nome, versione, estensione, encoding='utf-8'):
+    """
+    Inoltra i blocchi di una risposta in streaming e li scrive anche su un
+    file temporaneo, salvato in cache solo se lo stream arriva alla fine.
+    """
+    temporaneo = file_temporaneo(nome, estensione)
+    completato = False
+    try:
+        with open(temporaneo, 'wb') as file:
+            for blocco in blocchi:
+                file.write(blocco.encode(encoding) if isinstance(blocco, str) else blocco)
+                yield blocco
+        completato = True
+    finally:
+        if completato:
+            salva(temporaneo, nome, versione, estensione)
+        else:
+            _rimuovi(temporaneo)
+
+
+def invia(file, versione, nome, download_name, mimetype, in_cache=True):
+    """
+    Risposta send_file con ETag (solo per i file in cache): con If-None-Match
+    uguale risponde 304. max_age=0 fa rivalidare il browser a ogni download.
+    """
+    response = send_file(file, as_attachment=True, download_name=download_name, mimetype=mimetype,
+                         etag=etag(nome, versione) if in_cache else False, max_age=0, conditional=True)
+    response.cache_control.private = True
+    if not in_cache:
+        @response.call_on_close
+        def cleanup():
+            _rimuovi(file)
+    return response
+
+
+def invia_streaming(genera, nome, estensione, download_name, mimetype):
+    """
+    Risposta per un'esportazione generata a blocchi da genera(): dalla cache
+    se la versione corrente è già salvata, altrimenti in streaming
+    (primo byte subito), salvata in cache durante l'invio se stabile.
+    """
+    versione, stabile = leggi_versione()
+    file = cerca(nome, versione, estensione)
+    if file:
+        return invia(file, versione, nome, download_name, mimetype)
+
+    blocchi = genera()
+    if stabile:
+        blocchi = salva_durante_invio(blocchi, nome, versione, estensione)
+    response = Response(stream_with_context(blocchi), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={download_name}"
+    if stabile:
+        response.set_etag(etag(nome, versione))
+        response.cache_control.private = True
+        response.cache_control.max_age = 0
+    return response
@@ -0,0 +1,149 @@
+"""
+Esportazioni del magazzino (TXT a colonne fisse e XLSX) a memoria costante.
+
+Le giacenze vengono lette con un cursore non bufferizzato (le righe restano
+sul server e arrivano a blocchi di BLOCCO_RIGHE con fetchmany) e scritte
+man mano:
+  - il TXT è un generatore di blocchi di testo, inviato con
+    stream_with_context: il primo byte parte subito
+  - l'XLSX usa xlsxwriter in modalità constant_memory (una riga alla volta
+    su file temporaneo); il file .xlsx è uno zip e viene completato solo
+    alla chiusura, poi inviato a blocchi da send_file
+"""
+from datetime import datetime
+
+import xlsxwriter
+
+from database_connection import connect_to_database
+
+BLOCCO_RIGHE = 1000
+
+QUERY_GIACENZE = """
+    SELECT
+        p.codice_prodotto,
+        p.nome_prodotto,
+        m.nome AS magazzino,
+        g.ubicazione,
+        g.stato,
+        g.quantita,
+        g.note
+    FROM giacenze g
+    JOIN prodotti p ON g.prodotto_id = p.id
+    LEFT JOIN magazzini m ON g.magazzino_id = m.id
+    ORDER BY p.codice_prodotto ASC, m.nome ASC, g.ubicazione ASC
+"""
+
+TITOLO = 'PHARMAGEST - ESPORTAZIONE MAGAZZINO'
+INTESTAZIONI = ["Codice", "Prodotto", "Magazzino", "Ubicazione", "Stato", "Quantità", "Note"]
+
+# Larghezza delle colonne del TXT
+LARGHEZZE = {
+    "codice": 14,
+    "prodotto": 32,
+    "magazzino": 20,
+    "ubicazione": 18,
+    "stato": 13,
+    "quantita": 9,
+    "note": 30
+}
+# Larghezza delle colonne dell'XLSX
+LARGHEZZE_XLSX = [15, 30, 20, 18, 13, 9, 30]
+
+
+def blocchi_giacenze(blocco=BLOCCO_RIGHE):
+    """Giacenze da esportare, a blocchi di `blocco` righe (liste di dict)."""
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(QUERY_GIACENZE)
+        while True:
+            righe = cursor.fetchmany(blocco)
+            if not righe:
+                break
+            yield righe
+    finally:
+        # Interruzione a metà (es. client disconnesso): le righe non lette
+        # vanno consumate prima di restituire la connessione al pool
+        if conn.unread_result:
+            conn.consume_results()
+        cursor.close()
+        conn.close()
+
+
+def _riga_txt(g):
+    w = LARGHEZZE
+    return (
+        f"{str(g['codice_prodotto'])[:w['codice']-1]:<{w['codice']}}"
+        f"{str(g['nome_prodotto'])[:w['prodotto']-1]:<{w['prodotto']}}"
+        f"{str(g['magazzino'] or '')[:w['magazzino']-1]:<{w['magazzino']}}"
+        f"{str(g['ubicazione'] or '')[:w['ubicazione']-1]:<{w['ubicazione']}}"
+        f"{str(g['stato'] or '')[:w['stato']-1]:<{w['stato']}}"
+        f"{str(g['quantita']):>{w['quantita']}}  "
+        f"{str(g['note'] or '')}\n"
+    )
+
+
+def genera_txt(blocchi=None):
+    """Generatore del TXT a colonne fisse: intestazione, poi un blocco di testo per blocco di righe."""
+    w = LARGHEZZE
+    now = datetime.now().strftime("%d/%m/%Y %H:%M")
+    header = (
+        f"{'Codice':<{w['codice']}}"
+        f"{'Prodotto':<{w['prodotto']}}"
+        f"{'Magazzino':<{w['magazzino']}}"
+        f"{'Ubicazione':<{w['ubicazione']}}"
+        f"{'Stato':<{w['stato']}}"
+        f"{'Quantità':>{w['quantita']}}  "
+        f"{'Note'}"
+    )
+    yield (f"{TITOLO}\n"
+           f"Data esportazione: {now}\n\n"
+           f"{header}\n"
+           f"{'-' * (sum(w.values()) + 14)}\n")
+    for righe in blocchi if blocchi is not None else blocchi_giacenze():
+        yield ''.join(_riga_txt(g) for g in righe)
+
+
+def scrivi_xlsx(percorso, blocchi=None):
+    """Scrive l'XLSX delle giacenze in `percorso` (constant_memory). Restituisce le righe scritte."""
+    now = datetime.now().strftime("%d/%m/%Y %H:%M")
+    workbook = xlsxwriter.Workbook(percorso, {'constant_memory': True})
+    try:
+        worksheet = workbook.add_worksheet("Magazzino")
+        bold = workbook.add_format({'bold': True, 'bg_color': '#e3f2fd'})
+        for col, larghezza in enumerate(LARGHEZZE_XLSX):
+            worksheet.set_column(col, col, larghezza)
+
+        # In constant_memory le righe vanno scritte in ordine crescente
+        worksheet.write(0, 0, TITOLO)
+        worksheet.write(1, 0, f'Data esportazione: {now}')
+        worksheet.write_row(3, 0, INTESTAZIONI, bold)
+
+        row = 4
+        for righe in blocchi if blocchi is not None else blocchi_giacenze():
+            for g in righe:
+                worksheet.write_row(row, 0, (
+                    g['codice_prodotto'],
+                    g['nome_prodotto'],
+                    g['magazzino'] or '',
+                    g['ubicazione'] or '',
+                    g['stato'] or '',
+                    g['quantita'],
+                    g['note'] or '',
+                ))
+                row += 1
+    finally:
+        workbook.close()
+    return row - 4
+
+
+def conta_giacenze():
+    """Numero di righe dell'esportazione (per il progresso dei job)."""
+    conn = connect_to_database()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*) FROM giacenze")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        conn.close()
@@ -0,0 +1,99 @@
+"""
+Helper per le scritture sulla tabella giacenze.
+
+Una giacenza è identificata dalla chiave naturale
+(prodotto_id, magazzino_id, ubicazione_norm, stato, note_hash), garantita
+dall'indice UNIQUE `uq_giacenza_merge` (vedi add_giacenze_merge_key.sql).
+Le colonne ubicazione_norm e note_hash sono generate da MySQL:
+ubicazione e note NULL o vuote sono considerate equivalenti.
+
+Ogni scrittura incrementa la colonna `version` (vedi add_giacenze_version.sql):
+le modifiche fatte dall'utente su un valore letto in precedenza usano
+`WHERE id = %s AND version = %s` (controllo di concorrenza ottimistico),
+così una modifica concorrente non viene sovrascritta in silenzio.
+"""
+import mysql.connector
+from mysql.connector import errorcode
+
+# Aggiunge la quantità alla giacenza con la stessa chiave naturale, o la crea
+UPSERT_GIACENZA_SQL = """
+    INSERT INTO giacenze (prodotto_id, magazzino_id, ubicazione, stato, quantita, note)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE quantita = quantita + VALUES(quantita), version = version + 1
+"""
+
+
+def upsert_giacenza(cursor, prodotto_id, magazzino_id, ubicazione, stato, quantita, note=None):
+    """
+    Carica `quantita` sulla giacenza identificata dalla chiave naturale,
+    creandola se non esiste. Una sola istruzione, senza SELECT preventiva.
+    """
+    cursor.execute(UPSERT_GIACENZA_SQL, (prodotto_id, magazzino_id, ubicazione, stato, quantita, note))
+
+
+def upsert_giacenze(cursor, righe):
+    """
+    Versione batch di upsert_giacenza().
+    `righe` è una lista di tuple (prodotto_id, magazzino_id, ubicazione, stato, quantita, note).
+    """
+    if righe:
+        cursor.executemany(UPSERT_GIACENZA_SQL, righe)
+
+
+def carica_giacenza(cursor, giacenza_id):
+    """Rilegge una giacenza (con la versione corrente), ad esempio per rispondere a un conflitto."""
+    cursor.execute("""
+        SELECT id, prodotto_id, magazzino_id, ubicazione, stato, quantita, note, version
+        FROM giacenze
+        WHERE id = %s
+    """, (giacenza_id,))
+    return cursor.fetchone()
+
+
+def aggiorna_quantita_giacenza(cursor, giacenza_id, quantita, version=None):
+    """
+    Imposta la quantità di una giacenza e ne incrementa la versione.
+    Se `version` è indicata l'aggiornamento avviene solo se la giacenza non è
+    stata modificata nel frattempo. Restituisce False in caso di conflitto.
+    """
+    query = "UPDATE giacenze SET quantita = %s, version = version + 1 WHERE id = %s"
+    params = [quantita, giacenza_id]
+    if version is not None:
+        query += " AND version = %s"
+        params.append(version)
+    cursor.execute(query, params)
+    return cursor.rowcount > 0
+
+
+def aggiorna_o_unisci_giacenza(cursor, giacenza_id, prodotto_id, magazzino_id, ubicazione, stato, quantita, note,
+                               version=None):
+    """
+    Aggiorna ubicazione/stato/quantità/note di una giacenza esistente.
+    Se la nuova chiave coincide con quella di un'altra giacenza (violazione
+    dell'indice UNIQUE), la quantità viene unita a quella giacenza e la riga
+    originale viene eliminata.
+
+    Con `version` indicata la modifica è condizionata alla versione letta:
+    restituisce False (senza modificare nulla) se la giacenza è cambiata.
+    """
+    filtro_versione = ""
+    params_versione = []
+    if version is not None:
+        filtro_versione = " AND version = %s"
+        params_versione = [version]
+
+    try:
+        cursor.execute("""
+            UPDATE giacenze
+            SET ubicazione = %s, stato = %s, quantita = %s, note = %s, version = version + 1
+            WHERE id = %s
+        """ + filtro_versione, (ubicazione, stato, quantita, note, giacenza_id, *params_versione))
+        return cursor.rowcount > 0
+    except mysql.connector.IntegrityError as e:
+        if e.errno != errorcode.ER_DUP_ENTRY:
+            raise
+        cursor.execute("DELETE FROM giacenze WHERE id = %s" + filtro_versione, (giacenza_id, *params_versione))
+        if cursor.rowcount == 0:
+            return False
+        upsert_giacenza(cursor, prodotto_id, magazzino_id, ubicazione, stato, quantita, note)
+        return True
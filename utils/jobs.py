@@ -0,0 +1,329 @@
+"""
+Job asincroni per esportazioni e report.
+
+Le esportazioni pesanti non occupano più un worker per tutta la durata
+della richiesta:
+
+    POST /api/jobs                      {tipo, parametri} -> {job_id}
+    GET  /api/jobs/<job_id>             stato e progresso (0-100)
+    GET  /api/jobs/<job_id>/download    file generato
+
+sottometti() scrive il job in export_jobs (add_export_jobs.sql) e lo passa
+al pool di thread del processo (WORKER_JOB thread). Stato, progresso e file
+sono nel database e in CARTELLA_JOB, quindi qualunque processo risponde a
+stato e download. Un job con gli stessi parametri (e la stessa versione dei
+dati) già in coda, in corso o completato viene riusato: la chiave è UNIQUE.
+I file completati scadono dopo TTL_MINUTI.
+
+Ogni job appartiene al processo che lo ha sottomesso (PROCESSO, token
+casuale per processo): finché il job è in coda o in corso il processo ne
+aggiorna heartbeat_at ogni HEARTBEAT_SECONDI. Se il processo termina (es.
+riavvio) l'heartbeat si ferma e dopo ORFANO_SECONDI il job viene segnato
+in errore, liberando la chiave: la richiesta successiva crea un nuovo job
+invece di restare agganciata a quello perso. Un job in corso da oltre
+TIMEOUT_MINUTI (contati da started_at) viene anch'esso segnato in errore e
+il suo risultato, se arriva dopo, viene scartato.
+
+I tipi di job si registrano con registra_tipo(); la funzione di
+generazione riceve il percorso da scrivere, i parametri e una funzione
+avanzamento(percentuale).
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from mysql.connector import errorcode, IntegrityError
+
+from database_connection import connect_to_database
+
+WORKER_JOB = int(os.getenv('EXPORT_JOBS_WORKER', '2'))
+TTL_MINUTI = int(os.getenv('EXPORT_JOBS_TTL_MINUTI', '60'))
+TIMEOUT_MINUTI = int(os.getenv('EXPORT_JOBS_TIMEOUT_MINUTI', '30'))
+CARTELLA_JOB = os.getenv(
+    'EXPORT_JOBS_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'export_jobs'))
+INTERVALLO_PROGRESSO = 1.0   # secondi tra due aggiornamenti del progresso
+HEARTBEAT_SECONDI = 10
+ORFANO_SECONDI = 3 * HEARTBEAT_SECONDI
+
+# Identifica il processo proprietario dei job che sottomette
+PROCESSO = uuid.uuid4().hex
+
+IN_CODA = 'IN_CODA'
+IN_CORSO = 'IN_CORSO'
+COMPLETATO = 'COMPLETATO'
+ERRORE = 'ERRORE'
+
+logger = logging.getLogger(__name__)
+
+TIPI = {}
+_executor = None
+_heartbeat = None
+_lock = threading.Lock()
+_attivi = set()   # job di questo processo in coda o in corso
+
+
+class JobNonValido(Exception):
+    """Tipo o parametri del job non validi."""
+
+
+class TipoJob:
+    def __init__(self, nome, genera, estensione, mimetype, nome_download, normalizza=None, versione=None):
+        self.nome = nome
+        self.genera = genera
+        self.estensione = estensione
+        self.mimetype = mimetype
+        self.nome_download = nome_download
+        self.normalizza = normalizza or (lambda parametri: {})
+        self.versione = versione or (lambda parametri: '')
+
+
+def registra_tipo(nome, genera, estensione, mimetype, nome_download, normalizza=None, versione=None):
+    """
+    Registra un tipo di job. normalizza(parametri) valida i parametri ricevuti
+    (JobNonValido se non validi); versione(parametri) entra nella chiave di
+    deduplicazione (es. versione dei dati: un job vecchio non viene riusato).
+    """
+    TIPI[nome] = TipoJob(nome, genera, estensione, mimetype, nome_download, normalizza, versione)
+
+
+def _pool():
+    global _executor, _heartbeat
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKER_JOB, thread_name_prefix='job-export')
+            _heartbeat = threading.Thread(target=_ciclo_heartbeat, name='job-export-heartbeat', daemon=True)
+            _heartbeat.start()
+    return _executor
+
+
+def _ciclo_heartbeat():
+    """Aggiorna heartbeat_at dei job di questo processo ancora in coda o in corso."""
+    while True:
+        time.sleep(HEARTBEAT_SECONDI)
+        with _lock:
+            attivi = list(_attivi)
+        if not attivi:
+            continue
+        try:
+            conn = connect_to_database()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"""
+                    UPDATE export_jobs SET heartbeat_at = NOW()
+                    WHERE id IN ({','.join(['%s'] * len(attivi))}) AND stato IN (%s, %s)
+                """, (*attivi, IN_CODA, IN_CORSO))
+                conn.commit()
+            finally:
+                cursor.close()
+                conn.close()
+        except Exception:
+            logger.exception('Heartbeat dei job di esportazione non riuscito')
+
+
+def _termina(job_id):
+    with _lock:
+        _attivi.discard(job_id)
+
+
+def _chiave(tipo, parametri, versione):
+    testo = json.dumps({'tipo': tipo, 'parametri': parametri, 'versione': versione}, sort_keys=True)
+    return hashlib.sha256(testo.encode()).hexdigest()
+
+
+def sottometti(app, tipo, parametri, user_id):
+    """
+    Crea (o riusa) il job e lo avvia nel pool. Restituisce (job_id, nuovo).
+    `app` serve al thread per il contesto Flask (template dei report).
+    """
+    definizione = TIPI.get(tipo)
+    if definizione is None:
+        raise JobNonValido('Tipo di job non valido')
+    parametri = definizione.normalizza(parametri or {})
+    chiave = _chiave(tipo, parametri, definizione.versione(parametri))
+
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        pulisci(cursor)
+        conn.commit()
+        job_id = uuid.uuid4().hex
+        try:
+            cursor.execute("""
+                INSERT INTO export_jobs (id, chiave, tipo, parametri, user_id, stato, processo, heartbeat_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+            """, (job_id, chiave, tipo, json.dumps(parametri), user_id, IN_CODA, PROCESSO))
+            conn.commit()
+        except IntegrityError as e:
+            if e.errno != errorcode.ER_DUP_ENTRY:
+                raise
+            conn.rollback()
+            cursor.execute("SELECT id FROM export_jobs WHERE chiave = %s", (chiave,))
+            esistente = cursor.fetchone()
+            if esistente:
+                return esistente['id'], False
+            raise
+    finally:
+        cursor.close()
+        conn.close()
+
+    pool = _pool()
+    with _lock:
+        _attivi.add(job_id)
+    pool.submit(_esegui, app, job_id)
+    return job_id, True
+
+
+def _aggiorna(job_id, sql, params=()):
+    """Aggiorna il job solo se è ancora in corso (non segnato in errore nel frattempo)."""
+    conn = connect_to_database()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"UPDATE export_jobs SET {sql} WHERE id = %s AND stato = %s", (*params, job_id, IN_CORSO))
+        conn.commit()
+        return cursor.rowcount > 0
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def _esegui(app, job_id):
+    try:
+        _esegui_job(app, job_id)
+    finally:
+        _termina(job_id)
+
+
+def _esegui_job(app, job_id):
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            UPDATE export_jobs SET stato = %s, started_at = NOW(), heartbeat_at = NOW()
+            WHERE id = %s AND stato = %s
+        """, (IN_CORSO, job_id, IN_CODA))
+        conn.commit()
+        if not cursor.rowcount:
+            return
+        cursor.execute("SELECT tipo, parametri FROM export_jobs WHERE id = %s", (job_id,))
+        job = cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+    definizione = TIPI[job['tipo']]
+    ultimo = {'valore': 0, 'istante': 0.0}
+
+    def avanzamento(percentuale):
+        percentuale = max(0, min(99, int(percentuale)))
+        adesso = time.monotonic()
+        if percentuale > ultimo['valore'] and adesso - ultimo['istante'] >= INTERVALLO_PROGRESSO:
+            ultimo.update(valore=percentuale, istante=adesso)
+            _aggiorna(job_id, "progresso = %s", (percentuale,))
+
+    os.makedirs(CARTELLA_JOB, exist_ok=True)
+    file = os.path.join(CARTELLA_JOB, f'{job_id}.{definizione.estensione}')
+    temporaneo = file + '.tmp'
+    try:
+        # Contesto di richiesta fittizio: render_template esegue i context
+        # processor dell'app, che leggono la sessione
+        with app.test_request_context():
+            definizione.genera(temporaneo, json.loads(job['parametri']), avanzamento)
+        os.replace(temporaneo, file)
+        completato = _aggiorna(job_id, """
+            stato = %s, progresso = 100, file = %s, finished_at = NOW(),
+            expires_at = NOW() + INTERVAL %s MINUTE
+        """, (COMPLETATO, os.path.basename(file), TTL_MINUTI))
+        if not completato:
+            # Segnato in errore (timeout) mentre era in corso: risultato scartato
+            os.remove(file)
+    except Exception as e:
+        logger.exception('Job %s (%s) non riuscito', job_id, job['tipo'])
+        if os.path.exists(temporaneo):
+            os.remove(temporaneo)
+        _aggiorna(job_id, """
+            stato = %s, errore = %s, chiave = NULL, finished_at = NOW(),
+            expires_at = NOW() + INTERVAL %s MINUTE
+        """, (ERRORE, str(e)[:1000], TTL_MINUTI))
+
+
+def segna_interrotti(cursor, job_id=None):
+    """
+    Segna in errore i job in coda o in corso il cui processo non aggiorna più
+    l'heartbeat (processo terminato) e quelli in corso da oltre TIMEOUT_MINUTI.
+    Con job_id controlla solo quel job (interrogazione dello stato).
+    """
+    filtro, params = ('AND id = %s', (job_id,)) if job_id else ('', ())
+    cursor.execute(f"""
+        UPDATE export_jobs
+        SET stato = %s, errore = 'Job interrotto', chiave = NULL, finished_at = NOW(),
+            expires_at = NOW() + INTERVAL %s MINUTE
+        WHERE stato IN (%s, %s)
+          AND (heartbeat_at < NOW() - INTERVAL %s SECOND
+               OR started_at < NOW() - INTERVAL %s MINUTE)
+          {filtro}
+    """, (ERRORE, TTL_MINUTI, IN_CODA, IN_CORSO, ORFANO_SECONDI, TIMEOUT_MINUTI, *params))
+
+
+def pulisci(cursor):
+    """
+    Elimina job e file scaduti e segna in errore i job interrotti.
+    Chiamata a ogni sottomissione (query su indice).
+    """
+    segna_interrotti(cursor)
+    cursor.execute("SELECT id, file FROM export_jobs WHERE expires_at < NOW()")
+    scaduti = cursor.fetchall()
+    for job in scaduti:
+        if job['file']:
+            try:
+                os.remove(os.path.join(CARTELLA_JOB, job['file']))
+            except FileNotFoundError:
+                pass
+    if scaduti:
+        cursor.execute(
+            f"DELETE FROM export_jobs WHERE id IN ({','.join(['%s'] * len(scaduti))})",
+            [job['id'] for job in scaduti])
+
+
+def leggi_job(cursor, job_id):
+    """
+    Job non scaduto, o None. L'id casuale è il token di download: un job
+    riusato da un'altra richiesta identica è visibile a chi ne conosce l'id.
+    """
+    cursor.execute("""
+        SELECT id, tipo, parametri, stato, progresso, file, errore,
+               created_at, started_at, finished_at, expires_at
+        FROM export_jobs
+        WHERE id = %s AND (expires_at IS NULL OR expires_at > NOW())
+    """, (job_id,))
+    return cursor.fetchone()
+
+
+def stato_job(job):
+    """Rappresentazione JSON dello stato del job."""
+    return {
+        'job_id': job['id'],
+        'tipo': job['tipo'],
+        'stato': job['stato'],
+        'progresso': job['progresso'],
+        'errore': job['errore'],
+        'creato': job['created_at'].isoformat() if job['created_at'] else None,
+        'completato': job['finished_at'].isoformat() if job['finished_at'] else None,
+        'scadenza': job['expires_at'].isoformat() if job['expires_at'] else None,
+    }
+
+
+def file_job(job):
+    """(percorso, mimetype, nome di download) del job completato, o None."""
+    if job['stato'] != COMPLETATO or not job['file']:
+        return None
+    percorso = os.path.join(CARTELLA_JOB, job['file'])
+    if not os.path.exists(percorso):
+        return None
+    definizione = TIPI[job['tipo']]
+    return percorso, definizione.mimetype, definizione.nome_download(json.loads(job['parametri']))
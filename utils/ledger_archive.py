@@ -0,0 +1,284 @@
+"""
+Partizioni mensili e archivio a freddo del registro movimenti.
+
+stock_ledger è partizionata per mese su data_ora (RANGE COLUMNS, partizioni
+pAAAAMM più pmax per le date future; le righe precedenti al primo mese,
+comprese quelle con la data segnaposto 1970-01-01 della migrazione, sono
+in un'unica partizione p_storico): le query delle statistiche, che
+filtrano sempre per intervallo di date, leggono solo le partizioni del
+periodo e non rallentano con l'accumularsi degli anni.
+
+Manutenzione mensile (es. cron il primo del mese alle 03:30):
+
+    python -m utils.ledger_archive crea        # partizioni dei prossimi mesi
+    python -m utils.ledger_archive archivia    # archivia i mesi oltre l'orizzonte
+    python -m utils.ledger_archive stato
+
+Le partizioni più vecchie di ORIZZONTE_MESI mesi vengono esportate in
+CARTELLA_ARCHIVIO (un file CSV gzip per mese, con righe ordinate per
+data_ora) e poi eliminate con DROP PARTITION, che non legge le righe e non
+attiva i trigger append-only. leggi_archivio() legge i file archiviati con
+gli stessi filtri di base del log movimenti.
+"""
+import csv
+import gzip
+import logging
+import os
+import re
+import sys
+from datetime import date, datetime
+
+from database_connection import connect_to_database
+
+ORIZZONTE_MESI = int(os.getenv('MOVIMENTI_ORIZZONTE_MESI', '24'))
+MESI_AVANTI = 3
+CARTELLA_ARCHIVIO = os.getenv(
+    'MOVIMENTI_ARCHIVIO_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'archivio_movimenti'))
+BLOCCO_ESPORTAZIONE = 5000
+
+COLONNE = ('id', 'data_ora', 'tipo_movimento', 'prodotto_id', 'quantita', 'quantita_netta',
+           'da_magazzino_id', 'a_magazzino_id', 'da_ubicazione', 'a_ubicazione', 'stato',
+           'note', 'tipo_scarico', 'user_id')
+COLONNE_INTERE = {'id', 'prodotto_id', 'quantita', 'quantita_netta', 'da_magazzino_id',
+                  'a_magazzino_id', 'user_id'}
+
+NOME_PARTIZIONE = re.compile(r'^p(\d{4})(\d{2})$')
+PARTIZIONE_STORICO = 'p_storico'
+# Data assegnata da add_stock_ledger_partitions.sql alle righe senza data_ora
+DATA_SEGNAPOSTO = '1970-01-01 00:00:00'
+NOME_FILE = re.compile(r'^stock_ledger_(\d{4})(\d{2})\.csv\.gz$')
+
+logger = logging.getLogger(__name__)
+
+
+def _mese_successivo(mese):
+    return date(mese.year + mese.month // 12, mese.month % 12 + 1, 1)
+
+
+def _aggiungi_mesi(mese, mesi):
+    indice = mese.year * 12 + mese.month - 1 + mesi
+    return date(indice // 12, indice % 12 + 1, 1)
+
+
+def partizioni(cursor):
+    """Partizioni di stock_ledger in ordine: [{nome, mese, righe}], mese None per pmax."""
+    cursor.execute("""
+        SELECT PARTITION_NAME AS nome, TABLE_ROWS AS righe
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'stock_ledger'
+          AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """)
+    risultato = []
+    for riga in cursor.fetchall():
+        corrispondenza = NOME_PARTIZIONE.match(riga['nome'])
+        mese = date(int(corrispondenza.group(1)), int(corrispondenza.group(2)), 1) if corrispondenza else None
+        risultato.append({'nome': riga['nome'], 'mese': mese, 'righe': int(riga['righe'] or 0)})
+    return risultato
+
+
+def crea_partizioni(cursor, mesi_avanti=MESI_AVANTI):
+    """
+    Divide pmax in partizioni mensili fino a `mesi_avanti` mesi dopo quello
+    corrente. Alla prima esecuzione parte dal mese della riga più vecchia
+    (esclusa la data segnaposto), ma non prima dell'orizzonte di
+    archiviazione: le righe precedenti vanno tutte in p_storico, invece di
+    creare una partizione vuota per ogni mese.
+    Restituisce i nomi delle partizioni create.
+    """
+    esistenti = partizioni(cursor)
+    if not esistenti:
+        raise RuntimeError('stock_ledger non è partizionata: eseguire add_stock_ledger_partitions.sql')
+    mensili = [p['mese'] for p in esistenti if p['mese']]
+    storico = not mensili and all(p['nome'] != PARTIZIONE_STORICO for p in esistenti)
+    if mensili:
+        mese = _mese_successivo(mensili[-1])
+    else:
+        cursor.execute("SELECT MIN(data_ora) AS prima FROM stock_ledger WHERE data_ora > %s", (DATA_SEGNAPOSTO,))
+        prima = cursor.fetchone()['prima'] or datetime.now()
+        orizzonte = _aggiungi_mesi(date.today().replace(day=1), -ORIZZONTE_MESI)
+        mese = max(date(prima.year, prima.month, 1), orizzonte)
+
+    ultimo = _aggiungi_mesi(date.today().replace(day=1), mesi_avanti)
+    nuove = []
+    while mese <= ultimo:
+        nuove.append(mese)
+        mese = _mese_successivo(mese)
+    if not nuove:
+        return []
+
+    definizioni = [f"PARTITION p{m:%Y%m} VALUES LESS THAN ('{_mese_successivo(m):%Y-%m-%d}')" for m in nuove]
+    if storico:
+        definizioni.insert(0, f"PARTITION {PARTIZIONE_STORICO} VALUES LESS THAN ('{nuove[0]:%Y-%m-%d}')")
+    cursor.execute(f"""
+        ALTER TABLE stock_ledger REORGANIZE PARTITION pmax INTO (
+            {', '.join(definizioni)}, PARTITION pmax VALUES LESS THAN (MAXVALUE)
+        )
+    """)
+    return ([PARTIZIONE_STORICO] if storico else []) + [f'p{m:%Y%m}' for m in nuove]
+
+
+def _percorso_file(mese, cartella):
+    return os.path.join(cartella, f'stock_ledger_{mese:%Y%m}.csv.gz')
+
+
+def _esporta_partizione(conn, nome, percorso):
+    """Scrive le righe della partizione in un CSV gzip. Restituisce le righe scritte."""
+    temporaneo = percorso + '.tmp'
+    cursor = conn.cursor()
+    scritte = 0
+    try:
+        cursor.execute(f"SELECT {', '.join(COLONNE)} FROM stock_ledger PARTITION ({nome}) ORDER BY data_ora, id")
+        with gzip.open(temporaneo, 'wt', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(COLONNE)
+            while True:
+                righe = cursor.fetchmany(BLOCCO_ESPORTAZIONE)
+                if not righe:
+                    break
+                writer.writerows(righe)
+                scritte += len(righe)
+    except Exception:
+        if os.path.exists(temporaneo):
+            os.remove(temporaneo)
+        raise
+    finally:
+        cursor.close()
+    os.replace(temporaneo, percorso)
+    return scritte
+
+
+def archivia_partizioni(orizzonte_mesi=ORIZZONTE_MESI, cartella=CARTELLA_ARCHIVIO):
+    """
+    Esporta ed elimina le partizioni dei mesi precedenti l'orizzonte. Una
+    partizione viene eliminata solo se il file contiene tutte le sue righe.
+    p_storico viene archiviata nel file del mese precedente il suo limite
+    (il file più vecchio contiene anche le righe precedenti al suo mese).
+    Restituisce {nome_partizione: righe archiviate}.
+    """
+    os.makedirs(cartella, exist_ok=True)
+    limite = _aggiungi_mesi(date.today().replace(day=1), -orizzonte_mesi)
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    archiviate = {}
+    try:
+        elenco = partizioni(cursor)
+        for indice, partizione in enumerate(elenco):
+            mese = partizione['mese']
+            if partizione['nome'] == PARTIZIONE_STORICO:
+                successiva = elenco[indice + 1]['mese'] if indice + 1 < len(elenco) else None
+                if not successiva or successiva > limite:
+                    continue
+                mese = _aggiungi_mesi(successiva, -1)
+            if not mese or mese >= limite:
+                continue
+            nome = partizione['nome']
+            cursor.execute(f"SELECT COUNT(*) AS righe FROM stock_ledger PARTITION ({nome})")
+            attese = cursor.fetchone()['righe']
+            scritte = _esporta_partizione(conn, nome, _percorso_file(mese, cartella))
+            if scritte != attese:
+                raise RuntimeError(f'{nome}: esportate {scritte} righe su {attese}, partizione non eliminata')
+            cursor.execute(f"ALTER TABLE stock_ledger DROP PARTITION {nome}")
+            archiviate[nome] = scritte
+            logger.info('Partizione %s archiviata (%s righe)', nome, scritte)
+    finally:
+        cursor.close()
+        conn.close()
+    return archiviate
+
+
+def file_archivio(cartella=CARTELLA_ARCHIVIO):
+    """File archiviati in ordine di mese: [{mese, percorso, byte}]."""
+    if not os.path.isdir(cartella):
+        return []
+    risultato = []
+    for nome in sorted(os.listdir(cartella)):
+        corrispondenza = NOME_FILE.match(nome)
+        if corrispondenza:
+            percorso = os.path.join(cartella, nome)
+            risultato.append({'mese': date(int(corrispondenza.group(1)), int(corrispondenza.group(2)), 1),
+                              'percorso': percorso, 'byte': os.path.getsize(percorso)})
+    return risultato
+
+
+def _converti(riga):
+    for colonna in COLONNE_INTERE:
+        riga[colonna] = int(riga[colonna]) if riga[colonna] != '' else None
+    riga['data_ora'] = datetime.fromisoformat(riga['data_ora'])
+    for colonna in ('da_ubicazione', 'a_ubicazione', 'stato', 'note', 'tipo_scarico'):
+        riga[colonna] = riga[colonna] or None
+    return riga
+
+
+def leggi_archivio(data_da, data_a, prodotto_id=None, user_id=None, tipo=None, cartella=CARTELLA_ARCHIVIO):
+    """
+    Righe archiviate con data_da <= data_ora < data_a (datetime), in ordine
+    di data, filtrate per prodotto, utente e tipo. Legge solo i file dei
+    mesi dell'intervallo (il file più vecchio contiene anche le righe
+    precedenti al suo mese).
+    """
+    for indice, archivio in enumerate(file_archivio(cartella)):
+        inizio = datetime.combine(archivio['mese'], datetime.min.time())
+        if inizio >= data_a:
+            break
+        if indice > 0 and datetime.combine(_mese_successivo(archivio['mese']), datetime.min.time()) <= data_da:
+            continue
+        with gzip.open(archivio['percorso'], 'rt', encoding='utf-8', newline='') as file:
+            for riga in csv.DictReader(file):
+                riga = _converti(riga)
+                if not data_da <= riga['data_ora'] < data_a:
+                    continue
+                if prodotto_id is not None and riga['prodotto_id'] != prodotto_id:
+                    continue
+                if user_id is not None and riga['user_id'] != user_id:
+                    continue
+                if tipo and riga['tipo_movimento'] != tipo:
+                    continue
+                yield riga
+
+
+def stato_archivio_movimenti(cursor):
+    """Partizioni attive e file archiviati, per il pannello admin."""
+    return {
+        'orizzonte_mesi': ORIZZONTE_MESI,
+        'partizioni': [{'nome': p['nome'], 'mese': p['mese'].isoformat() if p['mese'] else None,
+                        'righe_stimate': p['righe']} for p in partizioni(cursor)],
+        'archiviati': [{'mese': f['mese'].isoformat(), 'file': os.path.basename(f['percorso']),
+                        'byte': f['byte']} for f in file_archivio()],
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    comando = sys.argv[1] if len(sys.argv) > 1 else 'stato'
+    try:
+        if comando == 'crea':
+            conn = connect_to_database()
+            cursor = conn.cursor(dictionary=True)
+            try:
+                logger.info('Partizioni create: %s', ', '.join(crea_partizioni(cursor)) or 'nessuna')
+            finally:
+                cursor.close()
+                conn.close()
+        elif comando == 'archivia':
+            mesi = int(sys.argv[2]) if len(sys.argv) > 2 else ORIZZONTE_MESI
+            logger.info('Partizioni archiviate: %s', archivia_partizioni(mesi) or 'nessuna')
+        elif comando == 'stato':
+            conn = connect_to_database()
+            cursor = conn.cursor(dictionary=True)
+            try:
+                stato = stato_archivio_movimenti(cursor)
+            finally:
+                cursor.close()
+                conn.close()
+            for p in stato['partizioni']:
+                print(f"{p['nome']:<10} {p['righe_stimate']:>12} righe (stima)")
+            for f in stato['archiviati']:
+                print(f"{f['file']:<32} {f['byte']:>12} byte")
+        else:
+            print('Uso: python -m utils.ledger_archive [crea|archivia [mesi]|stato]')
+            sys.exit(2)
+    except Exception as e:
+        logger.error('Manutenzione registro movimenti non riuscita: %s', e)
+        sys.exit(1)
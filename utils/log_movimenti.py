@@ -0,0 +1,194 @@
+"""
+Log movimenti paginato lato server.
+
+Il log legge il registro unico stock_ledger (movimenti e scarichi). Invece
+di leggere e ordinare tutte le righe, ogni pagina legge al massimo `limite`
+righe in ordine (data_ora, id) decrescente a partire dal cursore dell'ultima
+riga vista (keyset pagination), con i filtri applicati nel database:
+
+  utente / prodotto   testo risolto prima in id (utenti / prodotti), poi
+                      indici (user_id, data_ora) e (prodotto_id, data_ora)
+  magazzino           id del magazzino, indici (da_/a_magazzino_id, data_ora)
+  tipo                indice (tipo_movimento, data_ora)
+  data_da / data_a    intervallo su data_ora
+  q                   ricerca libera nelle note (LIKE, sulle righe già ristrette
+                      dagli altri filtri e dalle partizioni del periodo)
+
+Il registro e i suoi indici sono creati da add_stock_ledger.sql; la tabella
+è partizionata per mese (add_stock_ledger_partitions.sql).
+"""
+import base64
+from datetime import datetime, timedelta
+
+LIMITE_DEFAULT = 100
+LIMITE_MASSIMO = 500
+MAX_ID_RISOLTI = 500
+
+TIPI_MOVIMENTO = ('CARICO', 'SCARICO', 'TRASFERIMENTO', 'MODIFICA')
+
+
+class FiltroNonValido(Exception):
+    """Filtro o cursore del log movimenti non valido."""
+
+
+def codifica_cursore(riga):
+    testo = f"{riga['data_ora'].isoformat()}|{riga['id']}"
+    return base64.urlsafe_b64encode(testo.encode()).decode()
+
+
+def decodifica_cursore(cursore):
+    try:
+        data_ora, riga_id = base64.urlsafe_b64decode(cursore.encode()).decode().split('|')
+        return datetime.fromisoformat(data_ora), int(riga_id)
+    except (ValueError, UnicodeDecodeError):
+        raise FiltroNonValido('Cursore non valido')
+
+
+def _data(valore, nome):
+    try:
+        return datetime.strptime(valore, '%Y-%m-%d')
+    except ValueError:
+        raise FiltroNonValido(f'{nome} non valida (formato AAAA-MM-GG)')
+
+
+def _intero(valore, nome):
+    try:
+        return int(valore)
+    except (TypeError, ValueError):
+        raise FiltroNonValido(f'{nome} non valido')
+
+
+def _risolvi_ids(cursor, query, testo):
+    """Testo libero -> id corrispondenti (None se il testo è vuoto)."""
+    if not testo:
+        return None
+    cursor.execute(query, (f'%{testo}%', MAX_ID_RISOLTI))
+    return [riga['id'] for riga in cursor.fetchall()]
+
+
+def _condizione_cursore(cursore):
+    """Righe successive al cursore nell'ordine (data_ora, id) DESC."""
+    data_ora, riga_id = cursore
+    # Forma espansa (non row constructor) così l'intervallo su data_ora usa l'indice
+    return "sl.data_ora <= %s AND (sl.data_ora < %s OR sl.id < %s)", [data_ora, data_ora, riga_id]
+
+
+def normalizza_filtri(cursor, args):
+    """Parametri della richiesta -> filtri con gli id già risolti."""
+    filtri = {
+        'user_ids': _risolvi_ids(cursor, "SELECT id FROM utenti WHERE username LIKE %s LIMIT %s",
+                                 (args.get('utente') or '').strip()),
+        'prodotto_ids': _risolvi_ids(cursor, "SELECT id FROM prodotti WHERE nome_prodotto LIKE %s LIMIT %s",
+                                     (args.get('prodotto') or '').strip()),
+        'magazzino_id': None,
+        'tipo': (args.get('tipo') or '').strip().upper() or None,
+        'data_da': None,
+        'data_a': None,
+        'quantita_min': None,
+        'quantita_max': None,
+        'ubicazione': (args.get('ubicazione') or '').strip() or None,
+        'q': (args.get('q') or '').strip() or None,
+    }
+    if filtri['tipo'] and filtri['tipo'] not in TIPI_MOVIMENTO:
+        raise FiltroNonValido('Tipo movimento non valido')
+    if args.get('magazzino'):
+        filtri['magazzino_id'] = _intero(args['magazzino'], 'Magazzino')
+    if args.get('data_da'):
+        filtri['data_da'] = _data(args['data_da'], 'Data iniziale')
+    if args.get('data_a'):
+        filtri['data_a'] = _data(args['data_a'], 'Data finale') + timedelta(days=1)
+    if args.get('quantita_min'):
+        filtri['quantita_min'] = _intero(args['quantita_min'], 'Quantità minima')
+    if args.get('quantita_max'):
+        filtri['quantita_max'] = _intero(args['quantita_max'], 'Quantità massima')
+    return filtri
+
+
+def _condizioni(filtri, cursore):
+    condizioni, params = [], []
+    for chiave, colonna in (('user_ids', 'user_id'), ('prodotto_ids', 'prodotto_id')):
+        if filtri[chiave] is not None:
+            condizioni.append(f"sl.{colonna} IN ({','.join(['%s'] * len(filtri[chiave]))})")
+            params.extend(filtri[chiave])
+    if filtri['magazzino_id'] is not None:
+        condizioni.append("(sl.da_magazzino_id = %s OR sl.a_magazzino_id = %s)")
+        params.extend([filtri['magazzino_id'], filtri['magazzino_id']])
+    if filtri['tipo']:
+        condizioni.append("sl.tipo_movimento = %s")
+        params.append(filtri['tipo'])
+    if filtri['ubicazione']:
+        condizioni.append("(sl.da_ubicazione LIKE %s OR sl.a_ubicazione LIKE %s)")
+        params.extend([f"%{filtri['ubicazione']}%"] * 2)
+    if filtri['data_da']:
+        condizioni.append("sl.data_ora >= %s")
+        params.append(filtri['data_da'])
+    if filtri['data_a']:
+        condizioni.append("sl.data_ora < %s")
+        params.append(filtri['data_a'])
+    if filtri['quantita_min'] is not None:
+        condizioni.append("sl.quantita >= %s")
+        params.append(filtri['quantita_min'])
+    if filtri['quantita_max'] is not None:
+        condizioni.append("sl.quantita <= %s")
+        params.append(filtri['quantita_max'])
+    if filtri['q']:
+        # Le tabelle partizionate non supportano indici FULLTEXT
+        condizioni.append("sl.note LIKE %s")
+        params.append(f"%{filtri['q']}%")
+    if cursore:
+        condizione, valori = _condizione_cursore(cursore)
+        condizioni.append(condizione)
+        params.extend(valori)
+    return condizioni, params
+
+
+def leggi_pagina(cursor, filtri, cursore=None, limite=LIMITE_DEFAULT):
+    """
+    Una pagina del log: {movimenti, next_cursor, has_more}. Legge al massimo
+    limite + 1 righe dall'indice, già nell'ordine della pagina.
+    """
+    limite = max(1, min(int(limite), LIMITE_MASSIMO))
+    posizione = decodifica_cursore(cursore) if cursore else None
+
+    if filtri['user_ids'] == [] or filtri['prodotto_ids'] == []:
+        return {'movimenti': [], 'next_cursor': None, 'has_more': False}
+
+    condizioni, params = _condizioni(filtri, posizione)
+    where = f"WHERE {' AND '.join(condizioni)}" if condizioni else ''
+    cursor.execute(f"""
+        SELECT
+            sl.id, sl.data_ora,
+            u.username,
+            p.nome_prodotto,
+            m1.nome AS da_magazzino,
+            m2.nome AS a_magazzino,
+            sl.da_ubicazione,
+            sl.a_ubicazione,
+            sl.quantita,
+            CASE WHEN sl.tipo_scarico IS NULL THEN sl.note
+                 ELSE CONCAT('Tipo scarico: ', sl.tipo_scarico,
+                             CASE WHEN sl.note IS NOT NULL AND sl.note != ''
+                                  THEN CONCAT(' - ', sl.note)
+                                  ELSE '' END)
+            END AS note,
+            sl.stato,
+            sl.tipo_movimento
+        FROM stock_ledger sl
+        LEFT JOIN utenti u ON sl.user_id = u.id
+        LEFT JOIN prodotti p ON sl.prodotto_id = p.id
+        LEFT JOIN magazzini m1 ON sl.da_magazzino_id = m1.id
+        LEFT JOIN magazzini m2 ON sl.a_magazzino_id = m2.id
+        {where}
+        ORDER BY sl.data_ora DESC, sl.id DESC
+        LIMIT %s
+    """, (*params, limite + 1))
+    righe = cursor.fetchall()
+
+    has_more = len(righe) > limite
+    righe = righe[:limite]
+    for riga in righe:
+        riga['data_ora_fmt'] = riga['data_ora'].strftime('%d/%m/%Y %H:%M') if riga['data_ora'] else None
+    next_cursor = codifica_cursore(righe[-1]) if has_more and righe else None
+    for riga in righe:
+        riga['data_ora'] = riga['data_ora'].isoformat() if riga['data_ora'] else None
+    return {'movimenti': righe, 'next_cursor': next_cursor, 'has_more': has_more}
@@ -0,0 +1,259 @@
+"""
+Esecuzione set-based del Movimento Multiplo.
+
+Invece di eseguire 5-6 query per ogni riga del batch, tutte le giacenze
+coinvolte vengono caricate con un'unica SELECT ... FOR UPDATE, i movimenti
+vengono validati e pianificati in memoria e le modifiche vengono applicate
+con poche istruzioni: un INSERT multiplo per i movimenti, un unico UPDATE
+con JOIN per le quantità, un DELETE ... IN e l'upsert delle nuove giacenze.
+"""
+from utils.giacenze import upsert_giacenze
+from utils.outbox import registra_eventi
+
+
+def _chiave_testo(valore):
+    """
+    Normalizza un testo per il confronto in memoria.
+    Replica il comportamento della collation utf8mb4_unicode_ci
+    (case-insensitive, spazi finali ignorati).
+    """
+    if valore is None:
+        return None
+    return str(valore).rstrip().casefold()
+
+
+def _stessa_ubicazione(a, b):
+    """
+    Confronto null-safe con NULL e stringa vuota equivalenti, come la colonna
+    generata ubicazione_norm (confrontata con la collation della tabella).
+    """
+    return _chiave_testo(a or '') == _chiave_testo(b or '')
+
+
+def _stessa_nota(a, b):
+    """
+    Confronto esatto con NULL e stringa vuota equivalenti, come
+    note_hash = MD5(COALESCE(note, '')): maiuscole e spazi finali contano.
+    """
+    return (a or '') == (b or '')
+
+
+def normalizza_movimenti(movimenti):
+    """
+    Converte le righe ricevute dal frontend in dizionari con tipi coerenti.
+    Restituisce (righe, errori): le righe non valide producono un errore.
+    """
+    righe = []
+    errori = []
+    for i, mov in enumerate(movimenti):
+        try:
+            prodotto_id = int(mov.get('prodotto_id') or 0)
+        except (TypeError, ValueError):
+            prodotto_id = 0
+        try:
+            quantita = int(mov.get('quantita') or 0)
+        except (TypeError, ValueError):
+            quantita = 0
+
+        if not prodotto_id:
+            errori.append(f'Movimento {i+1}: prodotto mancante')
+            continue
+        if quantita <= 0:
+            errori.append(f'Movimento {i+1}: quantità non valida')
+            continue
+
+        righe.append({
+            'indice': i,
+            'prodotto_id': prodotto_id,
+            'da_ubicazione': mov.get('da_ubicazione'),
+            'a_ubicazione': mov.get('a_ubicazione') or None,
+            'quantita': quantita,
+            'nota': mov.get('nota', ''),
+            'stato_destinazione': mov.get('stato_destinazione'),
+        })
+    return righe, errori
+
+
+def carica_giacenze_coinvolte(cursor, prodotto_ids, stati):
+    """
+    Carica e blocca (FOR UPDATE) tutte le giacenze dei prodotti indicati
+    negli stati di origine e destinazione, con un'unica query.
+    Le righe sono ordinate per id: i lock vengono presi sempre nello stesso ordine.
+    """
+    prodotto_ids = sorted(set(prodotto_ids))
+    stati = sorted({s for s in stati if s})
+    if not prodotto_ids or not stati:
+        return []
+
+    ph_prodotti = ','.join(['%s'] * len(prodotto_ids))
+    ph_stati = ','.join(['%s'] * len(stati))
+    cursor.execute(f"""
+        SELECT id, prodotto_id, magazzino_id, ubicazione, stato, quantita, note
+        FROM giacenze
+        WHERE prodotto_id IN ({ph_prodotti}) AND stato IN ({ph_stati})
+        ORDER BY id
+        FOR UPDATE
+    """, (*prodotto_ids, *stati))
+    return cursor.fetchall()
+
+
+def pianifica_movimenti(righe, stato_origine, giacenze, user_id):
+    """
+    Valida e pianifica in memoria l'intero batch.
+
+    `giacenze` è il risultato di carica_giacenze_coinvolte(). Le righe vengono
+    applicate in sequenza su una copia in memoria, quindi più movimenti che
+    prelevano dalla stessa giacenza vengono validati sulla quantità residua.
+
+    Restituisce (errori, piano). Il piano contiene:
+      - movimenti: tuple per INSERT INTO movimenti
+      - aggiornamenti: tuple (quantita, id) per le giacenze esistenti modificate
+      - eliminazioni: id delle giacenze esistenti da eliminare
+      - inserimenti: tuple per upsert_giacenze() (nuove destinazioni)
+    """
+    # Stato in memoria delle giacenze, indicizzato per prodotto
+    righe_giacenze = {}
+    per_prodotto = {}
+    for g in giacenze:
+        riga = dict(g)
+        riga['quantita_originale'] = riga['quantita']
+        riga['eliminata'] = False
+        riga['nuova'] = False
+        righe_giacenze[riga['id']] = riga
+        per_prodotto.setdefault(riga['prodotto_id'], []).append(riga)
+
+    chiave_stato_origine = _chiave_testo(stato_origine)
+    errori = []
+    movimenti = []
+    nuove = []
+
+    for r in righe:
+        n = r['indice'] + 1
+        candidati = per_prodotto.get(r['prodotto_id'], [])
+
+        # Giacenza di origine (prodotto, stato origine, ubicazione)
+        origine = None
+        if r['da_ubicazione'] is not None and chiave_stato_origine is not None:
+            chiave_ubicazione = _chiave_testo(r['da_ubicazione'])
+            for g in candidati:
+                if (not g['eliminata']
+                        and _chiave_testo(g['stato']) == chiave_stato_origine
+                        and _chiave_testo(g['ubicazione']) == chiave_ubicazione):
+                    origine = g
+                    break
+
+        if not origine:
+            errori.append(f'Movimento {n}: giacenza non trovata per ubicazione {r["da_ubicazione"]}')
+            continue
+        if origine['quantita'] < r['quantita']:
+            errori.append(f'Movimento {n}: giacenza insufficiente (disponibili: {origine["quantita"]}, richiesti: {r["quantita"]})')
+            continue
+
+        magazzino_id = origine['magazzino_id']
+
+        # Tipo movimento: sempre TRASFERIMENTO per movimento multiplo
+        # SCARICO e CARICO sono riservati alle rispettive pagine dedicate
+        movimenti.append((
+            r['prodotto_id'], magazzino_id, magazzino_id,
+            r['da_ubicazione'], r['a_ubicazione'], r['quantita'], r['nota'],
+            user_id, r['stato_destinazione'], 'TRASFERIMENTO'
+        ))
+
+        # Decrementa origine
+        origine['quantita'] -= r['quantita']
+        if origine['quantita'] <= 0:
+            origine['eliminata'] = True
+
+        # Destinazione: stesso prodotto, stato, ubicazione e nota
+        destinazione = None
+        chiave_stato_dest = _chiave_testo(r['stato_destinazione'])
+        for g in candidati:
+            if g['eliminata'] or _chiave_testo(g['stato']) != chiave_stato_dest:
+                continue
+            if not _stessa_ubicazione(g['ubicazione'], r['a_ubicazione']):
+                continue
+            if not _stessa_nota(g['note'], r['nota']):
+                continue
+            destinazione = g
+            break
+
+        if destinazione:
+            destinazione['quantita'] += r['quantita']
+        else:
+            nuova = {
+                'id': None,
+                'prodotto_id': r['prodotto_id'],
+                'magazzino_id': magazzino_id,
+                'ubicazione': r['a_ubicazione'],
+                'stato': r['stato_destinazione'],
+                'quantita': r['quantita'],
+                'note': r['nota'],
+                'eliminata': False,
+                'nuova': True,
+            }
+            candidati.append(nuova)
+            per_prodotto[r['prodotto_id']] = candidati
+            nuove.append(nuova)
+
+    if errori:
+        return errori, None
+
+    aggiornamenti = []
+    eliminazioni = []
+    for g in righe_giacenze.values():
+        if g['eliminata']:
+            eliminazioni.append(g['id'])
+        elif g['quantita'] != g['quantita_originale']:
+            aggiornamenti.append((g['quantita'], g['id']))
+
+    inserimenti = [
+        (g['prodotto_id'], g['magazzino_id'], g['ubicazione'], g['stato'], g['quantita'], g['note'])
+        for g in nuove if not g['eliminata']
+    ]
+
+    piano = {
+        'movimenti': movimenti,
+        'aggiornamenti': aggiornamenti,
+        'eliminazioni': sorted(eliminazioni),
+        'inserimenti': inserimenti,
+    }
+    return [], piano
+
+
+def applica_piano(cursor, piano):
+    """Applica il piano calcolato da pianifica_movimenti() con istruzioni batch."""
+    if piano['movimenti']:
+        cursor.executemany("""
+            INSERT INTO movimenti (
+                prodotto_id, da_magazzino_id, a_magazzino_id,
+                da_ubicazione, a_ubicazione, quantita, note,
+                user_id, stato, tipo_movimento
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, piano['movimenti'])
+
+    if piano['aggiornamenti']:
+        # Un solo UPDATE: le nuove quantità arrivano da una tabella derivata
+        valori = ' UNION ALL '.join(
+            ['SELECT %s AS id, %s AS quantita'] + ['SELECT %s, %s'] * (len(piano['aggiornamenti']) - 1))
+        params = [v for quantita, giacenza_id in piano['aggiornamenti'] for v in (giacenza_id, quantita)]
+        cursor.execute(f"""
+            UPDATE giacenze g
+            JOIN ({valori}) v ON v.id = g.id
+            SET g.quantita = v.quantita, g.version = g.version + 1
+        """, params)
+
+    if piano['eliminazioni']:
+        placeholder = ','.join(['%s'] * len(piano['eliminazioni']))
+        cursor.execute(f"DELETE FROM giacenze WHERE id IN ({placeholder})", piano['eliminazioni'])
+
+    # Upsert sulla chiave naturale: una giacenza equivalente creata nel
+    # frattempo viene incrementata invece di essere duplicata
+    upsert_giacenze(cursor, piano['inserimenti'])
+
+    registra_eventi(cursor, [
+        (tipo, prodotto_id, quantita, user_id,
+         {'da_ubicazione': da_ubicazione, 'a_ubicazione': a_ubicazione, 'a_stato': stato,
+          'da_magazzino_id': da_magazzino_id, 'a_magazzino_id': a_magazzino_id})
+        for (prodotto_id, da_magazzino_id, a_magazzino_id, da_ubicazione, a_ubicazione,
+             quantita, _note, user_id, stato, tipo) in piano['movimenti']
+    ])
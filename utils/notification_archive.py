@@ -0,0 +1,107 @@
+"""
+Archiviazione delle notifiche lette.
+
+Le notifiche lette da più di RETENTION_GIORNI giorni vengono spostate in
+notifications_archive a blocchi di DIMENSIONE_BLOCCO righe: ogni blocco è
+una transazione breve (INSERT ... SELECT + DELETE per id), con una pausa
+tra un blocco e l'altro, così la tabella usata dal feed resta piccola senza
+lock lunghi. Da eseguire di notte, dopo il controllo completo delle soglie:
+
+    python -m utils.notification_archive [giorni]   # es. cron alle 03:00
+"""
+import logging
+import os
+import sys
+import time
+
+from database_connection import connect_to_database
+
+RETENTION_GIORNI = int(os.getenv('NOTIFICHE_RETENTION_GIORNI', '90'))
+DIMENSIONE_BLOCCO = 500
+PAUSA_BLOCCHI = 0.1   # secondi
+
+COLONNE = ('id, user_id, codice_prodotto, nome_prodotto, quantita_attuale, soglia_minima, '
+           'magazzino, data_notifica, visualizzata, data_visualizzazione')
+
+logger = logging.getLogger(__name__)
+
+
+def archivia_blocco(cursor, giorni, limite=DIMENSIONE_BLOCCO):
+    """Sposta in archivio un blocco di notifiche lette. Restituisce le righe spostate."""
+    cursor.execute("""
+        SELECT id FROM notifications
+        WHERE visualizzata = TRUE AND data_visualizzazione < NOW() - INTERVAL %s DAY
+        ORDER BY data_visualizzazione
+        LIMIT %s
+        FOR UPDATE
+    """, (giorni, limite))
+    ids = [riga['id'] for riga in cursor.fetchall()]
+    if not ids:
+        return 0
+    placeholder = ','.join(['%s'] * len(ids))
+    cursor.execute(f"""
+        INSERT INTO notifications_archive ({COLONNE})
+        SELECT {COLONNE} FROM notifications WHERE id IN ({placeholder})
+    """, ids)
+    cursor.execute(f"DELETE FROM notifications WHERE id IN ({placeholder})", ids)
+    return len(ids)
+
+
+def archivia_notifiche_lette(giorni=RETENTION_GIORNI, limite=DIMENSIONE_BLOCCO):
+    """Archivia tutte le notifiche lette più vecchie di `giorni`, un blocco per transazione."""
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    archiviate = 0
+    try:
+        while True:
+            spostate = archivia_blocco(cursor, giorni, limite)
+            conn.commit()
+            archiviate += spostate
+            if spostate < limite:
+                break
+            time.sleep(PAUSA_BLOCCHI)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    return archiviate
+
+
+def stato_archivio(cursor):
+    """Conteggi per il pannello admin: notifiche attive, lette, archiviabili e archiviate."""
+    cursor.execute("""
+        SELECT COUNT(*) AS totale,
+               COALESCE(SUM(visualizzata = FALSE), 0) AS non_lette,
+               COALESCE(SUM(visualizzata = TRUE), 0) AS lette,
+               COALESCE(SUM(visualizzata = TRUE
+                            AND data_visualizzazione < NOW() - INTERVAL %s DAY), 0) AS da_archiviare
+        FROM notifications
+    """, (RETENTION_GIORNI,))
+    attive = cursor.fetchone()
+    cursor.execute("""
+        SELECT COUNT(*) AS archiviate, MIN(data_notifica) AS piu_vecchia, MAX(archiviata_at) AS ultima_archiviazione
+        FROM notifications_archive
+    """)
+    archivio = cursor.fetchone()
+    return {
+        'retention_giorni': RETENTION_GIORNI,
+        'totale': int(attive['totale']),
+        'non_lette': int(attive['non_lette']),
+        'lette': int(attive['lette']),
+        'da_archiviare': int(attive['da_archiviare']),
+        'archiviate': int(archivio['archiviate']),
+        'piu_vecchia_archiviata': archivio['piu_vecchia'],
+        'ultima_archiviazione': archivio['ultima_archiviazione'],
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    giorni = int(sys.argv[1]) if len(sys.argv) > 1 else RETENTION_GIORNI
+    try:
+        logger.info('Notifiche lette da più di %s giorni archiviate: %s', giorni, archivia_notifiche_lette(giorni))
+    except Exception as e:
+        logger.error('Archiviazione notifiche non riuscita: %s', e)
+        sys.exit(1)
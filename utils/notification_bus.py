@@ -0,0 +1,219 @@
+"""
+Pub/sub in-process per il canale push delle notifiche.
+
+Ogni utente ha un numero di versione che cresce quando le sue notifiche
+cambiano. Le connessioni SSE (/notifications/stream) e il long-polling
+(/notifications/poll) attendono un cambio di versione con attendi(); il
+polling di /notifications usa la versione come ETag e risponde 304 senza
+prendere una connessione al database. Un client inattivo non esegue query.
+
+Chi scrive notifiche chiama pubblica() (o verifica_nuove_notifiche() se non
+conosce gli utenti). Per le notifiche create o lette da altri processi (più
+worker gunicorn, worker notifiche separato) un thread di controllo esegue,
+solo se ci sono client attivi, poche query su indice ogni
+INTERVALLO_CONTROLLO secondi per processo: il costo non dipende dal numero
+di schede aperte.
+
+Id AUTO_INCREMENT e date vengono assegnati durante la transazione, quindi
+una notifica (o una lettura) in commit tardivo può comparire con un id più
+basso o una data più vecchia di righe già viste. Come nel delta sync, i
+checkpoint non superano mai l'orizzonte stabile (delta_sync.orizzonte_stabile():
+inizio della più vecchia transazione di scrittura aperta): le righe più
+recenti vengono riesaminate a ogni controllo e ricordate per essere
+pubblicate una sola volta.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from database_connection import connect_to_database
+from utils.delta_sync import orizzonte_stabile
+
+INTERVALLO_CONTROLLO = 5   # secondi
+FINESTRA_CLIENT = 60       # secondi di attività del controllo dopo l'ultima richiesta
+
+logger = logging.getLogger(__name__)
+
+_condizione = threading.Condition()
+_versioni = {}
+_versione_globale = 0
+_iscritti = 0
+# Checkpoint (id o data) oltre i quali le righe vengono riesaminate, e
+# righe oltre il checkpoint già pubblicate
+_checkpoint_notifiche = None
+_notifiche_pubblicate = set()
+_checkpoint_broadcast = None
+_broadcast_pubblicati = set()
+_limite_letture = None
+_letture_pubblicate = set()
+_ultimo_controllo = 0.0
+_ultimo_client = 0.0
+_thread_controllo = None
+_lock_controllo = threading.Lock()
+
+
+def _versione(user_id):
+    return _versione_globale + _versioni.get(user_id, 0)
+
+
+def versione(user_id):
+    """Versione corrente delle notifiche dell'utente."""
+    with _condizione:
+        return _versione(user_id)
+
+
+def versione_aggiornata(user_id):
+    """
+    Versione da usare per rispondere a un client. Segna il processo come
+    attivo e, se il controllo periodico era fermo, lo esegue subito: una
+    versione vecchia non deve mai confermare dati cambiati nel frattempo.
+    """
+    global _ultimo_client
+    _avvia_controllo()
+    with _condizione:
+        _ultimo_client = time.monotonic()
+        aggiornato = _ultimo_client - _ultimo_controllo < 2 * INTERVALLO_CONTROLLO
+    if not aggiornato:
+        verifica_nuove_notifiche()
+    return versione(user_id)
+
+
+def pubblica(user_ids=None):
+    """Segnala un cambiamento per gli utenti indicati (None = tutti)."""
+    global _versione_globale
+    with _condizione:
+        if user_ids is None:
+            _versione_globale += 1
+        else:
+            for user_id in user_ids:
+                _versioni[user_id] = _versioni.get(user_id, 0) + 1
+        _condizione.notify_all()
+
+
+def attendi(user_id, versione_nota, timeout):
+    """
+    Attende fino a `timeout` secondi che la versione dell'utente sia diversa
+    da `versione_nota`. Restituisce la versione corrente (uguale a quella
+    nota se è scaduto il timeout).
+    """
+    global _iscritti
+    _avvia_controllo()
+    with _condizione:
+        _iscritti += 1
+        try:
+            _condizione.wait_for(lambda: _versione(user_id) != versione_nota, timeout)
+            return _versione(user_id)
+        finally:
+            _iscritti -= 1
+
+
+def _orizzonte(cursor):
+    # Le date delle notifiche hanno la precisione del secondo: un secondo di
+    # margine, così una riga nello stesso secondo dell'orizzonte non si perde
+    return orizzonte_stabile(cursor).replace(microsecond=0) - timedelta(seconds=1)
+
+
+def _checkpoint_iniziale(cursor, tabella, colonna_data, orizzonte):
+    """Id più alto tra le righe precedenti l'orizzonte (scansione a ritroso della chiave primaria)."""
+    cursor.execute(f"SELECT id FROM {tabella} WHERE {colonna_data} < %s ORDER BY id DESC LIMIT 1",
+                   (orizzonte,))
+    riga = cursor.fetchone()
+    return riga['id'] if riga else 0
+
+
+def _nuove_righe(cursor, tabella, colonne, colonna_data, checkpoint, pubblicate, orizzonte):
+    """
+    Righe con id oltre il checkpoint non ancora pubblicate. Il checkpoint
+    avanza solo sulle righe precedenti l'orizzonte: restituisce (righe, checkpoint).
+    """
+    cursor.execute(f"""
+        SELECT id, {colonne}, COALESCE({colonna_data}, '1970-01-01') < %s AS stabile
+        FROM {tabella}
+        WHERE id > %s
+        ORDER BY id
+    """, (orizzonte, checkpoint))
+    righe = cursor.fetchall()
+    nuove = [r for r in righe if r['id'] not in pubblicate]
+    for riga in righe:
+        if not riga['stabile']:
+            break
+        checkpoint = riga['id']
+    pubblicate.update(r['id'] for r in nuove)
+    pubblicate.difference_update([i for i in pubblicate if i <= checkpoint])
+    return nuove, checkpoint
+
+
+def verifica_nuove_notifiche():
+    """
+    Pubblica agli utenti con notifiche create o lette (data_visualizzazione /
+    letto_at) da qualunque processo, e a tutti se è stato inviato un nuovo
+    broadcast.
+    """
+    global _checkpoint_notifiche, _checkpoint_broadcast, _limite_letture, _ultimo_controllo
+    with _lock_controllo:
+        conn = connect_to_database()
+        cursor = conn.cursor(dictionary=True)
+        try:
+            orizzonte = _orizzonte(cursor)
+            if _checkpoint_notifiche is None:
+                _checkpoint_notifiche = _checkpoint_iniziale(cursor, 'notifications', 'data_notifica', orizzonte)
+                _checkpoint_broadcast = _checkpoint_iniziale(cursor, 'broadcasts', 'created_at', orizzonte)
+                _limite_letture = orizzonte
+            nuove, _checkpoint_notifiche = _nuove_righe(
+                cursor, 'notifications', 'user_id', 'data_notifica',
+                _checkpoint_notifiche, _notifiche_pubblicate, orizzonte)
+            broadcast, _checkpoint_broadcast = _nuove_righe(
+                cursor, 'broadcasts', 'created_by', 'created_at',
+                _checkpoint_broadcast, _broadcast_pubblicati, orizzonte)
+            cursor.execute("""
+                SELECT 'n' AS tabella, id AS chiave, user_id, data_visualizzazione AS istante
+                FROM notifications WHERE data_visualizzazione > %s
+                UNION ALL
+                SELECT 'b', broadcast_id, user_id, letto_at
+                FROM broadcast_reads WHERE letto_at > %s
+            """, (_limite_letture, _limite_letture))
+            letture = cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+
+        # Le letture oltre l'orizzonte restano nella finestra: pubblicate una volta sola
+        lette = []
+        for riga in letture:
+            chiave = (riga['tabella'], riga['chiave'], riga['user_id'], riga['istante'])
+            if chiave not in _letture_pubblicate:
+                _letture_pubblicate.add(chiave)
+                lette.append(riga)
+        if orizzonte > _limite_letture:
+            _limite_letture = orizzonte
+        _letture_pubblicate.difference_update([c for c in _letture_pubblicate if c[3] <= _limite_letture])
+        _ultimo_controllo = time.monotonic()
+
+        utenti = {r['user_id'] for r in nuove} | {r['user_id'] for r in lette}
+        if utenti:
+            pubblica(utenti)
+        if broadcast:
+            pubblica()
+
+
+def _ciclo_controllo():
+    evento = threading.Event()
+    while True:
+        evento.wait(INTERVALLO_CONTROLLO)
+        with _condizione:
+            in_ascolto = _iscritti > 0 or time.monotonic() - _ultimo_client < FINESTRA_CLIENT
+        if not in_ascolto:
+            continue
+        try:
+            verifica_nuove_notifiche()
+        except Exception as e:
+            logger.error('Errore nel controllo nuove notifiche: %s', e)
+
+
+def _avvia_controllo():
+    global _thread_controllo
+    with _condizione:
+        if _thread_controllo is None or not _thread_controllo.is_alive():
+            _thread_controllo = threading.Thread(target=_ciclo_controllo, name='bus-notifiche', daemon=True)
+            _thread_controllo.start()
@@ -0,0 +1,144 @@
+"""
+Worker in background per il controllo soglie e la creazione delle notifiche.
+
+Consuma gli eventi "giacenza cambiata per il prodotto X" dall'outbox
+(consumer `notifiche`), fuori dal percorso della richiesta:
+  - le scritture chiamano sveglia() dopo il commit; in assenza di sveglie
+    il worker controlla comunque l'outbox ogni INTERVALLO_POLLING secondi
+    (eventi scritti da altri processi o rimasti da un riavvio);
+  - dopo una sveglia attende FINESTRA_RAFFICA secondi, così una raffica di
+    scritture sullo stesso prodotto produce una sola valutazione;
+  - ogni blocco di eventi viene ridotto ai prodotti distinti e valutato in
+    un'unica transazione (notifiche scritte in batch).
+
+Può girare come thread dentro l'app (avvia_worker(), default) oppure come
+processo separato, impostando NOTIFICHE_WORKER=off per l'app:
+
+    python -m utils.notification_worker
+"""
+import logging
+import os
+import threading
+import time
+
+from database_connection import connect_to_database
+from utils.notification_bus import verifica_nuove_notifiche
+from utils.notifications import controlla_soglie
+from utils.outbox import elabora_eventi, leggi_checkpoint
+
+CONSUMER = 'notifiche'
+INTERVALLO_POLLING = 10    # secondi
+FINESTRA_RAFFICA = 0.5     # secondi
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_sveglia = threading.Event()
+_thread = None
+METRICHE = {
+    'cicli': 0,
+    'eventi_elaborati': 0,
+    'prodotti_valutati': 0,
+    'notifiche_create': 0,
+    'errori': 0,
+    'ultimo_errore': None,
+    'ultimo_ciclo': None,
+    'durata_ultimo_ciclo_ms': None,
+}
+
+
+def _incrementa(**valori):
+    with _lock:
+        for chiave, valore in valori.items():
+            METRICHE[chiave] += valore
+
+
+def _gestisci_eventi(eventi):
+    """Un blocco di eventi -> una valutazione dei prodotti distinti toccati."""
+    prodotto_ids = {e['prodotto_id'] for e in eventi if e['prodotto_id']}
+    create = controlla_soglie(prodotto_ids) if prodotto_ids else 0
+    if create:
+        verifica_nuove_notifiche()  # push immediato ai client collegati a questo processo
+    _incrementa(eventi_elaborati=len(eventi), prodotti_valutati=len(prodotto_ids), notifiche_create=create)
+
+
+def esegui_ciclo():
+    """Elabora tutti gli eventi in attesa. Gli errori vengono registrati, non propagati."""
+    inizio = time.monotonic()
+    try:
+        elabora_eventi(CONSUMER, _gestisci_eventi, solleva_errori=True)
+    except Exception as e:
+        logger.exception('Errore nel worker notifiche')
+        with _lock:
+            METRICHE['errori'] += 1
+            METRICHE['ultimo_errore'] = f'{time.strftime("%Y-%m-%d %H:%M:%S")} {e}'
+    with _lock:
+        METRICHE['cicli'] += 1
+        METRICHE['ultimo_ciclo'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        METRICHE['durata_ultimo_ciclo_ms'] = round((time.monotonic() - inizio) * 1000, 1)
+
+
+def sveglia():
+    """Segnala al worker che ci sono nuovi eventi (da chiamare dopo il commit)."""
+    _sveglia.set()
+
+
+def ciclo_worker(fermati=None):
+    """Ciclo principale: attende una sveglia o il polling, poi elabora l'outbox."""
+    fermati = fermati or threading.Event()
+    while not fermati.is_set():
+        if _sveglia.wait(INTERVALLO_POLLING):
+            time.sleep(FINESTRA_RAFFICA)  # raccoglie la raffica di scritture
+        _sveglia.clear()
+        esegui_ciclo()
+
+
+def avvia_worker():
+    """Avvia il worker come thread daemon (una sola volta per processo)."""
+    global _thread
+    if os.getenv('NOTIFICHE_WORKER', 'thread').lower() == 'off':
+        return None
+    with _lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=ciclo_worker, name='worker-notifiche', daemon=True)
+            _thread.start()
+    return _thread
+
+
+def get_metriche_worker():
+    """
+    Metriche del worker più profondità della coda (eventi non ancora
+    confermati) e ritardo (età dell'evento più vecchio in attesa).
+    """
+    with _lock:
+        metriche = dict(METRICHE)
+    metriche['thread_attivo'] = bool(_thread and _thread.is_alive())
+
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        checkpoint = leggi_checkpoint(cursor, CONSUMER)
+        cursor.execute("""
+            SELECT COUNT(*) AS in_coda,
+                   TIMESTAMPDIFF(MICROSECOND, MIN(created_at), NOW(6)) / 1000000 AS ritardo_secondi
+            FROM outbox_events
+            WHERE id > %s
+        """, (checkpoint,))
+        coda = cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+    metriche['checkpoint'] = checkpoint
+    metriche['in_coda'] = coda['in_coda']
+    metriche['ritardo_secondi'] = float(coda['ritardo_secondi'] or 0)
+    return metriche
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    logger.info('Worker notifiche avviato (polling ogni %s s)', INTERVALLO_POLLING)
+    try:
+        ciclo_worker()
+    except KeyboardInterrupt:
+        logger.info('Worker notifiche fermato')
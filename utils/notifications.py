@@ -0,0 +1,205 @@
+"""
+Controllo delle soglie minime e creazione delle notifiche.
+
+Dopo una scrittura vengono valutate solo le soglie dei prodotti toccati
+(valuta_soglie con prodotto_ids, alimentato dagli eventi dell'outbox):
+il costo è proporzionale ai prodotti modificati, non a tutte le soglie.
+Il controllo completo resta come rete di sicurezza notturna:
+
+    python -m utils.notifications        # es. da cron alle 02:00
+
+I broadcast degli amministratori sono una riga in broadcasts (più una
+ricevuta di lettura per utente in broadcast_reads) e vengono uniti al feed
+al momento della lettura: inviarne uno non scrive una riga per utente.
+"""
+import logging
+import sys
+from datetime import datetime
+
+from database_connection import connect_to_database
+
+TIPI_BROADCAST = ('info', 'success', 'warning', 'error')
+
+logger = logging.getLogger(__name__)
+
+
+def _select_sotto_soglia(filtro=''):
+    """
+    Una riga per utente/prodotto/magazzino sotto il minimo. Join per id
+    (idx_threshold_prodotto, PRIMARY di prodotti): vedi test_indici_soglie.py.
+    """
+    return f"""
+        SELECT
+            pt.user_id,
+            p.codice_prodotto,
+            p.nome_prodotto,
+            pt.soglia_minima,
+            COALESCE(SUM(g.quantita), 0) as quantita_attuale,
+            m.nome as magazzino
+        FROM product_thresholds pt
+        JOIN prodotti p ON p.id = pt.prodotto_id
+        LEFT JOIN giacenze g ON p.id = g.prodotto_id
+        LEFT JOIN magazzini m ON g.magazzino_id = m.id
+        WHERE pt.notifica_attiva = TRUE {filtro}
+        GROUP BY pt.user_id, p.codice_prodotto, p.nome_prodotto, pt.soglia_minima, m.nome
+        HAVING quantita_attuale <= pt.soglia_minima
+    """
+
+
+def valuta_soglie(cursor, prodotto_ids=None):
+    """
+    Crea le notifiche per le soglie attive sotto il minimo con un unico
+    INSERT ... SELECT: anti-join sulle notifiche non lette e indice UNIQUE
+    uq_notifica_non_letta (add_notifications_unread_key.sql), quindi al
+    massimo una notifica non letta per utente/prodotto anche con controlli
+    concorrenti. Con `prodotto_ids` valuta solo le soglie di quei prodotti;
+    senza, tutte le soglie (controllo completo). Restituisce le notifiche create.
+    """
+    filtro = ''
+    params = []
+    if prodotto_ids is not None:
+        prodotto_ids = sorted({int(pid) for pid in prodotto_ids})
+        if not prodotto_ids:
+            return 0
+        filtro = f"AND pt.prodotto_id IN ({','.join(['%s'] * len(prodotto_ids))})"
+        params = prodotto_ids
+
+    # sotto_soglia: una riga per utente/prodotto/magazzino sotto il minimo;
+    # per ogni utente/prodotto si notifica il magazzino con meno quantità
+    cursor.execute(f"""
+        INSERT INTO notifications
+            (user_id, codice_prodotto, nome_prodotto, quantita_attuale, soglia_minima, magazzino)
+        SELECT s.user_id, s.codice_prodotto, s.nome_prodotto, s.quantita_attuale, s.soglia_minima, s.magazzino
+        FROM (
+            SELECT sotto_soglia.*,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY sotto_soglia.user_id, sotto_soglia.codice_prodotto
+                       ORDER BY sotto_soglia.quantita_attuale, sotto_soglia.magazzino
+                   ) AS posizione
+            FROM (
+                {_select_sotto_soglia(filtro)}
+            ) sotto_soglia
+        ) s
+        LEFT JOIN notifications n
+               ON n.user_id = s.user_id
+              AND n.codice_non_letto = s.codice_prodotto COLLATE utf8mb4_unicode_ci
+        WHERE s.posizione = 1 AND n.id IS NULL
+        ON DUPLICATE KEY UPDATE notifications.id = notifications.id
+    """, params)
+    # Con ON DUPLICATE KEY UPDATE senza modifiche le righe già presenti contano 0
+    return max(cursor.rowcount, 0)
+
+
+def _broadcast_non_letti(cursor, user_id):
+    """Broadcast inviati dopo la creazione dell'utente e senza ricevuta di lettura."""
+    cursor.execute("""
+        SELECT b.id, b.titolo, b.messaggio, b.tipo, b.created_at
+        FROM utenti u
+        JOIN broadcasts b ON b.created_at >= COALESCE(u.created_at, '1970-01-01')
+        LEFT JOIN broadcast_reads r ON r.user_id = u.id AND r.broadcast_id = b.id
+        WHERE u.id = %s AND r.broadcast_id IS NULL
+    """, (user_id,))
+    # Stessa forma delle notifiche soglia; id prefissato per non collidere
+    return [{
+        'id': f"b{b['id']}",
+        'broadcast_id': b['id'],
+        'codice_prodotto': f"[{b['tipo'].upper()}] {b['titolo']}",
+        'nome_prodotto': b['messaggio'],
+        'quantita_attuale': 0,
+        'soglia_minima': 0,
+        'magazzino': b['tipo'],
+        'data_notifica': b['created_at'],
+    } for b in cursor.fetchall()]
+
+
+def notifiche_non_lette(cursor, user_id):
+    """Notifiche soglia e broadcast non letti dell'utente, più recenti prima, pronti per il JSON."""
+    cursor.execute("""
+        SELECT 
+            id,
+            codice_prodotto,
+            nome_prodotto,
+            quantita_attuale,
+            soglia_minima,
+            magazzino,
+            data_notifica
+        FROM notifications
+        WHERE visualizzata = FALSE AND user_id = %s
+        ORDER BY data_notifica DESC
+    """, (user_id,))
+    notifiche = cursor.fetchall() + _broadcast_non_letti(cursor, user_id)
+    notifiche.sort(key=lambda n: n['data_notifica'] or datetime.min, reverse=True)
+    # Converti datetime in stringa per JSON
+    for n in notifiche:
+        if n.get('data_notifica'):
+            n['data_notifica'] = n['data_notifica'].strftime('%Y-%m-%d %H:%M:%S')
+    return notifiche
+
+
+def crea_broadcast(cursor, titolo, messaggio, tipo, user_id):
+    """Registra un broadcast per tutti gli utenti: una sola riga. Restituisce l'id."""
+    tipo = tipo if tipo in TIPI_BROADCAST else 'info'
+    cursor.execute("""
+        INSERT INTO broadcasts (titolo, messaggio, tipo, created_by)
+        VALUES (%s, %s, %s, %s)
+    """, (titolo, messaggio, tipo, user_id))
+    return cursor.lastrowid
+
+
+def segna_broadcast_letto(cursor, user_id, broadcast_id):
+    cursor.execute("""
+        INSERT IGNORE INTO broadcast_reads (user_id, broadcast_id)
+        VALUES (%s, %s)
+    """, (user_id, broadcast_id))
+
+
+def segna_broadcast_letti(cursor, user_id):
+    """Ricevuta di lettura per tutti i broadcast non ancora letti dall'utente."""
+    cursor.execute("""
+        INSERT IGNORE INTO broadcast_reads (user_id, broadcast_id)
+        SELECT u.id, b.id
+        FROM utenti u
+        JOIN broadcasts b ON b.created_at >= COALESCE(u.created_at, '1970-01-01')
+        WHERE u.id = %s
+    """, (user_id,))
+
+
+def broadcast_recenti(cursor, limite=5):
+    """Ultimi broadcast per il pannello admin (indice su created_at)."""
+    cursor.execute("""
+        SELECT titolo AS riferimento, messaggio, created_at AS data_notifica, tipo
+        FROM broadcasts
+        ORDER BY created_at DESC
+        LIMIT %s
+    """, (limite,))
+    return cursor.fetchall()
+
+
+def conta_broadcast_oggi(cursor):
+    cursor.execute("SELECT COUNT(*) AS total FROM broadcasts WHERE created_at >= CURDATE()")
+    return cursor.fetchone()['total']
+
+
+def controlla_soglie(prodotto_ids=None):
+    """Esegue valuta_soglie() in una propria transazione. Restituisce le notifiche create."""
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        create = valuta_soglie(cursor, prodotto_ids)
+        conn.commit()
+        return create
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        logger.info('Controllo completo soglie: %s notifiche create', controlla_soglie())
+    except Exception as e:
+        logger.error('Controllo completo soglie non riuscito: %s', e)
+        sys.exit(1)
@@ -0,0 +1,162 @@
+"""
+Outbox transazionale degli eventi di magazzino.
+
+Le scritture sulle giacenze registrano un evento in outbox_events con
+registra_evento()/registra_eventi() usando lo stesso cursore della
+transazione: l'evento esiste solo se la modifica va in commit. Gli effetti
+collaterali (controllo soglie, notifiche) vengono eseguiti dai consumer
+fuori dalla richiesta, leggendo gli eventi in ordine di id e salvando un
+checkpoint in outbox_consumers.
+
+Consegna "almeno una volta": l'id viene assegnato all'INSERT, quindi una
+transazione ancora aperta può rendere visibile un id più basso dopo uno più
+alto. Il checkpoint suggerito da leggi_eventi() non supera mai gli eventi
+successivi all'orizzonte stabile (delta_sync.orizzonte_stabile(): inizio
+della più vecchia transazione di scrittura aperta), che vengono quindi
+riconsegnati: i consumer devono essere idempotenti. Per tenere breve questa finestra gli
+eventi vanno registrati alla fine della transazione, subito prima del commit.
+"""
+import json
+import logging
+
+from database_connection import connect_to_database
+from utils.delta_sync import orizzonte_stabile
+
+LIMITE_DEFAULT = 200
+LIMITE_MASSIMO = 1000
+
+logger = logging.getLogger(__name__)
+
+INSERT_EVENTO_SQL = """
+    INSERT INTO outbox_events (tipo_evento, prodotto_id, quantita, user_id, payload)
+    VALUES (%s, %s, %s, %s, %s)
+"""
+
+
+def _riga_evento(tipo_evento, prodotto_id, quantita, user_id, dati=None):
+    payload = json.dumps(dati, default=str) if dati else None
+    return (tipo_evento, prodotto_id, quantita, user_id, payload)
+
+
+def registra_evento(cursor, tipo_evento, prodotto_id, quantita, user_id, dati=None):
+    """Scrive un evento nella transazione corrente del cursore."""
+    cursor.execute(INSERT_EVENTO_SQL, _riga_evento(tipo_evento, prodotto_id, quantita, user_id, dati))
+
+
+def registra_eventi(cursor, eventi):
+    """
+    Versione batch di registra_evento(): `eventi` è una lista di tuple
+    (tipo_evento, prodotto_id, quantita, user_id, dati). Un solo executemany.
+    """
+    righe = [_riga_evento(*evento) for evento in eventi]
+    if righe:
+        cursor.executemany(INSERT_EVENTO_SQL, righe)
+
+
+def leggi_checkpoint(cursor, consumer):
+    """Ultimo id confermato dal consumer (0 se non ha mai confermato)."""
+    cursor.execute("SELECT ultimo_id FROM outbox_consumers WHERE consumer = %s", (consumer,))
+    riga = cursor.fetchone()
+    return riga['ultimo_id'] if riga else 0
+
+
+def leggi_eventi(cursor, consumer, limite=LIMITE_DEFAULT):
+    """
+    Eventi successivi al checkpoint del consumer, in ordine di id:
+    {consumer, checkpoint, eventi, ack, has_more}.
+    `ack` è l'id da confermare dopo averli elaborati: può essere inferiore
+    all'ultimo evento se alcuni sono troppo recenti (verranno riconsegnati).
+    """
+    limite = max(1, min(int(limite), LIMITE_MASSIMO))
+    checkpoint = leggi_checkpoint(cursor, consumer)
+
+    orizzonte = orizzonte_stabile(cursor)
+    cursor.execute("""
+        SELECT id, tipo_evento, prodotto_id, quantita, user_id, payload, created_at,
+               created_at >= %s AS recente
+        FROM outbox_events
+        WHERE id > %s
+        ORDER BY id
+        LIMIT %s
+    """, (orizzonte, checkpoint, limite + 1))
+    eventi = cursor.fetchall()
+
+    has_more = len(eventi) > limite
+    eventi = eventi[:limite]
+
+    ack = checkpoint
+    for evento in eventi:
+        if evento.pop('recente'):
+            break
+        ack = evento['id']
+    for evento in eventi:
+        evento.pop('recente', None)
+        evento['payload'] = json.loads(evento['payload']) if evento['payload'] else {}
+
+    return {'consumer': consumer, 'checkpoint': checkpoint, 'eventi': eventi,
+            'ack': ack, 'has_more': has_more}
+
+
+def conferma_eventi(cursor, consumer, ultimo_id):
+    """Sposta in avanti il checkpoint del consumer (mai indietro)."""
+    cursor.execute("""
+        INSERT INTO outbox_consumers (consumer, ultimo_id) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE ultimo_id = GREATEST(ultimo_id, VALUES(ultimo_id))
+    """, (consumer, int(ultimo_id)))
+
+
+def stato_outbox(cursor):
+    """Per ogni consumer: checkpoint ed eventi ancora da elaborare."""
+    cursor.execute("SELECT COALESCE(MAX(id), 0) AS ultimo_evento FROM outbox_events")
+    ultimo_evento = cursor.fetchone()['ultimo_evento']
+    cursor.execute("""
+        SELECT c.consumer, c.ultimo_id, c.updated_at,
+               (SELECT COUNT(*) FROM outbox_events e WHERE e.id > c.ultimo_id) AS in_attesa
+        FROM outbox_consumers c
+        ORDER BY c.consumer
+    """)
+    return {'ultimo_evento': ultimo_evento, 'consumers': cursor.fetchall()}
+
+
+def elabora_eventi(consumer, gestore, limite=LIMITE_DEFAULT, solleva_errori=False):
+    """
+    Elabora gli eventi in attesa per `consumer` chiamando gestore(eventi)
+    per ogni blocco e confermando il checkpoint dopo ogni blocco riuscito.
+    Un solo processo alla volta per consumer (GET_LOCK): se il lock è già
+    preso restituisce 0. Restituisce il numero di eventi consegnati.
+    Gli errori vengono registrati nel log, o propagati con `solleva_errori`.
+    """
+    conn = connect_to_database()
+    cursor = conn.cursor(dictionary=True)
+    nome_lock = f'outbox:{consumer}'
+    consegnati = 0
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, 0) AS preso", (nome_lock,))
+        if not cursor.fetchone()['preso']:
+            return 0
+        try:
+            while True:
+                blocco = leggi_eventi(cursor, consumer, limite)
+                conn.commit()  # nuova snapshot a ogni blocco
+                if not blocco['eventi']:
+                    break
+                gestore(blocco['eventi'])
+                consegnati += len(blocco['eventi'])
+                if blocco['ack'] > blocco['checkpoint']:
+                    conferma_eventi(cursor, consumer, blocco['ack'])
+                    conn.commit()
+                # Eventi recenti non confermabili: verranno riconsegnati al prossimo giro
+                if not blocco['has_more'] or blocco['ack'] < blocco['eventi'][-1]['id']:
+                    break
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (nome_lock,))
+            cursor.fetchone()
+    except Exception as e:
+        conn.rollback()
+        if solleva_errori:
+            raise
+        logger.error("Errore nell'elaborazione dell'outbox (%s): %s", consumer, e)
+    finally:
+        cursor.close()
+        conn.close()
+    return consegnati
@@ -0,0 +1,229 @@
+"""
+Sincronizzazione batch delle operazioni accodate offline dai palmari.
+
+Il client (static/offline-queue.js) salva in IndexedDB modifiche rapide,
+scarichi e movimenti, ognuno con una chiave di idempotenza generata sul
+dispositivo, e li invia in blocco a POST /api/sync. Tutte le operazioni
+del batch vengono applicate in un'unica transazione; ognuna ha il proprio
+SAVEPOINT, quindi un'operazione rifiutata non annulla le altre.
+
+L'esito di ogni operazione viene salvato in sync_operations: se il
+dispositivo reinvia la stessa chiave (es. risposta persa per caduta del
+Wi-Fi) riceve l'esito già registrato e l'operazione non viene ripetuta.
+"""
+import json
+import logging
+
+from mysql.connector import Error as ErroreDatabase
+
+from utils.giacenze import aggiorna_quantita_giacenza, carica_giacenza
+from utils.movimento_multiplo import (
+    normalizza_movimenti, carica_giacenze_coinvolte, pianifica_movimenti, applica_piano
+)
+from utils.outbox import registra_evento
+from utils.transactions import blocca_giacenze, ERRORI_RIPETIBILI
+
+MAX_OPERAZIONI = 200
+
+logger = logging.getLogger(__name__)
+
+
+class OperazioneRifiutata(Exception):
+    """Operazione non applicabile (dati non validi, giacenza insufficiente, conflitto)."""
+
+    def __init__(self, messaggio, stato='errore', giacenza=None):
+        super().__init__(messaggio)
+        self.messaggio = messaggio
+        self.stato = stato
+        self.giacenza = giacenza
+
+
+def _intero(valore, campo):
+    try:
+        return int(valore)
+    except (TypeError, ValueError):
+        raise OperazioneRifiutata(f'{campo} non valido')
+
+
+def _modifica_rapida(cursor, user_id, dati):
+    """Stessa logica di /aggiorna_giacenza_rapida, con versione obbligatoria."""
+    giacenza_id = _intero(dati.get('giacenza_id'), 'Giacenza')
+    nuova_quantita = _intero(dati.get('quantita'), 'Quantità')
+    version = _intero(dati.get('version'), 'Versione')
+    if nuova_quantita < 0:
+        raise OperazioneRifiutata('Quantità non valida')
+
+    giacenza = blocca_giacenze(cursor, [giacenza_id]).get(giacenza_id)
+    if not giacenza:
+        raise OperazioneRifiutata('Giacenza non trovata')
+    if giacenza['version'] != version:
+        raise OperazioneRifiutata('La giacenza è stata modificata da un altro utente',
+                                  stato='conflitto', giacenza=carica_giacenza(cursor, giacenza_id))
+
+    aggiorna_quantita_giacenza(cursor, giacenza_id, nuova_quantita, version=version)
+    differenza = nuova_quantita - giacenza['quantita']
+    if differenza:
+        cursor.execute("""
+            INSERT INTO movimenti (prodotto_id, quantita, note, user_id, stato, a_ubicazione, a_magazzino_id, tipo_movimento)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            giacenza['prodotto_id'],
+            abs(differenza),
+            f"Modifica rapida mobile: {giacenza['quantita']} → {nuova_quantita} ({'carico' if differenza > 0 else 'scarico'})",
+            user_id,
+            'IN_MAGAZZINO',
+            giacenza['ubicazione'],
+            giacenza['magazzino_id'] or 1,
+            'MODIFICA'
+        ))
+        registra_evento(cursor, 'MODIFICA', giacenza['prodotto_id'], nuova_quantita, user_id, {
+            'giacenza_id': giacenza_id, 'quantita_precedente': giacenza['quantita'],
+            'a_stato': giacenza['stato'], 'a_ubicazione': giacenza['ubicazione'], 'offline': True,
+        })
+    return carica_giacenza(cursor, giacenza_id)
+
+
+def _scarico(cursor, user_id, dati):
+    """Stessa logica di /scaricomerce (scarico da magazzino)."""
+    prodotto_id = _intero(dati.get('prodotto_id'), 'Prodotto')
+    quantita = _intero(dati.get('quantita'), 'Quantità')
+    ubicazione = dati.get('ubicazione') or None
+    if quantita <= 0:
+        raise OperazioneRifiutata('La quantità deve essere positiva')
+
+    query = "SELECT * FROM giacenze WHERE prodotto_id = %s AND stato = 'IN_MAGAZZINO'"
+    params = [prodotto_id]
+    if ubicazione:
+        query += " AND ubicazione = %s"
+        params.append(ubicazione)
+    cursor.execute(query + " ORDER BY id LIMIT 1 FOR UPDATE", params)
+    giacenza = cursor.fetchone()
+    if not giacenza:
+        raise OperazioneRifiutata('Giacenza non trovata per il prodotto e ubicazione selezionati')
+    if giacenza['quantita'] < quantita:
+        raise OperazioneRifiutata(f"Quantità insufficiente (disponibili: {giacenza['quantita']})")
+
+    nuova_quantita = giacenza['quantita'] - quantita
+    if nuova_quantita == 0:
+        cursor.execute("DELETE FROM giacenze WHERE id = %s", (giacenza['id'],))
+    else:
+        aggiorna_quantita_giacenza(cursor, giacenza['id'], nuova_quantita)
+    cursor.execute("""
+        INSERT INTO stock_ledger (prodotto_id, quantita, note, user_id, tipo_movimento, tipo_scarico)
+        VALUES (%s, %s, %s, %s, 'SCARICO', %s)
+    """, (prodotto_id, quantita, dati.get('note'), user_id, 'DA_MAGAZZINO'))
+    registra_evento(cursor, 'SCARICO', prodotto_id, quantita, user_id, {
+        'giacenza_id': giacenza['id'], 'da_ubicazione': giacenza['ubicazione'],
+        'quantita_precedente': giacenza['quantita'], 'quantita_nuova': nuova_quantita, 'offline': True,
+    })
+    return carica_giacenza(cursor, giacenza['id'])
+
+
+def _movimento(cursor, user_id, dati):
+    """Trasferimento singolo, con la stessa pianificazione del movimento multiplo."""
+    stato_origine = dati.get('stato_origine') or 'IN_MAGAZZINO'
+    righe, errori = normalizza_movimenti([{
+        'prodotto_id': dati.get('prodotto_id'),
+        'da_ubicazione': dati.get('da_ubicazione'),
+        'a_ubicazione': dati.get('a_ubicazione'),
+        'quantita': dati.get('quantita'),
+        'nota': dati.get('note') or '',
+        'stato_destinazione': dati.get('stato_destinazione') or stato_origine,
+    }])
+    if errori:
+        raise OperazioneRifiutata(errori[0].replace('Movimento 1: ', ''))
+
+    riga = righe[0]
+    giacenze = carica_giacenze_coinvolte(cursor, [riga['prodotto_id']], {stato_origine, riga['stato_destinazione']})
+    errori, piano = pianifica_movimenti(righe, stato_origine, giacenze, user_id)
+    if errori:
+        raise OperazioneRifiutata(errori[0].replace('Movimento 1: ', ''))
+    applica_piano(cursor, piano)
+    return None
+
+
+GESTORI = {
+    'modifica_rapida': _modifica_rapida,
+    'scarico': _scarico,
+    'movimento': _movimento,
+}
+
+
+def _esiti_registrati(cursor, user_id, chiavi):
+    """Esiti già salvati per le chiavi di idempotenza del batch (una query)."""
+    if not chiavi:
+        return {}
+    placeholder = ','.join(['%s'] * len(chiavi))
+    cursor.execute(f"""
+        SELECT idempotency_key, risultato FROM sync_operations
+        WHERE user_id = %s AND idempotency_key IN ({placeholder})
+    """, (user_id, *chiavi))
+    return {row['idempotency_key']: json.loads(row['risultato']) for row in cursor.fetchall()}
+
+
+def applica_operazioni(cursor, user_id, operazioni):
+    """
+    Applica le operazioni nell'ordine ricevuto e restituisce un esito per ognuna:
+    {id, stato: ok|errore|conflitto|duplicata, messaggio, giacenza}.
+    Un'operazione con dati non validi (anche se rifiutati dal database, es.
+    ubicazione troppo lunga o vincolo violato) riceve stato 'errore' e non
+    blocca le successive; solo deadlock e lock timeout vengono propagati,
+    così il runner può ripetere l'intero batch.
+    """
+    chiavi = sorted({str(op.get('id')) for op in operazioni if isinstance(op, dict) and op.get('id')})
+    registrati = _esiti_registrati(cursor, user_id, chiavi)
+
+    risultati = []
+    da_registrare = []
+    for op in operazioni:
+        if not isinstance(op, dict):
+            risultati.append({'id': '', 'stato': 'errore', 'messaggio': 'Operazione non valida'})
+            continue
+        chiave = str(op.get('id') or '')
+        tipo = op.get('tipo')
+        if not isinstance(tipo, str):
+            tipo = None
+        if not chiave or len(chiave) > 64:
+            risultati.append({'id': chiave, 'stato': 'errore', 'messaggio': 'Chiave di idempotenza mancante o non valida'})
+            continue
+        if chiave in registrati:
+            risultati.append({**registrati[chiave], 'id': chiave, 'duplicata': True})
+            continue
+
+        gestore = GESTORI.get(tipo)
+        cursor.execute("SAVEPOINT sync_op")
+        try:
+            if not gestore:
+                raise OperazioneRifiutata(f'Tipo operazione non supportato: {str(op.get("tipo"))[:30]}')
+            dati = op.get('dati') or {}
+            if not isinstance(dati, dict):
+                raise OperazioneRifiutata('Dati operazione non validi')
+            giacenza = gestore(cursor, user_id, dati)
+            esito = {'id': chiave, 'stato': 'ok', 'messaggio': '', 'giacenza': giacenza}
+            cursor.execute("RELEASE SAVEPOINT sync_op")
+        except OperazioneRifiutata as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT sync_op")
+            esito = {'id': chiave, 'stato': e.stato, 'messaggio': e.messaggio, 'giacenza': e.giacenza}
+        except ErroreDatabase as e:
+            # Deadlock e lock timeout: il runner ripete l'intero batch
+            if e.errno in ERRORI_RIPETIBILI:
+                raise
+            cursor.execute("ROLLBACK TO SAVEPOINT sync_op")
+            logger.warning('Operazione offline %s (%s) rifiutata dal database: %s', chiave, tipo, e)
+            esito = {'id': chiave, 'stato': 'errore', 'messaggio': f'Dati non validi: {e.msg}', 'giacenza': None}
+        except (TypeError, ValueError, AttributeError, KeyError) as e:
+            # Valori di tipo inatteso nei dati dell'operazione (es. liste al posto di testi)
+            cursor.execute("ROLLBACK TO SAVEPOINT sync_op")
+            logger.warning('Operazione offline %s (%s) non valida: %s', chiave, tipo, e)
+            esito = {'id': chiave, 'stato': 'errore', 'messaggio': 'Dati operazione non validi', 'giacenza': None}
+
+        registrati[chiave] = esito
+        risultati.append(esito)
+        da_registrare.append((user_id, chiave, tipo, esito['stato'], json.dumps(esito, default=str)))
+
+    if da_registrare:
+        cursor.executemany("""
+            INSERT INTO sync_operations (user_id, idempotency_key, tipo, stato, risultato)
+            VALUES (%s, %s, %s, %s, %s)
+        """, da_registrare)
+    return risultati
@@ -0,0 +1,167 @@
+"""
+Esecuzione delle transazioni di scrittura con retry su deadlock e lock timeout.
+
+Le transazioni che toccano più giacenze (movimento multiplo, rientro,
+compensazione) possono andare in deadlock (errore MySQL 1213) o superare
+l'attesa dei lock (1205) quando più utenti lavorano in contemporanea.
+esegui_transazione() ripete automaticamente la transazione con un backoff
+esponenziale con jitter, entro un budget globale di retry, e registra le
+metriche; blocca_giacenze() prende i lock sempre in ordine di id, riducendo
+la probabilità di deadlock.
+"""
+import logging
+import random
+import threading
+import time
+
+import mysql.connector
+from mysql.connector import errorcode
+
+from database_connection import connect_to_database
+
+# Errori per cui la transazione viene ripetuta
+ERRORI_RIPETIBILI = {
+    errorcode.ER_LOCK_DEADLOCK: 'deadlock',              # 1213
+    errorcode.ER_LOCK_WAIT_TIMEOUT: 'lock_timeout',      # 1205
+}
+
+MAX_TENTATIVI = 4          # tentativi totali per transazione
+BACKOFF_BASE = 0.05        # secondi, raddoppiato a ogni tentativo
+BACKOFF_MAX = 1.0          # secondi
+# Budget globale: al massimo RETRY_BUDGET retry ogni RETRY_FINESTRA secondi,
+# per non amplificare il carico quando il database è già in sofferenza
+RETRY_BUDGET = 100
+RETRY_FINESTRA = 60
+
+MESSAGGIO_CONTESA = ("Il magazzino è molto occupato in questo momento: l'operazione non è stata "
+                     "registrata. Riprova tra qualche secondo.")
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_retry_recenti = []
+METRICHE = {
+    'transazioni': 0,
+    'commit': 0,
+    'retry_deadlock': 0,
+    'retry_lock_timeout': 0,
+    'fallite_dopo_retry': 0,
+    'budget_esaurito': 0,
+}
+
+
+class AnnullaTransazione(Exception):
+    """
+    Sollevata dalla funzione di transazione per fare ROLLBACK senza errore
+    (es. validazione fallita). esegui_transazione() restituisce `risultato`.
+    """
+
+    def __init__(self, risultato=None):
+        super().__init__()
+        self.risultato = risultato
+
+
+class TransazioneContesa(Exception):
+    """Deadlock/lock timeout persistente: retry esauriti o budget finito."""
+
+    def __init__(self, errore):
+        super().__init__(MESSAGGIO_CONTESA)
+        self.errore = errore
+        self.messaggio = MESSAGGIO_CONTESA
+
+
+def _incrementa(chiave):
+    with _lock:
+        METRICHE[chiave] += 1
+
+
+def _consuma_budget():
+    """Registra un retry se il budget della finestra corrente lo consente."""
+    adesso = time.monotonic()
+    with _lock:
+        while _retry_recenti and adesso - _retry_recenti[0] > RETRY_FINESTRA:
+            _retry_recenti.pop(0)
+        if len(_retry_recenti) >= RETRY_BUDGET:
+            METRICHE['budget_esaurito'] += 1
+            return False
+        _retry_recenti.append(adesso)
+        return True
+
+
+def _attesa(tentativo):
+    """Backoff esponenziale con full jitter."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (tentativo - 1))))
+
+
+def get_metriche_transazioni():
+    """Copia delle metriche di retry (per il pannello admin)."""
+    with _lock:
+        metriche = dict(METRICHE)
+        metriche['retry_ultima_finestra'] = len(_retry_recenti)
+    metriche['retry_budget'] = RETRY_BUDGET
+    return metriche
+
+
+def esegui_transazione(funzione, *args, max_tentativi=MAX_TENTATIVI, **kwargs):
+    """
+    Esegue funzione(cursor, *args, **kwargs) in una transazione e fa COMMIT.
+
+    In caso di deadlock o lock timeout MySQL annulla la transazione: la
+    funzione viene richiamata da capo (deve quindi rileggere i dati dal
+    database, non riusare valori letti in un tentativo precedente).
+    Solleva TransazioneContesa quando i tentativi o il budget sono esauriti;
+    gli altri errori vengono propagati dopo il ROLLBACK.
+    """
+    _incrementa('transazioni')
+    conn = connect_to_database()
+    conn.autocommit = False
+    try:
+        tentativo = 0
+        while True:
+            tentativo += 1
+            cursor = conn.cursor(dictionary=True, buffered=True)
+            try:
+                risultato = funzione(cursor, *args, **kwargs)
+                conn.commit()
+                _incrementa('commit')
+                return risultato
+            except AnnullaTransazione as annulla:
+                conn.rollback()
+                return annulla.risultato
+            except mysql.connector.Error as e:
+                conn.rollback()
+                tipo = ERRORI_RIPETIBILI.get(e.errno)
+                if tipo is None:
+                    raise
+                if tentativo >= max_tentativi or not _consuma_budget():
+                    _incrementa('fallite_dopo_retry')
+                    raise TransazioneContesa(e) from e
+                _incrementa(f'retry_{tipo}')
+                logger.warning("Transazione ripetuta (%s, tentativo %d/%d)", tipo, tentativo, max_tentativi)
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+            time.sleep(_attesa(tentativo))
+    finally:
+        conn.close()
+
+
+def blocca_giacenze(cursor, giacenza_ids):
+    """
+    Blocca (SELECT ... FOR UPDATE) le giacenze indicate in ordine di id,
+    così transazioni concorrenti prendono i lock sempre nella stessa sequenza.
+    Restituisce un dizionario id -> giacenza (le giacenze inesistenti mancano).
+    """
+    ids = sorted({int(i) for i in giacenza_ids if i is not None and int(i) > 0})
+    if not ids:
+        return {}
+    placeholder = ','.join(['%s'] * len(ids))
+    cursor.execute(f"""
+        SELECT * FROM giacenze
+        WHERE id IN ({placeholder})
+        ORDER BY id
+        FOR UPDATE
+    """, ids)
+    return {row['id']: row for row in cursor.fetchall()}